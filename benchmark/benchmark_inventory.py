@@ -0,0 +1,211 @@
+"""
+<Program Name>
+  benchmark_inventory.py
+
+<Purpose>
+  Fills a SeleXor database with a synthetic inventory of nodes, vessels,
+  ports and locations, so that resolutions can be benchmarked without
+  probing real nodes.
+
+  Nodes are spread over the countries in COUNTRIES in proportion to their
+  weights, roughly following where Seattle nodes are found, and are placed
+  near one of their country's cities.  A few nodes have no location, as
+  happens when the GeoIP lookup fails.
+
+  The inventory replaces whatever is in the database, so this must only be
+  used on a database set aside for benchmarks.  When settings.db_backend is
+  'sqlite', the database is named by the path of its file.
+
+"""
+
+import datetime
+import os
+import random
+import sys
+
+# Run from the SeleXor directory: python benchmark/<script>.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import selexorhelper
+import settings
+
+
+# (country_code, weight, [(city, latitude, longitude)])
+COUNTRIES = [
+  ('US', 30, [('Seattle', 47.6, -122.3), ('New York', 40.7, -74.0), ('Chicago', 41.9, -87.6), ('Austin', 30.3, -97.7)]),
+  ('DE', 8, [('Berlin', 52.5, 13.4), ('Munich', 48.1, 11.6)]),
+  ('CN', 6, [('Beijing', 39.9, 116.4), ('Shanghai', 31.2, 121.5)]),
+  ('JP', 5, [('Tokyo', 35.7, 139.7), ('Osaka', 34.7, 135.5)]),
+  ('GB', 5, [('London', 51.5, -0.1), ('Cambridge', 52.2, 0.1)]),
+  ('FR', 4, [('Paris', 48.9, 2.4), ('Lyon', 45.8, 4.8)]),
+  ('CA', 4, [('Toronto', 43.7, -79.4), ('Vancouver', 49.3, -123.1)]),
+  ('BR', 3, [('Sao Paulo', -23.6, -46.6), ('Rio de Janeiro', -22.9, -43.2)]),
+  ('IN', 3, [('Bangalore', 13.0, 77.6), ('Delhi', 28.6, 77.2)]),
+  ('KR', 3, [('Seoul', 37.6, 127.0)]),
+  ('IT', 2, [('Rome', 41.9, 12.5), ('Milan', 45.5, 9.2)]),
+  ('ES', 2, [('Madrid', 40.4, -3.7)]),
+  ('NL', 2, [('Amsterdam', 52.4, 4.9)]),
+  ('SE', 2, [('Stockholm', 59.3, 18.1)]),
+  ('CH', 2, [('Zurich', 47.4, 8.5)]),
+  ('AU', 2, [('Sydney', -33.9, 151.2), ('Melbourne', -37.8, 145.0)]),
+  ('PL', 1, [('Warsaw', 52.2, 21.0)]),
+  ('RU', 1, [('Moscow', 55.8, 37.6)]),
+  ('IL', 1, [('Tel Aviv', 32.1, 34.8)]),
+  ('TW', 1, [('Taipei', 25.0, 121.6)]),
+  ('GR', 1, [('Athens', 38.0, 23.7)]),
+  ('FI', 1, [('Helsinki', 60.2, 24.9)]),
+  ('AR', 1, [('Buenos Aires', -34.6, -58.4)]),
+  ('ZA', 1, [('Cape Town', -33.9, 18.4)]),
+]
+
+# (node_type, weight)
+NODE_TYPES = [
+  (selexorhelper.NODE_UNIVERSITY, 45),
+  (selexorhelper.NODE_HOME, 35),
+  (selexorhelper.NODE_TESTBED, 10),
+  (selexorhelper.NODE_UNKNOWN, 10),
+]
+
+# The fraction of nodes whose location is unknown.
+MISSING_LOCATION_RATE = 0.05
+
+# The user ports that vessels are given.
+USER_PORTS = range(63100, 63180)
+
+# The number of rows to insert with each statement.
+INSERT_CHUNK_SIZE = 1000
+
+
+def _pick_weighted(rng, choices):
+  target = rng.random() * sum([choice[1] for choice in choices])
+  for choice in choices:
+    target -= choice[1]
+    if target < 0:
+      return choice
+  return choices[-1]
+
+
+def use_database(database):
+  ''' Makes SeleXor connect to the given benchmark database. '''
+  if settings.db_backend == 'sqlite':
+    settings.sqlite_path = database
+  else:
+    settings.dbname = database
+
+
+def create_tables(cursor):
+  '''
+  <Purpose>
+    Creates the SeleXor tables, if they don't exist yet.
+  <Arguments>
+    cursor:
+      A cursor to the benchmark database.
+  <Exceptions>
+    MySQLdb.Error, sqlite3.Error
+  <Side Effects>
+    Runs the database's schema file if the vessels table is missing.
+  <Returns>
+    None
+
+  '''
+  selexorhelper.autoretry_mysql_command(cursor, "SHOW TABLES LIKE 'vessels'")
+  if cursor.fetchall():
+    return
+  code = open(selexorhelper.get_database_schema_file()).read()
+  for statement in code.split(';'):
+    if statement.strip():
+      selexorhelper.autoretry_mysql_command(cursor, statement.strip())
+
+
+def _insert_rows(cursor, table, columns, rows):
+  placeholders = '(' + ', '.join(['%s'] * len(columns)) + ')'
+  for chunk_start in range(0, len(rows), INSERT_CHUNK_SIZE):
+    chunk = rows[chunk_start:chunk_start + INSERT_CHUNK_SIZE]
+    values = []
+    for row in chunk:
+      values.extend(row)
+    selexorhelper.autoretry_mysql_command(cursor,
+      "INSERT INTO " + table + " (" + ', '.join(columns) + ") VALUES " +
+      ', '.join([placeholders] * len(chunk)), values)
+
+
+def generate_inventory(db, cursor, num_vessels, seed=0, max_vessels_per_node=8):
+  '''
+  <Purpose>
+    Replaces the inventory in the database with a synthetic one.
+  <Arguments>
+    db, cursor:
+      The connection and cursor of the benchmark database.
+    num_vessels:
+      The number of vessels to create.
+    seed:
+      Inventories generated with the same seed are the same.
+    max_vessels_per_node:
+      Each node gets between 1 and this many vessels.
+  <Exceptions>
+    MySQLdb.Error, sqlite3.Error
+  <Side Effects>
+    Deletes every node, vessel, port, location and vessel lease in the
+    database, and inserts the new inventory.
+  <Returns>
+    The number of nodes created.
+
+  '''
+  rng = random.Random(seed)
+  create_tables(cursor)
+  for table in ('vesselports', 'userkeys', 'vessels', 'nodes', 'location', 'vessel_leases'):
+    selexorhelper.autoretry_mysql_command(cursor, "DELETE FROM " + table)
+
+  now = datetime.datetime.now()
+  node_rows = []
+  location_rows = []
+  vessel_rows = []
+  port_rows = []
+  node_id = 0
+  while len(vessel_rows) < num_vessels:
+    node_id += 1
+    ip_addr = '10.%d.%d.%d' % (node_id / 65536 % 256, node_id / 256 % 256, node_id % 256)
+    node_key = '%040x' % rng.getrandbits(160)
+    node_type = _pick_weighted(rng, NODE_TYPES)[0]
+    last_ip_change = now - datetime.timedelta(seconds=rng.randint(0, 30 * 24 * 60 * 60))
+    last_seen = now - datetime.timedelta(seconds=rng.randint(0, 10 * 60))
+    node_rows.append((node_id, node_key, 1224, node_type, ip_addr, last_ip_change, last_seen))
+
+    if rng.random() >= MISSING_LOCATION_RATE:
+      country_code, weight, cities = _pick_weighted(rng, COUNTRIES)
+      city, latitude, longitude = rng.choice(cities)
+      # Nodes are spread around the city.
+      location_rows.append((ip_addr, city, country_code,
+        latitude + rng.uniform(-1, 1), int(round(longitude + rng.uniform(-1, 1)))))
+
+    num_node_vessels = min(rng.randint(1, max_vessels_per_node), num_vessels - len(vessel_rows))
+    for vessel_no in range(num_node_vessels):
+      # v1 and v2 are reserved for the nodemanager and the clearinghouse.
+      vesselname = 'v' + str(vessel_no + 3)
+      vessel_rows.append((node_id, vesselname))
+      for port in rng.sample(USER_PORTS, rng.randint(1, 3)):
+        port_rows.append((node_id, vesselname, str(port)))
+
+  _insert_rows(cursor, 'nodes',
+    ['node_id', 'node_key', 'node_port', 'node_type', 'ip_addr', 'last_ip_change', 'last_seen'], node_rows)
+  _insert_rows(cursor, 'location', ['ip_addr', 'city', 'country_code', 'latitude', 'longitude'], location_rows)
+  _insert_rows(cursor, 'vessels', ['node_id', 'vessel_name'], vessel_rows)
+  _insert_rows(cursor, 'vesselports', ['node_id', 'vessel_name', 'port'], port_rows)
+  db.commit()
+  return len(node_rows)
+
+
+if __name__ == '__main__':
+  if len(sys.argv) < 3:
+    print "Usage: python benchmark/benchmark_inventory.py <database name or SQLite file> <number of vessels> [seed]"
+    sys.exit(1)
+  use_database(sys.argv[1])
+  seed = 0
+  if len(sys.argv) > 3:
+    seed = int(sys.argv[3])
+  db, cursor = selexorhelper.connect_to_db()
+  try:
+    num_nodes = generate_inventory(db, cursor, int(sys.argv[2]), seed)
+  finally:
+    db.close()
+  print "Created", sys.argv[2], "vessels on", num_nodes, "nodes"
@@ -0,0 +1,197 @@
+"""
+<Program Name>
+  fake_clearinghouse.py
+
+<Purpose>
+  Stands in for the Seattle Clearinghouse in benchmarks.  It answers the
+  calls SeleXor makes, after a configurable delay, and refuses a
+  configurable fraction of the vessels it is asked for, the way the real
+  clearinghouse refuses vessels that are taken or offline.
+
+  All clients share one FakeClearinghouse, so vessels acquired through one
+  client can't be acquired through another until they are released.
+
+<Example Use>
+  clearinghouse = FakeClearinghouse(latency=0.2, rejection_rate=0.1)
+  clearinghouse.install()
+  ... run resolutions ...
+  print clearinghouse.get_call_counts()
+
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+
+# Run from the SeleXor directory: python benchmark/<script>.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import seattleclearinghouse_xmlrpc
+import selexorhelper
+
+
+class FakeClearinghouse:
+  def __init__(self, latency=0.0, rejection_rate=0.0, max_vessels=None, seed=None):
+    '''
+    <Purpose>
+      Creates a stand-in clearinghouse.
+    <Arguments>
+      latency:
+        The number of seconds each call takes.
+      rejection_rate:
+        The probability that a free vessel is not given out when asked for.
+      max_vessels:
+        The number of vessels each user may hold, or None for no limit.
+        Asking for more raises NotEnoughCreditsError.
+      seed:
+        Seeds the choice of the vessels that are refused.
+    <Exceptions>
+      None
+    <Side Effects>
+      None
+    <Returns>
+      A FakeClearinghouse instance.
+
+    '''
+    self.latency = latency
+    self.rejection_rate = rejection_rate
+    self.max_vessels = max_vessels
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    # vesselhandle: username
+    self._held_vessels = {}
+    # call name: number of calls
+    self._call_counts = {}
+
+
+  def install(self):
+    ''' Makes SeleXor connect to this clearinghouse instead of the real one. '''
+    selexorhelper.connect_to_clearinghouse = self.connect
+    # Sessions of the real clearinghouse must not be reused.
+    selexorhelper.clearinghouse_sessions = selexorhelper.ClearinghouseSessionPool()
+
+
+  def connect(self, authdata):
+    ''' Replacement for selexorhelper.connect_to_clearinghouse(). '''
+    return FakeClearinghouseClient(self, authdata.keys()[0])
+
+
+  def get_call_counts(self):
+    ''' Returns a dictionary mapping each call's name to its number of calls. '''
+    self._lock.acquire()
+    try:
+      return dict(self._call_counts)
+    finally:
+      self._lock.release()
+
+
+  def reset(self):
+    ''' Releases every vessel and clears the call counts. '''
+    self._lock.acquire()
+    try:
+      self._held_vessels.clear()
+      self._call_counts.clear()
+    finally:
+      self._lock.release()
+
+
+  def _count_call(self, name):
+    # The caller must hold self._lock.
+    self._call_counts[name] = self._call_counts.get(name, 0) + 1
+
+
+  def _get_user_vessels(self, username):
+    # The caller must hold self._lock.
+    return [vesselhandle for (vesselhandle, holder) in self._held_vessels.iteritems()
+      if holder == username]
+
+
+  def acquire_specific_vessels(self, username, vesselhandles):
+    time.sleep(self.latency)
+    self._lock.acquire()
+    try:
+      self._count_call('acquire_specific_vessels')
+      if (self.max_vessels is not None and
+          len(self._get_user_vessels(username)) + len(vesselhandles) > self.max_vessels):
+        raise seattleclearinghouse_xmlrpc.NotEnoughCreditsError(
+          "You do not have enough vessel credits to acquire " + str(len(vesselhandles)) + " vessels.")
+      acquired_vesseldicts = []
+      for vesselhandle in vesselhandles:
+        if vesselhandle in self._held_vessels or self._random.random() < self.rejection_rate:
+          continue
+        self._held_vessels[vesselhandle] = username
+        acquired_vesseldicts.append(_create_vesseldict(vesselhandle))
+      return acquired_vesseldicts
+    finally:
+      self._lock.release()
+
+
+  def release_resources(self, username, vesselhandles):
+    time.sleep(self.latency)
+    self._lock.acquire()
+    try:
+      self._count_call('release_resources')
+      for vesselhandle in vesselhandles:
+        if self._held_vessels.get(vesselhandle) == username:
+          del self._held_vessels[vesselhandle]
+    finally:
+      self._lock.release()
+
+
+  def get_resource_info(self, username):
+    time.sleep(self.latency)
+    self._lock.acquire()
+    try:
+      self._count_call('get_resource_info')
+      return [_create_vesseldict(vesselhandle) for vesselhandle in self._get_user_vessels(username)]
+    finally:
+      self._lock.release()
+
+
+  def get_account_info(self, username):
+    time.sleep(self.latency)
+    self._lock.acquire()
+    try:
+      self._count_call('get_account_info')
+    finally:
+      self._lock.release()
+    max_vessels = self.max_vessels
+    if max_vessels is None:
+      max_vessels = 1000000
+    return {'user_name': username, 'max_vessels': max_vessels, 'user_port': 63100}
+
+
+
+class FakeClearinghouseClient:
+  '''
+  A client of a FakeClearinghouse, with the same methods as the
+  SeattleClearinghouseClient calls that SeleXor makes.
+
+  '''
+  def __init__(self, clearinghouse, username):
+    self._clearinghouse = clearinghouse
+    self._username = username
+
+  def acquire_specific_vessels(self, vesselhandles):
+    return self._clearinghouse.acquire_specific_vessels(self._username, vesselhandles)
+
+  def release_resources(self, vesselhandles):
+    return self._clearinghouse.release_resources(self._username, vesselhandles)
+
+  def get_resource_info(self):
+    return self._clearinghouse.get_resource_info(self._username)
+
+  def get_account_info(self):
+    return self._clearinghouse.get_account_info(self._username)
+
+
+
+def _create_vesseldict(vesselhandle):
+  node_key, vesselname = vesselhandle.split(':')
+  return {
+    'handle': vesselhandle,
+    'node_id': node_key,
+    'vessel_id': vesselname,
+  }
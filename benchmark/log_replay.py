@@ -0,0 +1,452 @@
+"""
+<Program Name>
+  log_replay.py
+
+<Purpose>
+  Replays the requests recorded in selexorserver.log against a local
+  SeleXor web server, so that capacity can be planned with the mix of
+  requests that users actually send.
+
+  Every "Obtained request" line of the logs is sent to the web server as a
+  'request' action, as the web interface would, from the user that sent it.
+  Its status is then polled until it finishes, and the vessels it got are
+  released.  Requests are sent at the times they were logged, sped up by
+  --speed, over at most --concurrency connections at once.
+
+  The web server runs in this process, against a synthetic inventory (see
+  benchmark_inventory.py) and a stand-in clearinghouse (see
+  fake_clearinghouse.py).  The database named with --database is
+  overwritten, so it must be set aside for benchmarks.
+
+  The report contains how each request ended, the fraction of requests that
+  failed, and percentiles of:
+    The time until the request was accepted.
+    The time until the request finished.
+    How late the request was sent, which grows once the concurrency is too
+    low to keep up with the logged rate.
+
+<Usage>
+  From the SeleXor directory:
+    python benchmark/log_replay.py --database selexorbench selexorserver.log
+    python benchmark/log_replay.py --database selexorbench --vessels 100000 \\
+      --speed 10 --concurrency 32 --latency 0.2 selexorserver.log*
+
+"""
+
+import ast
+import datetime
+import httplib
+import optparse
+import os
+import Queue
+import re
+import sys
+import threading
+import time
+
+# Run from the SeleXor directory: python benchmark/<script>.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import benchmark_inventory
+import fake_clearinghouse
+import selexorhelper
+import selexorrequeststore
+import selexorserver
+import selexorweb
+import settings
+
+# selexorweb translates serialize.repy when it is imported.
+import serialize_repy
+
+
+# <date> <time>,<milliseconds> <identity>: Obtained request: <request>
+# The identity is (username, remote IP) in older logs, and
+# (username, remote IP, request ID) in newer ones.
+REQUEST_LINE_PATTERN = re.compile(
+  r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d+) (\(.*?\)): Obtained request: (.*)$")
+LOG_TIME_FORMAT = "%Y-%m-%d %H:%M:%S,%f"
+
+# How a replayed request can end, besides the final status of the request.
+# 'rejected': The server refused the request, e.g. because it was busy.
+# 'http_error': The request could not be sent, or its response could not
+#   be read.
+# 'server_error': The server failed while handling the request.
+# 'unfinished': The request did not finish within --timeout seconds, and
+#   was cancelled.
+# Requests that end in any of these, or with the 'error' status, count as
+# errors.
+ERROR_OUTCOMES = set(['rejected', 'http_error', 'server_error', 'unfinished', 'error'])
+
+REPLAY_APIKEY = 'replay'
+
+
+def load_requests(log_paths):
+  '''
+  <Purpose>
+    Extracts the requests recorded in SeleXor server logs.
+  <Arguments>
+    log_paths:
+      The paths of the logs to read.
+  <Exceptions>
+    IOError
+  <Side Effects>
+    None
+  <Returns>
+    A tuple (requests, number of request lines that could not be read).
+    requests is a list of (seconds since the first request, username,
+    request), in the order the requests were logged.
+
+  '''
+  logged_requests = []
+  num_skipped = 0
+  for log_path in log_paths:
+    logfile = open(log_path)
+    try:
+      for line in logfile:
+        match = REQUEST_LINE_PATTERN.match(line.rstrip('\r\n'))
+        if not match:
+          continue
+        log_time, identity, request = match.groups()
+        try:
+          log_time = datetime.datetime.strptime(log_time, LOG_TIME_FORMAT)
+          username = ast.literal_eval(identity)[0]
+          request = ast.literal_eval(request)
+        except (ValueError, SyntaxError, IndexError):
+          num_skipped += 1
+          continue
+        if not isinstance(request, dict):
+          num_skipped += 1
+          continue
+        logged_requests.append((log_time, username, request))
+    finally:
+      logfile.close()
+
+  # Rotated logs may be given in any order.
+  logged_requests.sort(key=lambda logged_request: logged_request[0])
+  requests = []
+  for log_time, username, request in logged_requests:
+    offset = (log_time - logged_requests[0][0]).total_seconds()
+    requests.append((offset, username, request))
+  return requests, num_skipped
+
+
+class ReplayConnection:
+  '''
+  A keep-alive connection to the web server, that sends actions and reads
+  their responses the way the web interface does.
+
+  '''
+  def __init__(self, host, port, timeout):
+    self._host = host
+    self._port = port
+    self._timeout = timeout
+    self._connection = None
+
+
+  def post(self, action, data):
+    '''
+    <Purpose>
+      Sends an action to the web server.
+    <Arguments>
+      action:
+        The name of the action, e.g. 'request'.
+      data:
+        The data to send with the action.
+    <Exceptions>
+      httplib.HTTPException, socket.error
+        The action could not be sent, or its response could not be read.
+      ValueError
+        The server answered the action with an error.
+    <Side Effects>
+      Reconnects if the connection was closed.
+    <Returns>
+      The 'data' of the response, and its 'version' if it has one.
+
+    '''
+    if self._connection is None:
+      self._connection = httplib.HTTPConnection(self._host, self._port, timeout=self._timeout)
+    try:
+      self._connection.request('POST', '/', serialize_repy.serialize_serializedata({action: data}))
+      response = self._connection.getresponse()
+      rawdata = response.read()
+    except:
+      # Start over with a new connection next time.
+      self.close()
+      raise
+    response = serialize_repy.serialize_deserializedata(rawdata)
+    if response.get('status') != 'ok':
+      raise ValueError(response.get('error', "The server did not answer the action."))
+    return response['data'], response.get('version')
+
+
+  def close(self):
+    if self._connection is not None:
+      self._connection.close()
+      self._connection = None
+
+
+
+def replay_request(connection, username, request, timeout):
+  '''
+  <Purpose>
+    Sends a request to the web server, waits for it to finish, and releases
+    the vessels it got.
+  <Arguments>
+    connection:
+      The ReplayConnection to send the request over.
+    username:
+      The user to send the request as.
+    request:
+      The request, as it was logged.
+    timeout:
+      The number of seconds to wait for the request to finish before
+      cancelling it.
+  <Exceptions>
+    None
+  <Side Effects>
+    Acquires and releases vessels from the stand-in clearinghouse.
+  <Returns>
+    A dictionary containing:
+      'outcome': The final status of the request, or one of the outcomes
+        described at ERROR_OUTCOMES.
+      'accept_seconds': The time until the request was accepted or
+        refused, or None if the server did not answer.
+      'seconds': The time until the request finished or the replay gave up.
+      'num_acquired', 'num_wanted': The number of vessels the request got,
+        and the number it asked for.
+
+  '''
+  userdata = {username: {'apikey': REPLAY_APIKEY}}
+  result = {'outcome': 'http_error', 'accept_seconds': None, 'num_acquired': 0, 'num_wanted': 0}
+  for groupdata in request.values():
+    try:
+      result['num_wanted'] += int(groupdata['allocate'])
+    except (KeyError, TypeError, ValueError):
+      pass
+
+  start_time = time.time()
+  try:
+    status, version = connection.post('request', {'userdata': userdata, 'groups': request})
+    result['accept_seconds'] = time.time() - start_time
+    request_id = status.get('request_id')
+    if request_id is None:
+      result['outcome'] = 'rejected'
+    else:
+      # Long poll, as the web interface does.
+      while (status['status'] in selexorrequeststore.ACTIVE_STATUSES and
+          time.time() - start_time < timeout):
+        status, version = connection.post('query',
+          {'userdata': userdata, 'request_id': request_id, 'version': version})
+      result['outcome'] = status['status']
+  except ValueError:
+    result['outcome'] = 'server_error'
+    result['seconds'] = time.time() - start_time
+    return result
+  except Exception:
+    result['seconds'] = time.time() - start_time
+    return result
+  result['seconds'] = time.time() - start_time
+
+  if request_id is None:
+    return result
+  try:
+    if result['outcome'] in selexorrequeststore.ACTIVE_STATUSES:
+      result['outcome'] = 'unfinished'
+      connection.post('cancel', {'userdata': userdata, 'request_id': request_id, 'release': True})
+      return result
+
+    # The last status may only contain what changed, so ask for all of it.
+    status, version = connection.post('query', {'userdata': userdata, 'request_id': request_id})
+    handles = []
+    for group in status['groups'].values():
+      for vessel in group['vessels_acquired']:
+        handles.append({'handle': vessel['handle']})
+    result['num_acquired'] = len(handles)
+    if handles:
+      connection.post('release', {'userdata': userdata, 'vessels': handles, 'request_id': request_id})
+  except Exception:
+    # The request itself was served; only the cleanup failed.
+    pass
+  return result
+
+
+def replay(requests, host, port, concurrency, speed, timeout):
+  '''
+  <Purpose>
+    Replays requests against a web server.
+  <Arguments>
+    requests:
+      The requests, as returned by load_requests().
+    host, port:
+      The address of the web server.
+    concurrency:
+      The number of requests to replay at the same time.
+    speed:
+      How many times faster than logged to send the requests.  If 0, they
+      are sent as fast as the concurrency allows.
+    timeout:
+      The number of seconds to wait for each request to finish.
+  <Exceptions>
+    None
+  <Side Effects>
+    Sends the requests.
+  <Returns>
+    A list with a result for each request, as returned by
+    replay_request(), that also contains the number of seconds the request
+    was sent late as 'lag_seconds'.
+
+  '''
+  pending_requests = Queue.Queue()
+  for logged_request in requests:
+    pending_requests.put(logged_request)
+  results = []
+  results_lock = threading.Lock()
+  start_time = time.time()
+
+  def replay_worker():
+    connection = ReplayConnection(host, port, timeout + settings.status_long_poll_timeout)
+    try:
+      while True:
+        try:
+          offset, username, request = pending_requests.get_nowait()
+        except Queue.Empty:
+          return
+        send_time = start_time
+        if speed:
+          send_time += offset / speed
+        if send_time > time.time():
+          time.sleep(send_time - time.time())
+        lag_seconds = time.time() - send_time
+        result = replay_request(connection, username, request, timeout)
+        result['lag_seconds'] = lag_seconds
+        results_lock.acquire()
+        try:
+          results.append(result)
+        finally:
+          results_lock.release()
+    finally:
+      connection.close()
+
+  threads = []
+  for thread_no in range(concurrency):
+    thread = threading.Thread(target=replay_worker)
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+  for thread in threads:
+    thread.join()
+  return results
+
+
+def _get_percentile(sorted_values, percentile):
+  # Nearest rank
+  rank = max(1, int(round(percentile / 100.0 * len(sorted_values))))
+  return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def print_report(results, elapsed_seconds):
+  ''' Prints how the replayed requests ended and how long they took. '''
+  if not results:
+    print "No requests were replayed."
+    return
+
+  outcomes = {}
+  num_errors = 0
+  num_acquired = 0
+  num_wanted = 0
+  for result in results:
+    outcomes[result['outcome']] = outcomes.get(result['outcome'], 0) + 1
+    if result['outcome'] in ERROR_OUTCOMES:
+      num_errors += 1
+    num_acquired += result['num_acquired']
+    num_wanted += result['num_wanted']
+
+  print "Replayed", len(results), "requests in %.1f seconds (%.2f requests/second)" % (
+    elapsed_seconds, len(results) / max(elapsed_seconds, 1e-9))
+  print
+  print "%-12s %8s %8s" % ('outcome', 'count', 'percent')
+  for outcome in sorted(outcomes):
+    print "%-12s %8d %7.1f%%" % (outcome, outcomes[outcome], 100.0 * outcomes[outcome] / len(results))
+  print "Error rate: %.1f%%" % (100.0 * num_errors / len(results))
+  print "Vessels acquired:", num_acquired, "of", num_wanted, "requested"
+  print
+
+  print "%-12s %8s %10s %10s %10s %10s" % ('seconds', 'count', 'p50', 'p90', 'p99', 'max')
+  for name, key in (('accepted', 'accept_seconds'), ('finished', 'seconds'), ('sent late', 'lag_seconds')):
+    durations = sorted([result[key] for result in results if result[key] is not None])
+    if not durations:
+      continue
+    print "%-12s %8d %10.3f %10.3f %10.3f %10.3f" % (name, len(durations),
+      _get_percentile(durations, 50), _get_percentile(durations, 90),
+      _get_percentile(durations, 99), durations[-1])
+
+
+def main():
+  parser = optparse.OptionParser(usage="%prog --database <database> [options] <log file> ...",
+    description="Replays the requests in SeleXor server logs against a local web server.")
+  parser.add_option('--database', help="the database to fill with the synthetic inventory")
+  parser.add_option('--vessels', type='int', default=10000,
+    help="number of vessels in the synthetic inventory; 0 uses the database as it is")
+  parser.add_option('--concurrency', type='int', default=8,
+    help="number of requests to replay at the same time")
+  parser.add_option('--speed', type='float', default=1.0,
+    help="how many times faster than logged to send requests; 0 sends them as fast as possible")
+  parser.add_option('--limit', type='int', default=None, help="replay only the first LIMIT requests")
+  parser.add_option('--latency', type='float', default=0.0,
+    help="seconds each clearinghouse call takes")
+  parser.add_option('--rejection-rate', type='float', default=0.0,
+    help="fraction of vessels the clearinghouse refuses")
+  parser.add_option('--max-vessels', type='int', default=None,
+    help="number of vessels each user may hold at the clearinghouse")
+  parser.add_option('--timeout', type='float', default=600,
+    help="seconds to wait for each request before cancelling it")
+  parser.add_option('--port', type='int', default=0,
+    help="port for the web server to listen on; 0 picks a free one")
+  parser.add_option('--seed', type='int', default=0, help="seeds the inventory and the clearinghouse")
+  options, log_paths = parser.parse_args()
+  if not options.database:
+    parser.error("--database is required, and its contents are replaced")
+  if not log_paths:
+    parser.error("no log files given")
+
+  requests, num_skipped = load_requests(log_paths)
+  if options.limit is not None:
+    requests = requests[:options.limit]
+  print "Read", len(requests), "requests;", num_skipped, "request lines could not be read"
+  if not requests:
+    return
+
+  benchmark_inventory.use_database(options.database)
+  settings.enable_https = False
+  settings.persist_request_state = False
+  if options.vessels:
+    db, cursor = selexorhelper.connect_to_db()
+    try:
+      benchmark_inventory.generate_inventory(db, cursor, options.vessels, options.seed)
+    finally:
+      db.close()
+
+  clearinghouse = fake_clearinghouse.FakeClearinghouse(latency=options.latency,
+    rejection_rate=options.rejection_rate, max_vessels=options.max_vessels, seed=options.seed)
+  clearinghouse.install()
+
+  selexorweb.logger = selexorhelper.setup_logging("selexorweb")
+  selexorweb.selexor_server = selexorserver.SelexorServer()
+  http_server = selexorweb.SelexorHTTPServer(('127.0.0.1', options.port), selexorweb.SelexorHandler)
+  http_thread = threading.Thread(target=http_server.serve_forever)
+  http_thread.daemon = True
+  http_thread.start()
+
+  start_time = time.time()
+  try:
+    results = replay(requests, '127.0.0.1', http_server.server_address[1],
+      options.concurrency, options.speed, options.timeout)
+  finally:
+    http_server.shutdown()
+    selexorweb.selexor_server.shutdown()
+  print_report(results, time.time() - start_time)
+  print "Clearinghouse calls:", clearinghouse.get_call_counts()
+
+
+if __name__ == '__main__':
+  main()
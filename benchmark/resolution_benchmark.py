@@ -0,0 +1,180 @@
+"""
+<Program Name>
+  resolution_benchmark.py
+
+<Purpose>
+  Measures how long SeleXor takes to resolve a few typical requests,
+  against a synthetic inventory and a stand-in clearinghouse, so that
+  changes to resolution or to the rule parsers can be compared.
+
+  For each inventory size, the database is filled with that many vessels
+  (see benchmark_inventory.py), and every scenario in SCENARIOS is resolved
+  by a fresh SelexorServer.  Each resolution reports:
+    The time from when the request was sent until it finished.
+    The number of database statements it ran, taken from its trace.
+    The number of clearinghouse calls it made.
+    How many of the requested vessels it got.
+
+  The database named with --database is overwritten, so it must be set
+  aside for benchmarks.
+
+<Usage>
+  From the SeleXor directory:
+    python benchmark/resolution_benchmark.py --database selexorbench
+    python benchmark/resolution_benchmark.py --database selexorbench \\
+      --sizes 1000,10000 --latency 0.2 --rejection-rate 0.1
+
+"""
+
+import copy
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+# Run from the SeleXor directory: python benchmark/<script>.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import benchmark_inventory
+import fake_clearinghouse
+import selexorhelper
+import selexorrequeststore
+import selexorserver
+import selexortrace
+import settings
+
+
+# scenario name: request, as passed to SelexorServer.handle_request()
+SCENARIOS = {
+  'single_country': {
+    'g0': {'allocate': 10, 'rules': {
+      'location_specific': {'city': '?', 'country': 'United States of America'},
+    }},
+  },
+  'different_countries': {
+    'g0': {'allocate': 20, 'rules': {
+      'location_different': {'location_count': '20', 'location_type': 'country_code'},
+    }},
+  },
+  'separation_radius': {
+    'g0': {'allocate': 10, 'rules': {
+      'location_separation_radius': {'min_radius': '100', 'max_radius': '3000'},
+    }},
+  },
+}
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+BENCHMARK_USER = {'benchmark': {'apikey': 'benchmark'}}
+BENCHMARK_IP = '127.0.0.1'
+
+
+def run_scenario(selexor_server, request, timeout):
+  '''
+  <Purpose>
+    Sends a request to a SelexorServer and waits for it to finish.
+  <Arguments>
+    selexor_server:
+      The SelexorServer to send the request to.
+    request:
+      The request, as passed to SelexorServer.handle_request().
+    timeout:
+      The number of seconds to wait for the request to finish.
+  <Exceptions>
+    None
+  <Side Effects>
+    Resolves the request.
+  <Returns>
+    A tuple (seconds taken, final status response, request_id).
+
+  '''
+  start_time = time.time()
+  status = selexor_server.handle_request(BENCHMARK_USER, request, BENCHMARK_IP)
+  request_id = status.get('request_id')
+  version = None
+  while (status['status'] in selexorrequeststore.ACTIVE_STATUSES and
+      time.time() - start_time < timeout):
+    version = selexor_server.wait_for_request_change(
+      BENCHMARK_USER, BENCHMARK_IP, version, 1, request_id)
+    status = selexor_server.get_request_status(BENCHMARK_USER, BENCHMARK_IP, request_id=request_id)
+  return (time.time() - start_time, status, request_id)
+
+
+def count_spans(trace_file, request_id, prefix):
+  ''' Returns the number of spans of the given request whose name starts with prefix. '''
+  return len([record for record in selexortrace.load_spans(trace_file, request_id)
+    if record['name'].startswith(prefix)])
+
+
+def main():
+  parser = optparse.OptionParser(description="Benchmarks request resolution.")
+  parser.add_option('--database', help="the database to fill with the synthetic inventory")
+  parser.add_option('--sizes', default=','.join([str(size) for size in DEFAULT_SIZES]),
+    help="comma-separated numbers of vessels to benchmark with")
+  parser.add_option('--scenarios', default=','.join(sorted(SCENARIOS)),
+    help="comma-separated scenarios to run")
+  parser.add_option('--latency', type='float', default=0.0,
+    help="seconds each clearinghouse call takes")
+  parser.add_option('--rejection-rate', type='float', default=0.0,
+    help="fraction of vessels the clearinghouse refuses")
+  parser.add_option('--repeat', type='int', default=3,
+    help="number of times to run each scenario; the median is reported")
+  parser.add_option('--timeout', type='float', default=600,
+    help="seconds to wait for each request")
+  parser.add_option('--seed', type='int', default=0, help="seeds the inventory")
+  options, args = parser.parse_args()
+  if not options.database:
+    parser.error("--database is required, and its contents are replaced")
+
+  benchmark_inventory.use_database(options.database)
+  settings.persist_request_state = False
+  settings.trace_enabled = True
+  trace_file_handle, settings.trace_file = tempfile.mkstemp(suffix='.jsonl')
+  os.close(trace_file_handle)
+
+  clearinghouse = fake_clearinghouse.FakeClearinghouse(
+    latency=options.latency, rejection_rate=options.rejection_rate, seed=options.seed)
+  clearinghouse.install()
+
+  print "%10s %-22s %-10s %9s %10s %10s %10s" % (
+    'vessels', 'scenario', 'status', 'acquired', 'seconds', 'db', 'ch calls')
+  try:
+    for size in [int(size) for size in options.sizes.split(',')]:
+      db, cursor = selexorhelper.connect_to_db()
+      try:
+        benchmark_inventory.generate_inventory(db, cursor, size, options.seed)
+      finally:
+        db.close()
+
+      for scenario in options.scenarios.split(','):
+        results = []
+        for run_no in range(options.repeat):
+          clearinghouse.reset()
+          # A fresh server, so that no caches or leases carry over.
+          selexor_server = selexorserver.SelexorServer()
+          try:
+            # Rules are preprocessed in place, so each run gets its own copy.
+            seconds, status, request_id = run_scenario(
+              selexor_server, copy.deepcopy(SCENARIOS[scenario]), options.timeout)
+          finally:
+            selexor_server.shutdown()
+          num_acquired = 0
+          num_wanted = 0
+          for group in status['groups'].itervalues():
+            num_acquired += len(group['vessels_acquired'])
+            num_wanted += group['target_num_vessels']
+          results.append((seconds, status['status'], num_acquired, num_wanted,
+            count_spans(settings.trace_file, request_id, 'db.'),
+            sum(clearinghouse.get_call_counts().values())))
+
+        results.sort()
+        seconds, status, num_acquired, num_wanted, num_queries, num_calls = results[len(results) / 2]
+        print "%10d %-22s %-10s %9s %10.3f %10d %10d" % (size, scenario, status,
+          str(num_acquired) + '/' + str(num_wanted), seconds, num_queries, num_calls)
+  finally:
+    os.remove(settings.trace_file)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,287 @@
+"""
+<Program Name>
+  rule_benchmark.py
+
+<Purpose>
+  Times every registered vessel and group rule, along with
+  apply_vessel_rules(), apply_group_rules(), GroupRuleState and both
+  versions of get_worst_vessel(), for a range of inventory sizes and
+  numbers of acquired vessels.
+
+  Each measurement is the median of --repeat runs.  Results can be saved
+  as a baseline, and later runs are compared against it, so that a rule
+  that got slower shows up as a number:
+    python benchmark/rule_benchmark.py --database selexorbench --save-baseline
+    ... change a rule ...
+    python benchmark/rule_benchmark.py --database selexorbench
+  Measurements that take more than --tolerance longer than their baseline
+  are marked as regressions, and the exit status is 1 if there are any.
+
+  The baseline is specific to the machine and database server it was
+  measured on, so it is not checked in.  The database named with
+  --database is overwritten, so it must be set aside for benchmarks.
+
+"""
+
+import copy
+import json
+import optparse
+import os
+import random
+import sys
+import time
+
+# Run from the SeleXor directory: python benchmark/<script>.py
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import benchmark_inventory
+import selexorhelper
+import selexorruleparser
+import settings
+
+
+# rule name: unprocessed parameters to benchmark the rule with.  Registered
+# rules that are not listed here are reported as skipped.
+SAMPLE_PARAMETERS = {
+  'location_specific': {'city': '?', 'country': 'Germany'},
+  'location_separation_radius': {'min_radius': '100', 'max_radius': '3000'},
+  'location_different': {'location_count': '10', 'location_type': 'country_code'},
+  'num_ip_change': {'min_change': '0', 'max_change': '5'},
+  'node_type': {'node_type': 'university'},
+  'port': {'port': '63100'},
+}
+
+# The rules that are applied together, as in a typical request.
+VESSEL_RULES = ['location_specific', 'node_type', 'port']
+GROUP_RULES = ['location_different', 'location_separation_radius']
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_ACQUIRED_SIZES = [0, 10, 50]
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rule_benchmark_baseline.json')
+
+# Differences smaller than this many seconds are noise.
+MIN_REGRESSION_SECONDS = 0.001
+
+
+def _get_rules(rule_names):
+  rules = {}
+  for rule_name in rule_names:
+    rules[rule_name] = copy.deepcopy(SAMPLE_PARAMETERS[rule_name])
+  return selexorruleparser.preprocess_rules(rules)
+
+
+def _time(function, repeat):
+  # Returns the median duration of repeat calls.
+  durations = []
+  for run_no in range(repeat):
+    start_time = time.time()
+    function()
+    durations.append(time.time() - start_time)
+  durations.sort()
+  return durations[len(durations) / 2]
+
+
+def _get_vessels(cursor):
+  selexorhelper.autoretry_mysql_command(cursor,
+    "SELECT node_id, vessel_name, node_key FROM vessels JOIN nodes USING (node_id)")
+  vesselset = set()
+  vesseldicts = []
+  for node_id, vesselname, node_key in cursor.fetchall():
+    vesselset.add((node_id, vesselname))
+    vesseldicts.append({
+      'node_id': node_id,
+      'vessel_name': vesselname,
+      'node_key': node_key,
+      'handle': node_key + ':' + vesselname,
+    })
+  return vesselset, vesseldicts
+
+
+def benchmark_inventory_size(cursor, num_vessels, acquired_sizes, repeat, seed):
+  '''
+  <Purpose>
+    Times the rule engine against the inventory that is in the database.
+  <Arguments>
+    cursor:
+      A cursor to the benchmark database.
+    num_vessels:
+      The number of vessels in the inventory, used to name the results.
+    acquired_sizes:
+      The numbers of acquired vessels to time the group rules with.
+    repeat:
+      The number of times to run each measurement.
+    seed:
+      Seeds the choice of acquired vessels.
+  <Exceptions>
+    None
+  <Side Effects>
+    Updates the rule statistics kept by selexorruleparser.
+  <Returns>
+    A dictionary mapping each measurement's name to its median duration in
+    seconds, or to an error message if it could not be run.  Names are in
+    the form <what was timed>/<number of vessels>/<number acquired>.
+
+  '''
+  vesselset, vesseldicts = _get_vessels(cursor)
+  rng = random.Random(seed)
+  results = {}
+
+  def measure(name, num_acquired, function):
+    key = name + '/' + str(num_vessels) + '/' + str(num_acquired)
+    try:
+      results[key] = _time(function, repeat)
+    except Exception, e:
+      results[key] = "error: " + repr(e)
+
+  # Parameters are preprocessed up front, so that only the rules are timed.
+  vessel_rules = _get_rules(VESSEL_RULES)
+  group_rules = _get_rules(GROUP_RULES)
+  rule_params = {}
+  for rule_name in SAMPLE_PARAMETERS:
+    try:
+      rule_params[rule_name] = _get_rules([rule_name])[rule_name]
+    except Exception, e:
+      rule_params[rule_name] = e
+
+  for rule_type in ('vessel', 'group'):
+    for rule_name in sorted(selexorruleparser.rule_callbacks[rule_type]):
+      callback = selexorruleparser.rule_callbacks[rule_type][rule_name]
+      for num_acquired in (rule_type == 'vessel' and [0] or acquired_sizes):
+        name = rule_type + '_rule.' + rule_name
+        key = name + '/' + str(num_vessels) + '/' + str(num_acquired)
+        if rule_name not in SAMPLE_PARAMETERS:
+          results[key] = "skipped: no sample parameters"
+        elif isinstance(rule_params[rule_name], Exception):
+          results[key] = "error: " + repr(rule_params[rule_name])
+        elif rule_type == 'vessel':
+          measure(name, num_acquired, lambda: callback(
+            cursor, False, rule_params[rule_name], vesselset))
+        else:
+          acquired_vessels = rng.sample(vesseldicts, min(num_acquired, len(vesseldicts)))
+          measure(name, num_acquired, lambda: callback(
+            cursor, False, rule_params[rule_name], acquired_vessels, vesselset))
+
+  measure('apply_vessel_rules', 0,
+    lambda: selexorruleparser.apply_vessel_rules(vessel_rules, cursor, vesselset))
+
+  for num_acquired in acquired_sizes:
+    acquired_vessels = rng.sample(vesseldicts, min(num_acquired, len(vesseldicts)))
+    measure('apply_group_rules', num_acquired,
+      lambda: selexorruleparser.apply_group_rules(group_rules, cursor, vesselset, acquired_vessels))
+    measure('GroupRuleState', num_acquired,
+      lambda: selexorruleparser.GroupRuleState(group_rules, cursor, vesselset, acquired_vessels))
+
+    if not acquired_vessels:
+      continue
+    measure('get_worst_vessel', num_acquired,
+      lambda: selexorruleparser.get_worst_vessel(acquired_vessels, vesselset, cursor, group_rules))
+    group_state = selexorruleparser.GroupRuleState(group_rules, cursor, vesselset, acquired_vessels)
+    measure('GroupRuleState.get_worst_vessel', num_acquired,
+      lambda: group_state.get_worst_vessel(acquired_vessels))
+
+  return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+  '''
+  <Purpose>
+    Compares results to a baseline.
+  <Arguments>
+    results, baseline:
+      Dictionaries as returned by benchmark_inventory_size().
+    tolerance:
+      The fraction by which a measurement may exceed its baseline before it
+      is a regression.
+  <Exceptions>
+    None
+  <Side Effects>
+    None
+  <Returns>
+    A list of (name, seconds, baseline seconds or None, is regression), in
+    order of name.
+
+  '''
+  comparison = []
+  for name in sorted(results):
+    seconds = results[name]
+    baseline_seconds = baseline.get(name)
+    if not isinstance(seconds, float) or not isinstance(baseline_seconds, float):
+      comparison.append((name, seconds, baseline_seconds, False))
+      continue
+    is_regression = (seconds > baseline_seconds * (1 + tolerance) and
+      seconds - baseline_seconds > MIN_REGRESSION_SECONDS)
+    comparison.append((name, seconds, baseline_seconds, is_regression))
+  return comparison
+
+
+def main():
+  parser = optparse.OptionParser(description="Benchmarks the rule engine.")
+  parser.add_option('--database', help="the database to fill with the synthetic inventory")
+  parser.add_option('--sizes', default=','.join([str(size) for size in DEFAULT_SIZES]),
+    help="comma-separated numbers of vessels to benchmark with")
+  parser.add_option('--acquired', default=','.join([str(size) for size in DEFAULT_ACQUIRED_SIZES]),
+    help="comma-separated numbers of acquired vessels to benchmark group rules with")
+  parser.add_option('--repeat', type='int', default=5,
+    help="number of times to run each measurement; the median is reported")
+  parser.add_option('--baseline', default=DEFAULT_BASELINE, help="the baseline file")
+  parser.add_option('--save-baseline', action='store_true', default=False,
+    help="save the results as the new baseline")
+  parser.add_option('--tolerance', type='float', default=0.25,
+    help="fraction by which a measurement may exceed its baseline")
+  parser.add_option('--seed', type='int', default=0, help="seeds the inventory")
+  options, args = parser.parse_args()
+  if not options.database:
+    parser.error("--database is required, and its contents are replaced")
+  benchmark_inventory.use_database(options.database)
+
+  results = {}
+  db, cursor = selexorhelper.connect_to_db()
+  try:
+    for size in [int(size) for size in options.sizes.split(',')]:
+      benchmark_inventory.generate_inventory(db, cursor, size, options.seed)
+      results.update(benchmark_inventory_size(cursor, size,
+        [int(size) for size in options.acquired.split(',')], options.repeat, options.seed))
+  finally:
+    db.close()
+
+  baseline = {}
+  if os.path.exists(options.baseline):
+    baseline_file = open(options.baseline)
+    try:
+      baseline = json.load(baseline_file)
+    finally:
+      baseline_file.close()
+
+  num_regressions = 0
+  print "%-55s %12s %12s %8s" % ('measurement', 'seconds', 'baseline', 'change')
+  for name, seconds, baseline_seconds, is_regression in compare_to_baseline(results, baseline, options.tolerance):
+    if not isinstance(seconds, float):
+      print "%-55s %s" % (name, seconds)
+      continue
+    if isinstance(baseline_seconds, float):
+      change = "%+7.0f%%" % ((seconds / max(baseline_seconds, 1e-9) - 1) * 100)
+      baseline_text = "%12.5f" % baseline_seconds
+    else:
+      change = ''
+      baseline_text = "%12s" % '-'
+    print "%-55s %12.5f %s %8s%s" % (name, seconds, baseline_text, change,
+      is_regression and '  REGRESSION' or '')
+    if is_regression:
+      num_regressions += 1
+
+  if options.save_baseline:
+    baseline_file = open(options.baseline, 'w')
+    try:
+      json.dump(results, baseline_file, indent=2, sort_keys=True)
+    finally:
+      baseline_file.close()
+    print "Saved the baseline to", options.baseline
+
+  if num_regressions:
+    print num_regressions, "measurement(s) regressed"
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -59,3 +59,24 @@ CREATE TABLE `vesselports` (
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 
 
+
+
+CREATE TABLE `vessel_leases` (
+  `node_id` int(11) NOT NULL,
+  `vessel_name` varchar(5) NOT NULL,
+  `owner` varchar(64) NOT NULL,
+  `expires` datetime NOT NULL,
+  PRIMARY KEY (`node_id`,`vessel_name`),
+  KEY `expires_idx` (`expires`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+
+
+
+CREATE TABLE `request_states` (
+  `request_key` varchar(255) NOT NULL,
+  `state` mediumblob NOT NULL,
+  `expires` datetime NOT NULL,
+  PRIMARY KEY (`request_key`),
+  KEY `expires_idx` (`expires`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
@@ -0,0 +1,82 @@
+
+-- The SeleXor tables for the embedded SQLite backend.  These match
+-- database_create.sql.  Text columns that users search by compare without
+-- regard to case, as they do under MySQL's default collation.  Date columns
+-- are declared as timestamps, so that they are read back as datetimes.
+
+CREATE TABLE IF NOT EXISTS location (
+  ip_addr varchar(15) NOT NULL PRIMARY KEY,
+  city varchar(100) NOT NULL COLLATE NOCASE,
+  country_code char(2) NOT NULL COLLATE NOCASE,
+  latitude double DEFAULT NULL,
+  longitude int(11) DEFAULT NULL
+);
+
+
+
+
+CREATE TABLE IF NOT EXISTS nodes (
+  node_id INTEGER PRIMARY KEY AUTOINCREMENT,
+  node_key text NOT NULL,
+  node_port int(11) NOT NULL,
+  node_type varchar(15) NOT NULL DEFAULT 'unknown',
+  ip_addr varchar(15) NOT NULL,
+  last_ip_change timestamp NOT NULL,
+  last_seen timestamp NOT NULL
+);
+
+
+CREATE TABLE IF NOT EXISTS vessels (
+  node_id int(11) NOT NULL REFERENCES nodes (node_id),
+  vessel_name varchar(5) NOT NULL,
+  acquirable boolean DEFAULT TRUE,
+  PRIMARY KEY (node_id, vessel_name)
+);
+
+
+
+
+
+CREATE TABLE IF NOT EXISTS userkeys (
+  node_id int(11) NOT NULL PRIMARY KEY,
+  vessel_name varchar(10) NOT NULL,
+  userkey text NOT NULL,
+  FOREIGN KEY (node_id, vessel_name) REFERENCES vessels (node_id, vessel_name) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS vessel_idx ON userkeys (node_id, vessel_name);
+
+
+
+
+CREATE TABLE IF NOT EXISTS vesselports (
+  node_id int(11) NOT NULL,
+  vessel_name varchar(45) NOT NULL,
+  port varchar(45) NOT NULL,
+  PRIMARY KEY (node_id, vessel_name, port),
+  FOREIGN KEY (node_id, vessel_name) REFERENCES vessels (node_id, vessel_name)
+);
+
+
+
+
+CREATE TABLE IF NOT EXISTS vessel_leases (
+  node_id int(11) NOT NULL,
+  vessel_name varchar(5) NOT NULL,
+  owner varchar(64) NOT NULL,
+  expires timestamp NOT NULL,
+  PRIMARY KEY (node_id, vessel_name)
+);
+
+CREATE INDEX IF NOT EXISTS expires_idx ON vessel_leases (expires);
+
+
+
+
+CREATE TABLE IF NOT EXISTS request_states (
+  request_key varchar(255) NOT NULL PRIMARY KEY,
+  state blob NOT NULL,
+  expires timestamp NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS request_states_expires_idx ON request_states (expires);
@@ -48,6 +48,7 @@
   MySQL server
   MySQL client
   MySQL mod python
+  (None of these are needed when settings.db_backend is 'sqlite'.)
 """
 
 import selexorhelper
@@ -62,7 +63,6 @@ import sys
 import threading
 import time
 import traceback
-import MySQLdb
 
 
 
@@ -123,7 +123,7 @@ def create_database():
   Creates any missing tables.
   """
   db, cursor = selexorhelper.connect_to_db()
-  code = open('database_create.sql', 'r').read()
+  code = open(selexorhelper.get_database_schema_file(), 'r').read()
   for line in code.split(';'):
     if line.strip():
       cursor.execute(line.strip())
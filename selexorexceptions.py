@@ -33,6 +33,12 @@ class SelexorInvalidRequest(SelexorException):
 class SelexorInternalError(SelexorException):
   """ An internal error in SeleXor occurred. """
 
+class SelexorClearinghouseTimeout(SelexorException):
+  """ The clearinghouse did not respond in time. """
+
+class SelexorServerBusy(SelexorException):
+  """ SeleXor has too many requests waiting to accept another one. """
+
 
 
 class RuleException(Exception):
@@ -17,10 +17,21 @@ import math
 import selexorexceptions
 import os
 import seattleclearinghouse_xmlrpc
-import MySQLdb
 import logging
 import settings
 import socket
+import sys
+import threading
+import time
+import Queue
+import selexortrace
+import selexorsqlite
+
+try:
+  import MySQLdb
+except ImportError:
+  # Only needed when settings.db_backend is 'mysql'.
+  MySQLdb = None
 
 helpercontext = {}
 
@@ -252,6 +263,200 @@ def connect_to_clearinghouse(authdata):
   return client
 
 
+
+# Clearinghouse calls that do not change anything, and so can be sent a
+# second time if the first attempt is slow to respond.
+HEDGEABLE_CLEARINGHOUSE_CALLS = set([
+  'get_account_info',
+  'get_resource_info',
+  'get_public_key',
+])
+
+
+class ClearinghouseSessionPool:
+  '''
+  <Purpose>
+    Keeps clearinghouse clients around so that they can be reused by later
+    actions of the same user.  A client keeps its HTTP connection to the
+    clearinghouse open between calls, so reusing it saves a connection and
+    TLS handshake per action.
+
+    Clients cannot be used by more than one thread at a time, so each client
+    is checked out by one caller until it is checked back in.  Clients that
+    stay idle for settings.clearinghouse_session_idle_timeout seconds are
+    dropped.
+  <Example Use>
+    session = clearinghouse_sessions.checkout(authdata)
+    try:
+      session.get_account_info()
+    finally:
+      clearinghouse_sessions.checkin(session)
+
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    # session key: [(time checked in, ClearinghouseSession)]
+    self._idle_sessions = {}
+
+
+  def _get_session_key(self, authdata):
+    username = authdata.keys()[0]
+    return (username, str(sorted(authdata[username].items())))
+
+
+  def _drop_expired_sessions(self, now):
+    # The caller must hold self._lock.
+    for session_key, idle_sessions in self._idle_sessions.items():
+      idle_sessions[:] = [(checkin_time, session) for (checkin_time, session) in idle_sessions
+        if now - checkin_time < settings.clearinghouse_session_idle_timeout]
+      if not idle_sessions:
+        del self._idle_sessions[session_key]
+
+
+  def checkout(self, authdata):
+    """
+    <Purpose>
+      Returns a session for the given user, reusing an idle one if possible.
+    <Arguments>
+      authdata:
+        An authdict. See module documentation for more information.
+    <Exceptions>
+      SelexorAuthenticationFailed
+    <Side Effects>
+      Creates a new clearinghouse client if there is no idle session.
+    <Returns>
+      A ClearinghouseSession.  It must be returned with checkin() once the
+      caller is done with it.
+    """
+    session_key = self._get_session_key(authdata)
+    self._lock.acquire()
+    try:
+      self._drop_expired_sessions(time.time())
+      idle_sessions = self._idle_sessions.get(session_key)
+      if idle_sessions:
+        return idle_sessions.pop()[1]
+    finally:
+      self._lock.release()
+    return ClearinghouseSession(self, authdata, connect_to_clearinghouse(authdata))
+
+
+  def checkin(self, session):
+    ''' Makes the given session available for reuse by the same user. '''
+    session_key = self._get_session_key(session.authdata)
+    self._lock.acquire()
+    try:
+      idle_sessions = self._idle_sessions.setdefault(session_key, [])
+      if len(idle_sessions) < settings.max_idle_clearinghouse_sessions_per_user:
+        idle_sessions.append((time.time(), session))
+    finally:
+      self._lock.release()
+
+
+
+class ClearinghouseSession:
+  '''
+  <Purpose>
+    Wraps a SeattleClearinghouseClient.  Calls in
+    HEDGEABLE_CLEARINGHOUSE_CALLS that have not returned after
+    settings.clearinghouse_hedge_delay seconds are sent once more on a new
+    connection, and the first response is used.  These calls time out after
+    settings.clearinghouse_call_timeout seconds.
+
+    Other calls change what the user holds, and may still succeed after a
+    timeout, so they are waited on for as long as they take.
+
+    Every other attribute is passed through to the client, so this can be
+    used anywhere a SeattleClearinghouseClient is expected.
+
+  '''
+  def __init__(self, pool, authdata, client):
+    self.authdata = authdata
+    self._pool = pool
+    self._client = client
+
+
+  def __getattr__(self, name):
+    attribute = getattr(self._client, name)
+    if not callable(attribute):
+      return attribute
+    def call(*args, **kwargs):
+      return self._call(name, args, kwargs)
+    return call
+
+
+  def _start_attempt(self, client, name, args, kwargs, results):
+    def attempt():
+      try:
+        results.put((True, getattr(client, name)(*args, **kwargs)))
+      except Exception:
+        results.put((False, sys.exc_info()))
+    thread = threading.Thread(target=attempt)
+    # Don't keep the process alive for a call that never returns.
+    thread.daemon = True
+    thread.start()
+
+
+  def _call(self, name, args, kwargs):
+    with selexortrace.span('clearinghouse.' + name) as call_span:
+      if args and isinstance(args[0], list):
+        call_span.set(num_requested=len(args[0]))
+      if name in HEDGEABLE_CLEARINGHOUSE_CALLS:
+        result = self._call_with_timeout(name, args, kwargs)
+      else:
+        result = getattr(self._client, name)(*args, **kwargs)
+      if isinstance(result, list):
+        call_span.set(num_results=len(result))
+      return result
+
+
+  def _call_with_timeout(self, name, args, kwargs):
+    # Only for calls in HEDGEABLE_CLEARINGHOUSE_CALLS.
+    results = Queue.Queue()
+    self._start_attempt(self._client, name, args, kwargs, results)
+    num_attempts = 1
+    deadline = time.time() + settings.clearinghouse_call_timeout
+
+    try:
+      return self._get_result(results.get(timeout=settings.clearinghouse_hedge_delay))
+    except Queue.Empty:
+      logger.info("Clearinghouse call " + name + " is slow, sending it again")
+      self._start_attempt(connect_to_clearinghouse(self.authdata), name, args, kwargs, results)
+      num_attempts += 1
+
+    first_error = None
+    while num_attempts:
+      try:
+        success, value = results.get(timeout=max(0, deadline - time.time()))
+      except Queue.Empty:
+        break
+      num_attempts -= 1
+      if success:
+        return value
+      if first_error is None:
+        first_error = value
+
+    if first_error is not None and not num_attempts:
+      raise first_error[0], first_error[1], first_error[2]
+
+    # The client may still be waiting for its response, so it can't be used
+    # for anything else.
+    self._client = connect_to_clearinghouse(self.authdata)
+    raise selexorexceptions.SelexorClearinghouseTimeout(
+      "The clearinghouse did not respond to " + name + " within " +
+      str(settings.clearinghouse_call_timeout) + " seconds")
+
+
+  def _get_result(self, result):
+    success, value = result
+    if success:
+      return value
+    raise value[0], value[1], value[2]
+
+
+# Shared by every part of SeleXor that talks to the clearinghouse.
+clearinghouse_sessions = ClearinghouseSessionPool()
+
+
 def haversine_distance(long1, lat1, long2, lat2):
   '''
   Given two coordinates, calculate the great circle distance between them.
@@ -289,18 +494,24 @@ def get_handle_location(handle, loctype, database):
 def connect_to_db():
   """
   <Purpose>
-    Connect to the MySQL database using the user/pass/db specified in the
-    configuration file.
+    Connect to the database configured in the settings file: the MySQL
+    database using the user/pass/db specified there, or the SQLite database
+    at settings.sqlite_path.
   <Arguments>
-    configuration - Configuration dictionary from load_config_with_file().
-  <Exceptions>
     None
+  <Exceptions>
+    ImportError if the MySQL backend is configured but MySQLdb is missing.
   <Side Effects>
     Connects to the specified db.
+    Creates the tables of a SQLite database the first time it is opened.
   <Return>
     A db and cursor object representing the connection.
   """
+  if settings.db_backend == 'sqlite':
+    return selexorsqlite.connect(settings.sqlite_path)
 
+  if MySQLdb is None:
+    raise ImportError("MySQLdb is needed when settings.db_backend is 'mysql'")
   db = MySQLdb.connect(
       host='localhost', port=3306,
       user=settings.dbusername, passwd=settings.dbpassword,
@@ -309,10 +520,17 @@ def connect_to_db():
   return db, cursor
 
 
+def get_database_schema_file():
+  """ Returns the file that creates the tables of the configured database. """
+  if settings.db_backend == 'sqlite':
+    return selexorsqlite.SCHEMA_FILE
+  return 'database_create.sql'
 
 
 
-def autoretry_mysql_command(cursor, command):
+
+
+def autoretry_mysql_command(cursor, command, parameters=None):
   """
   <Purpose>
     Inserts the specified command into the command queue, and returns its
@@ -320,22 +538,38 @@ def autoretry_mysql_command(cursor, command):
     that would occur due to simultaneous db accesses.
   <Arguments>
     command: The command to send to the database.
+    parameters:
+      Optional sequence of values to substitute for the %s placeholders in
+      the command.  The database driver escapes these values.
   <Side Effects>
     Executes the specified MySQL statement.
+    Records a trace span for the statement, if a request is being traced.
   <Exceptions>
     None
   <Returns>
     None
   """
-  while True:
-    try:
-      result = cursor.execute(command)
-      return result
-    except MySQLdb.OperationalError, e:
-      if (e.args == (1213, 'Deadlock found when trying to get lock; try restarting transaction') or
-          e.args == (1205, 'Lock wait timeout exceeded; try restarting transaction')):
-        continue
-      raise
+  with selexortrace.span('db.' + command.split(None, 1)[0].lower()) as query_span:
+    while True:
+      try:
+        if parameters is None:
+          result = cursor.execute(command)
+        else:
+          result = cursor.execute(command, parameters)
+        query_span.set(rows=result)
+        return result
+      except Exception, e:
+        if _is_transient_db_error(e):
+          continue
+        raise
+
+
+def _is_transient_db_error(error):
+  ''' Returns whether a statement that raised error should be run again. '''
+  if MySQLdb is not None and isinstance(error, MySQLdb.OperationalError):
+    return (error.args == (1213, 'Deadlock found when trying to get lock; try restarting transaction') or
+      error.args == (1205, 'Lock wait timeout exceeded; try restarting transaction'))
+  return selexorsqlite.is_transient_error(error)
 
 
 
@@ -0,0 +1,255 @@
+"""
+<Program Name>
+  selexornodecache.py
+
+<Purpose>
+  Keeps an in-memory copy of the identity of every node in the database, so
+  that SeleXor can translate between node_ids, node_keys and node addresses
+  without querying the database for each vessel.
+
+  nodeinfo:
+    A tuple in the form (node_id, node_key, ip_addr, node_port).
+
+  The whole nodes table is loaded in bulk, and reloaded once it is older than
+  settings.node_cache_refresh_interval.  Lookups for nodes that are not in the
+  cache (e.g. nodes found by the prober since the last reload) are fetched
+  from the database, many nodes per query.
+
+"""
+
+import threading
+import time
+
+import selexorhelper
+import settings
+
+
+# The maximum number of nodes to look up in a single query.
+_LOOKUP_CHUNK_SIZE = 1000
+
+
+class NodeIdentityCache:
+  def __init__(self, refresh_interval=None):
+    '''
+    <Purpose>
+      Creates an empty node identity cache.  The cache is loaded on first use.
+    <Arguments>
+      refresh_interval:
+        The number of seconds before the cache is reloaded.  Defaults to
+        settings.node_cache_refresh_interval.
+    <Exceptions>
+      None
+    <Side Effects>
+      None
+    <Returns>
+      A NodeIdentityCache instance.
+
+    '''
+    if refresh_interval is None:
+      refresh_interval = settings.node_cache_refresh_interval
+    self._refresh_interval = refresh_interval
+    self._lock = threading.Lock()
+    self._last_refresh = None
+    self._by_node_id = {}
+    self._by_node_key = {}
+    self._by_address = {}
+
+
+  def _add_nodeinfo(self, nodeinfo):
+    node_id, node_key, ip_addr, node_port = nodeinfo
+    # Drop the entry for the node's old address, if it moved.
+    old_nodeinfo = self._by_node_id.get(node_id)
+    if old_nodeinfo is not None:
+      self._by_address.pop((old_nodeinfo[2], old_nodeinfo[3]), None)
+    self._by_node_id[node_id] = nodeinfo
+    self._by_node_key[node_key] = nodeinfo
+    self._by_address[(ip_addr, node_port)] = nodeinfo
+
+
+  def refresh(self, cursor):
+    '''
+    <Purpose>
+      Reloads the identities of all nodes from the database.
+    <Arguments>
+      cursor:
+        A database cursor object.
+    <Exceptions>
+      None
+    <Side Effects>
+      Replaces the contents of the cache.
+    <Returns>
+      None
+
+    '''
+    selexorhelper.autoretry_mysql_command(cursor,
+      "SELECT node_id, node_key, ip_addr, node_port FROM nodes")
+    rows = cursor.fetchall()
+
+    self._lock.acquire()
+    try:
+      self._by_node_id = {}
+      self._by_node_key = {}
+      self._by_address = {}
+      for nodeinfo in rows:
+        self._add_nodeinfo(tuple(nodeinfo))
+      self._last_refresh = time.time()
+    finally:
+      self._lock.release()
+
+
+  def _get_index(self, column):
+    if column == 'node_id':
+      return self._by_node_id
+    return self._by_node_key
+
+
+  def _refresh_if_stale(self, cursor):
+    if (self._last_refresh is None or
+        time.time() - self._last_refresh > self._refresh_interval):
+      self.refresh(cursor)
+
+
+  def _lookup(self, cursor, column, values):
+    '''
+    Returns a dictionary mapping each of the given node_ids or node_keys
+    (depending on column) to its nodeinfo, fetching the ones that are not
+    cached from the database.  Values that are not in the database are left
+    out.
+
+    '''
+    self._refresh_if_stale(cursor)
+    found = {}
+    missing = []
+    self._lock.acquire()
+    try:
+      index = self._get_index(column)
+      for value in set(values):
+        if value in index:
+          found[value] = index[value]
+        else:
+          missing.append(value)
+    finally:
+      self._lock.release()
+
+    for chunk_start in range(0, len(missing), _LOOKUP_CHUNK_SIZE):
+      chunk = missing[chunk_start:chunk_start + _LOOKUP_CHUNK_SIZE]
+      query = ("SELECT node_id, node_key, ip_addr, node_port FROM nodes WHERE " +
+        column + " IN (" + ", ".join(["%s"] * len(chunk)) + ")")
+      selexorhelper.autoretry_mysql_command(cursor, query, chunk)
+      rows = cursor.fetchall()
+
+      self._lock.acquire()
+      try:
+        for nodeinfo in rows:
+          self._add_nodeinfo(tuple(nodeinfo))
+        index = self._get_index(column)
+        for value in chunk:
+          if value in index:
+            found[value] = index[value]
+      finally:
+        self._lock.release()
+    return found
+
+
+  def get_nodeinfos_by_node_id(self, cursor, node_ids):
+    '''
+    <Purpose>
+      Looks up the nodeinfos of the given node_ids.
+    <Arguments>
+      cursor:
+        A database cursor object, used if any node is not in the cache.
+      node_ids:
+        An iterable of node_ids.
+    <Exceptions>
+      None
+    <Side Effects>
+      Reloads the cache if it is stale.
+    <Returns>
+      A dictionary mapping node_ids to nodeinfos.  Unknown nodes are left out.
+
+    '''
+    return self._lookup(cursor, 'node_id', node_ids)
+
+
+  def get_nodeinfos_by_node_key(self, cursor, node_keys):
+    '''
+    <Purpose>
+      Looks up the nodeinfos of the given node_keys.
+    <Arguments>
+      cursor:
+        A database cursor object, used if any node is not in the cache.
+      node_keys:
+        An iterable of node_keys.
+    <Exceptions>
+      None
+    <Side Effects>
+      Reloads the cache if it is stale.
+    <Returns>
+      A dictionary mapping node_keys to nodeinfos.  Unknown nodes are left out.
+
+    '''
+    return self._lookup(cursor, 'node_key', node_keys)
+
+
+  def get_nodeinfo_by_node_id(self, cursor, node_id):
+    ''' Returns the nodeinfo of the given node_id, or None if it is unknown. '''
+    return self.get_nodeinfos_by_node_id(cursor, [node_id]).get(node_id)
+
+
+  def get_nodeinfos_by_address(self, cursor, addresses):
+    '''
+    <Purpose>
+      Looks up the nodeinfos of the nodes listening on the given addresses.
+    <Arguments>
+      cursor:
+        A database cursor object, used if any node is not in the cache.
+      addresses:
+        An iterable of (ip_addr, node_port) tuples.
+    <Exceptions>
+      None
+    <Side Effects>
+      Reloads the cache if it is stale.
+    <Returns>
+      A dictionary mapping (ip_addr, node_port) tuples to nodeinfos.  Unknown
+      nodes are left out.  Ports in the keys are always ints.
+
+    '''
+    self._refresh_if_stale(cursor)
+    found = {}
+    missing = set()
+    self._lock.acquire()
+    try:
+      for ip_addr, node_port in addresses:
+        address = (ip_addr, int(node_port))
+        if address in self._by_address:
+          found[address] = self._by_address[address]
+        else:
+          missing.add(address)
+    finally:
+      self._lock.release()
+
+    # Look up the missing nodes by IP address only, and match the ports here.
+    missing_ips = list(set([ip_addr for (ip_addr, node_port) in missing]))
+    for chunk_start in range(0, len(missing_ips), _LOOKUP_CHUNK_SIZE):
+      chunk = missing_ips[chunk_start:chunk_start + _LOOKUP_CHUNK_SIZE]
+      query = ("SELECT node_id, node_key, ip_addr, node_port FROM nodes WHERE ip_addr IN (" +
+        ", ".join(["%s"] * len(chunk)) + ")")
+      selexorhelper.autoretry_mysql_command(cursor, query, chunk)
+      rows = cursor.fetchall()
+
+      self._lock.acquire()
+      try:
+        for nodeinfo in rows:
+          nodeinfo = tuple(nodeinfo)
+          address = (nodeinfo[2], int(nodeinfo[3]))
+          if address in missing:
+            self._add_nodeinfo(nodeinfo)
+            found[address] = nodeinfo
+      finally:
+        self._lock.release()
+    return found
+
+
+  def get_nodeinfo_by_address(self, cursor, ip_addr, node_port):
+    ''' Returns the nodeinfo of the node at the given address, or None if it is unknown. '''
+    return self.get_nodeinfos_by_address(cursor, [(ip_addr, node_port)]).get((ip_addr, int(node_port)))
@@ -0,0 +1,165 @@
+"""
+<Program Name>
+  selexorreliability.py
+
+<Purpose>
+  Keeps track of how often vessels can actually be acquired, so that
+  SeleXor stops offering vessels that the clearinghouse keeps refusing.
+
+  Every acquisition attempt is recorded for the vessel and for its node.
+  This is used in two ways:
+    Vessels that failed to be acquired are not picked again, by anyone,
+    for settings.failed_vessel_ttl seconds.
+    Each vessel gets a reliability score between 0 and 1, a smoothed
+    success rate.  Vessels without a history use their node's score, and
+    nodes without a history use settings.default_vessel_reliability.
+    Candidates are picked at random with their score as their weight.
+
+  vessel_key:
+    A (node_id, vesselname) tuple that identifies a vessel.
+
+"""
+
+import random
+import threading
+import time
+
+import settings
+
+
+# Vessels are still picked now and then, however unreliable they are, so
+# that vessels that recover get a chance to show it.
+MIN_PICK_WEIGHT = 0.05
+
+
+class VesselReliability:
+  def __init__(self):
+    self._lock = threading.Lock()
+    # vessel_key / node_id: (score, time of last update)
+    self._vessel_scores = {}
+    self._node_scores = {}
+    # vessel_key: time until which the vessel is not picked
+    self._failed_vessels = {}
+
+
+  def record_outcome(self, vessel_key, acquired):
+    '''
+    <Purpose>
+      Records the outcome of an attempt to acquire a vessel.
+    <Arguments>
+      vessel_key:
+        The vessel that SeleXor tried to acquire.
+      acquired:
+        True if the vessel was acquired, False otherwise.
+    <Exceptions>
+      None
+    <Side Effects>
+      Updates the scores of the vessel and its node.  Vessels that were not
+      acquired are excluded for settings.failed_vessel_ttl seconds.
+    <Returns>
+      None
+
+    '''
+    now = time.time()
+    outcome = acquired and 1.0 or 0.0
+    self._lock.acquire()
+    try:
+      node_score = self._get_node_score(vessel_key[0])
+      vessel_score = self._vessel_scores.get(vessel_key, (node_score, None))[0]
+      self._vessel_scores[vessel_key] = (_smooth(vessel_score, outcome), now)
+      self._node_scores[vessel_key[0]] = (_smooth(node_score, outcome), now)
+
+      if acquired:
+        self._failed_vessels.pop(vessel_key, None)
+      else:
+        self._failed_vessels[vessel_key] = now + settings.failed_vessel_ttl
+
+      if len(self._vessel_scores) > settings.max_reliability_entries:
+        self._forget_oldest_scores()
+    finally:
+      self._lock.release()
+
+
+  def get_failed_vessels(self):
+    ''' Returns the set of vessels that recently failed to be acquired. '''
+    now = time.time()
+    self._lock.acquire()
+    try:
+      for vessel_key, expiretime in self._failed_vessels.items():
+        if expiretime <= now:
+          del self._failed_vessels[vessel_key]
+      return set(self._failed_vessels)
+    finally:
+      self._lock.release()
+
+
+  def get_score(self, vessel_key):
+    ''' Returns the reliability score of the given vessel. '''
+    self._lock.acquire()
+    try:
+      if vessel_key in self._vessel_scores:
+        return self._vessel_scores[vessel_key][0]
+      return self._get_node_score(vessel_key[0])
+    finally:
+      self._lock.release()
+
+
+  def choose(self, vessels):
+    '''
+    <Purpose>
+      Picks one of the given vessels at random, favouring reliable ones.
+    <Arguments>
+      vessels:
+        A non-empty sequence of vessel_keys.
+    <Exceptions>
+      None
+    <Side Effects>
+      None
+    <Returns>
+      The chosen vessel_key.
+
+    '''
+    self._lock.acquire()
+    try:
+      weights = []
+      for vessel_key in vessels:
+        if vessel_key in self._vessel_scores:
+          score = self._vessel_scores[vessel_key][0]
+        else:
+          score = self._get_node_score(vessel_key[0])
+        weights.append(max(score, MIN_PICK_WEIGHT))
+    finally:
+      self._lock.release()
+
+    target = random.random() * sum(weights)
+    for vessel_key, weight in zip(vessels, weights):
+      target -= weight
+      if target < 0:
+        return vessel_key
+    # Rounding errors
+    return vessels[-1]
+
+
+  def _get_node_score(self, node_id):
+    # The caller must hold self._lock.
+    if node_id in self._node_scores:
+      return self._node_scores[node_id][0]
+    return settings.default_vessel_reliability
+
+
+  def _forget_oldest_scores(self):
+    # The caller must hold self._lock.  Forgets the older half of the
+    # scores, which then go back to the default.
+    for scores in (self._vessel_scores, self._node_scores):
+      if not scores:
+        continue
+      update_times = sorted([update_time for (score, update_time) in scores.itervalues()])
+      cutoff = update_times[len(update_times) / 2]
+      for key, (score, update_time) in scores.items():
+        if update_time < cutoff:
+          del scores[key]
+
+
+
+def _smooth(score, outcome):
+  return score + settings.reliability_smoothing * (outcome - score)
@@ -0,0 +1,371 @@
+"""
+<Program Name>
+  selexorrequeststore.py
+
+<Purpose>
+  Keeps the state of every request (its requestdict) that SeleXor knows
+  about.
+
+  Requests are split between a number of stripes by their key, and each
+  stripe has its own lock, so that threads working on different requests
+  rarely wait on each other.  Callers that change a stored requestdict
+  must hold the lock returned by get_lock() for its key, as requests are
+  read and saved with that lock held.
+
+  Threads can wait for a request to change with wait_for_change().  They
+  are woken up by notify_changed(), which only wakes the threads waiting
+  for that request.
+
+  Finished requests expire settings.request_state_ttl seconds after they
+  last changed, and only the settings.max_finished_requests most recently
+  used finished requests are kept.  Requests that are still being served
+  are never dropped.
+
+  If settings.persist_request_state is set, changed requests are written to
+  the request_states table every settings.request_state_persist_interval
+  seconds, and are loaded again when SeleXor restarts.  Requests that were
+  being served when SeleXor stopped are loaded with 'resume_needed' set, so
+  that they can be resumed once their user provides credentials again.
+
+"""
+
+import cPickle
+import datetime
+import threading
+import time
+import traceback
+
+import selexorhelper
+import settings
+
+
+logger = selexorhelper.setup_logging(__name__)
+
+
+# Requests in these states are still being served.
+ACTIVE_STATUSES = set(['processing', 'accepted', 'queued', 'working'])
+
+
+class RequestStore:
+  def __init__(self):
+    '''
+    <Purpose>
+      Creates a request store.  If settings.persist_request_state is set,
+      the requests that were saved before SeleXor last stopped are loaded.
+    <Arguments>
+      None
+    <Exceptions>
+      None
+    <Side Effects>
+      Loads saved requests and starts the thread that saves changed requests,
+      if persistence is enabled.
+    <Returns>
+      A RequestStore instance.
+
+    '''
+    self._stripes = []
+    for stripe_no in range(settings.num_request_store_stripes):
+      # Stored requests are ordered from least to most recently used.  The
+      # last item maps the keys of requests that threads are waiting on to
+      # [condition, number of waiting threads].
+      self._stripes.append((threading.RLock(), {}, [], {}))
+    self._max_finished_per_stripe = max(1, settings.max_finished_requests / len(self._stripes))
+
+    # Keys that were dropped since the last save, and the versions of the
+    # requests as they were last saved.
+    self._persist_lock = threading.Lock()
+    self._removed_keys = set()
+    self._persisted_versions = {}
+
+    if settings.persist_request_state:
+      self._load()
+      persist_thread = threading.Thread(target=self._persist_periodically)
+      persist_thread.daemon = True
+      persist_thread.start()
+
+
+  def _get_stripe(self, key):
+    return self._stripes[hash(key) % len(self._stripes)]
+
+
+  def get_lock(self, key):
+    ''' Returns the lock that guards the request with the given key. '''
+    return self._get_stripe(key)[0]
+
+
+  def get(self, key):
+    '''
+    <Purpose>
+      Looks up a request.
+    <Arguments>
+      key:
+        The key the request was stored under.
+    <Exceptions>
+      None
+    <Side Effects>
+      Drops the request if it has expired.
+    <Returns>
+      The requestdict, or None if there is no such request.
+
+    '''
+    lock, requests, usage_order, waiters = self._get_stripe(key)
+    lock.acquire()
+    try:
+      request_data = requests.get(key)
+      if request_data is None:
+        return None
+      if _is_expired(request_data, time.time()):
+        self._remove(key, requests, usage_order)
+        return None
+      usage_order.remove(key)
+      usage_order.append(key)
+      return request_data
+    finally:
+      lock.release()
+
+
+  def put(self, key, request_data):
+    '''
+    <Purpose>
+      Stores a request, replacing any request with the same key.
+    <Arguments>
+      key:
+        The key to store the request under.
+      request_data:
+        The requestdict.
+    <Exceptions>
+      None
+    <Side Effects>
+      Drops expired requests and the least recently used finished requests
+      that share the request's stripe.
+    <Returns>
+      None
+
+    '''
+    lock, requests, usage_order, waiters = self._get_stripe(key)
+    lock.acquire()
+    try:
+      if key in requests:
+        usage_order.remove(key)
+      requests[key] = request_data
+      usage_order.append(key)
+      self._drop_old_requests(requests, usage_order)
+    finally:
+      lock.release()
+
+
+  def get_items(self):
+    ''' Returns a list of (key, requestdict) of every stored request. '''
+    items = []
+    for lock, requests, usage_order, waiters in self._stripes:
+      lock.acquire()
+      try:
+        items.extend(requests.items())
+      finally:
+        lock.release()
+    return items
+
+
+  def wait_for_change(self, key, known_version, timeout):
+    '''
+    <Purpose>
+      Waits for the request with the given key to change, unless its
+      version is already different from known_version.
+    <Arguments>
+      key:
+        The key the request was stored under.
+      known_version:
+        The version of the request that the caller has seen.
+      timeout:
+        The maximum number of seconds to wait for.
+    <Exceptions>
+      None
+    <Side Effects>
+      Blocks the calling thread until notify_changed() is called for the
+      request, or until timeout passes.
+    <Returns>
+      The current version of the request, or None if there is no such
+      request.
+
+    '''
+    lock, requests, usage_order, waiters = self._get_stripe(key)
+    lock.acquire()
+    try:
+      request_data = self.get(key)
+      if request_data is not None and request_data.get('version') == known_version and timeout > 0:
+        waiter = waiters.setdefault(key, [threading.Condition(lock), 0])
+        waiter[1] += 1
+        try:
+          waiter[0].wait(timeout)
+        finally:
+          waiter[1] -= 1
+          if not waiter[1]:
+            del waiters[key]
+        request_data = requests.get(key)
+      if request_data is None:
+        return None
+      return request_data.get('version')
+    finally:
+      lock.release()
+
+
+  def notify_changed(self, key):
+    ''' Wakes up the threads waiting for the request with the given key to change. '''
+    lock, requests, usage_order, waiters = self._get_stripe(key)
+    lock.acquire()
+    try:
+      if key in waiters:
+        waiters[key][0].notifyAll()
+    finally:
+      lock.release()
+
+
+  def remove(self, key):
+    ''' Drops the request with the given key, if there is one. '''
+    lock, requests, usage_order, waiters = self._get_stripe(key)
+    lock.acquire()
+    try:
+      if key in requests:
+        self._remove(key, requests, usage_order)
+    finally:
+      lock.release()
+
+
+  def _remove(self, key, requests, usage_order):
+    # The caller must hold the stripe's lock.
+    del requests[key]
+    usage_order.remove(key)
+    self._persist_lock.acquire()
+    try:
+      self._removed_keys.add(key)
+    finally:
+      self._persist_lock.release()
+
+
+  def _drop_old_requests(self, requests, usage_order):
+    # The caller must hold the stripe's lock.
+    now = time.time()
+    finished_keys = []
+    for key in list(usage_order):
+      if _is_expired(requests[key], now):
+        self._remove(key, requests, usage_order)
+      elif requests[key].get('status') not in ACTIVE_STATUSES:
+        finished_keys.append(key)
+
+    # Least recently used first
+    for key in finished_keys[:max(0, len(finished_keys) - self._max_finished_per_stripe)]:
+      self._remove(key, requests, usage_order)
+
+
+  def _load(self):
+    db = None
+    try:
+      db, cursor = selexorhelper.connect_to_db()
+      now = datetime.datetime.now()
+      selexorhelper.autoretry_mysql_command(cursor,
+        "DELETE FROM request_states WHERE expires<=%s", (now,))
+      db.commit()
+      selexorhelper.autoretry_mysql_command(cursor, "SELECT state FROM request_states")
+      rows = cursor.fetchall()
+    except Exception:
+      logger.error("Could not load saved requests\n" + traceback.format_exc())
+      return
+    finally:
+      if db is not None:
+        db.close()
+
+    num_resumable = 0
+    for [state] in rows:
+      key, request_data = cPickle.loads(str(state))
+      if request_data.get('status') in ACTIVE_STATUSES:
+        # The threads that were serving this request are gone.
+        request_data['status'] = 'queued'
+        request_data['queue_position'] = None
+        request_data['resume_needed'] = True
+        request_data['expiretime'] = time.time() + settings.request_state_ttl
+        num_resumable += 1
+      self._persisted_versions[key] = request_data.get('version')
+      self.put(key, request_data)
+    logger.info("Loaded " + str(len(rows)) + " saved request(s), " + str(num_resumable) + " to be resumed")
+
+
+  def _persist_periodically(self):
+    db = None
+    while True:
+      time.sleep(settings.request_state_persist_interval)
+      try:
+        if db is None:
+          db, cursor = selexorhelper.connect_to_db()
+        self.persist(cursor)
+        db.commit()
+      except Exception:
+        logger.error("Could not save requests\n" + traceback.format_exc())
+        if db is not None:
+          db.close()
+          db = None
+
+
+  def persist(self, cursor):
+    '''
+    <Purpose>
+      Saves the requests that changed since they were last saved, and
+      deletes the saved copies of requests that were dropped.
+    <Arguments>
+      cursor:
+        A database cursor object.  The caller must commit the changes.
+    <Exceptions>
+      MySQLdb.Error
+    <Side Effects>
+      Writes to the request_states table.
+    <Returns>
+      None
+
+    '''
+    self._persist_lock.acquire()
+    try:
+      removed_keys = self._removed_keys
+      self._removed_keys = set()
+    finally:
+      self._persist_lock.release()
+
+    for key in removed_keys:
+      self._persisted_versions.pop(key, None)
+      selexorhelper.autoretry_mysql_command(cursor,
+        "DELETE FROM request_states WHERE request_key=%s", (repr(key),))
+
+    for lock, requests, usage_order, waiters in self._stripes:
+      changed_states = []
+      lock.acquire()
+      try:
+        for key, request_data in requests.iteritems():
+          version = request_data.get('version')
+          if key in self._persisted_versions and self._persisted_versions[key] == version:
+            continue
+          expiretime = request_data.get('expiretime', 0)
+          if request_data.get('status') in ACTIVE_STATUSES:
+            # Keep it until it can be resumed, however long ago it changed.
+            expiretime = max(expiretime, time.time() + settings.request_state_ttl)
+          state = cPickle.dumps((key, request_data), cPickle.HIGHEST_PROTOCOL)
+          changed_states.append((key, version, state, expiretime))
+      finally:
+        lock.release()
+
+      for key, version, state, expiretime in changed_states:
+        selexorhelper.autoretry_mysql_command(cursor,
+          "REPLACE INTO request_states (request_key, state, expires) VALUES (%s, %s, %s)",
+          (repr(key), state, datetime.datetime.fromtimestamp(expiretime)))
+        self._persisted_versions[key] = version
+
+
+
+def _is_expired(request_data, now):
+  '''
+  Returns whether the given requestdict should be dropped.  Requests that
+  are still being served never expire, unless they were loaded from the
+  database and have not been resumed.
+
+  '''
+  if (request_data.get('status') in ACTIVE_STATUSES and
+      not request_data.get('resume_needed')):
+    return False
+  return request_data.get('expiretime', now) < now
@@ -0,0 +1,254 @@
+"""
+<Program Name>
+  selexorreservation.py
+
+<Purpose>
+  Implements short-lived vessel leases, which keep concurrent resolutions
+  from picking the same vessels.
+
+  A resolution leases each candidate before it tries to acquire it.  While
+  the lease is held, the vessel is hidden from every other resolution.  The
+  lease is released if the vessel is not acquired, and is committed if it
+  is.  Committed leases are kept for as long as the vessel is expected to be
+  held by its user, since the database cannot tell which vessels are in use.
+
+  vessel_key:
+    A (node_id, vesselname) tuple that identifies a vessel.
+
+  owner:
+    A string that uniquely identifies the resolution that holds a lease.
+
+  Leases are kept in memory by default.  Multiple SeleXor instances that
+  share a database should set settings.use_database_vessel_leases, so that
+  leases are kept in the vessel_leases table instead.
+
+"""
+
+import datetime
+import threading
+import time
+
+import selexorhelper
+import settings
+
+
+logger = selexorhelper.setup_logging(__name__)
+
+
+def create_vessel_leases():
+  '''
+  <Purpose>
+    Creates the lease store selected in the settings.
+  <Arguments>
+    None
+  <Exceptions>
+    None
+  <Side Effects>
+    None
+  <Returns>
+    A VesselLeases or DatabaseVesselLeases instance.
+
+  '''
+  if settings.use_database_vessel_leases:
+    return DatabaseVesselLeases()
+  return VesselLeases()
+
+
+class VesselLeases:
+  '''
+  <Purpose>
+    Keeps vessel leases in memory.
+  <Side Effects>
+    None
+  <Example Use>
+    leases = VesselLeases()
+    if leases.lease(vessel_key, owner):
+      # Acquire the vessel...
+      leases.commit(vessel_key, owner)
+
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    # vessel_key: (owner, expiry time)
+    self._leases = {}
+    self._last_purge = time.time()
+
+
+  def _purge_expired(self, now):
+    # Only sweep once per lease duration; expired leases are ignored anyway.
+    if now - self._last_purge < settings.vessel_lease_duration:
+      return
+    for vessel_key, (owner, expiretime) in self._leases.items():
+      if expiretime <= now:
+        del self._leases[vessel_key]
+    self._last_purge = now
+
+
+  def _set_lease(self, vessel_key, owner, duration, only_if_owned):
+    now = time.time()
+    self._lock.acquire()
+    try:
+      self._purge_expired(now)
+      if vessel_key in self._leases:
+        current_owner, expiretime = self._leases[vessel_key]
+        if current_owner != owner and expiretime > now:
+          return False
+      elif only_if_owned:
+        return False
+      self._leases[vessel_key] = (owner, now + duration)
+      return True
+    finally:
+      self._lock.release()
+
+
+  def lease(self, vessel_key, owner):
+    '''
+    <Purpose>
+      Leases a vessel for settings.vessel_lease_duration seconds.
+    <Arguments>
+      vessel_key:
+        The vessel to lease.
+      owner:
+        The resolution that is leasing the vessel.
+    <Exceptions>
+      None
+    <Side Effects>
+      Hides the vessel from other owners while the lease is held.
+    <Returns>
+      True if the lease was obtained, False if another owner holds it.
+
+    '''
+    return self._set_lease(vessel_key, owner, settings.vessel_lease_duration, False)
+
+
+  def commit(self, vessel_key, owner):
+    '''
+    Extends the given owner's lease on a vessel that it has acquired, to
+    settings.vessel_commit_lease_duration seconds.
+
+    '''
+    self._set_lease(vessel_key, owner, settings.vessel_commit_lease_duration, True)
+
+
+  def release(self, vessel_key, owner=None):
+    '''
+    Releases the lease on a vessel.  If owner is given, the lease is only
+    released if it is held by that owner.
+
+    '''
+    self._lock.acquire()
+    try:
+      if vessel_key in self._leases:
+        if owner is None or self._leases[vessel_key][0] == owner:
+          del self._leases[vessel_key]
+    finally:
+      self._lock.release()
+
+
+  def get_leased_vessels(self, owner):
+    ''' Returns the set of vessels that are leased by anyone except owner. '''
+    now = time.time()
+    leased_vessels = set()
+    self._lock.acquire()
+    try:
+      for vessel_key, (lease_owner, expiretime) in self._leases.iteritems():
+        if lease_owner != owner and expiretime > now:
+          leased_vessels.add(vessel_key)
+    finally:
+      self._lock.release()
+    return leased_vessels
+
+
+
+class DatabaseVesselLeases:
+  '''
+  <Purpose>
+    Keeps vessel leases in the vessel_leases table, so that they are shared
+    by every SeleXor instance that uses the same database.  This has the same
+    interface as VesselLeases.
+  <Side Effects>
+    Opens a database connection on first use.
+
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._db = None
+    self._cursor = None
+
+
+  def _execute(self, command, parameters=None):
+    # The caller must hold self._lock.
+    if self._db is None:
+      self._db, self._cursor = selexorhelper.connect_to_db()
+    return selexorhelper.autoretry_mysql_command(self._cursor, command, parameters)
+
+
+  def _set_lease(self, vessel_key, owner, duration, only_if_owned):
+    now = datetime.datetime.now()
+    expiretime = now + datetime.timedelta(seconds=duration)
+    node_id, vesselname = vessel_key
+    self._lock.acquire()
+    try:
+      try:
+        # Leases held by the same owner are simply extended.
+        extended = self._execute(
+          "UPDATE vessel_leases SET expires=%s WHERE node_id=%s AND vessel_name=%s AND owner=%s",
+          (expiretime, node_id, vesselname, owner))
+        if extended or only_if_owned:
+          self._db.commit()
+          return bool(extended)
+
+        self._execute(
+          "DELETE FROM vessel_leases WHERE node_id=%s AND vessel_name=%s AND expires<=%s",
+          (node_id, vesselname, now))
+        # This does nothing if another owner still holds a lease.
+        leased = self._execute(
+          "INSERT IGNORE INTO vessel_leases (node_id, vessel_name, owner, expires) VALUES (%s, %s, %s, %s)",
+          (node_id, vesselname, owner, expiretime))
+        self._db.commit()
+        return leased == 1
+      except:
+        self._db.rollback()
+        raise
+    finally:
+      self._lock.release()
+
+
+  def lease(self, vessel_key, owner):
+    ''' See VesselLeases.lease(). '''
+    return self._set_lease(vessel_key, owner, settings.vessel_lease_duration, False)
+
+
+  def commit(self, vessel_key, owner):
+    ''' See VesselLeases.commit(). '''
+    self._set_lease(vessel_key, owner, settings.vessel_commit_lease_duration, True)
+
+
+  def release(self, vessel_key, owner=None):
+    ''' See VesselLeases.release(). '''
+    node_id, vesselname = vessel_key
+    self._lock.acquire()
+    try:
+      if owner is None:
+        self._execute("DELETE FROM vessel_leases WHERE node_id=%s AND vessel_name=%s",
+          (node_id, vesselname))
+      else:
+        self._execute("DELETE FROM vessel_leases WHERE node_id=%s AND vessel_name=%s AND owner=%s",
+          (node_id, vesselname, owner))
+      self._db.commit()
+    finally:
+      self._lock.release()
+
+
+  def get_leased_vessels(self, owner):
+    ''' See VesselLeases.get_leased_vessels(). '''
+    self._lock.acquire()
+    try:
+      self._execute("SELECT node_id, vessel_name FROM vessel_leases WHERE owner!=%s AND expires>%s",
+        (owner, datetime.datetime.now()))
+      leased_vessels = set(self._cursor.fetchall())
+      # End the transaction so that the next query sees new leases.
+      self._db.commit()
+      return leased_vessels
+    finally:
+      self._lock.release()
@@ -40,9 +40,67 @@ ruledict:
   that pass the rule.  It should be in the same format as returned by a MySQL
   lookup.
 
+  Vessel rule callbacks accept one additional parameter:
+    vesselset:
+      The set of (node_id, vesselname) candidates that passed the rules
+      that were applied before this one.  Vessels outside of this set are
+      discarded anyway, so callbacks may limit their work to it.
+
   After defining the callback function, simply place it into the corresponding
   rules dictionary in the _init function.
 
+  Group rule callbacks accept two additional parameters:
+    acquired_vessels:
+      The list of vesseldicts that are already in the group.
+    vesselset:
+      The set of (node_id, vesselname) candidates to evaluate.  Callbacks
+      should only return vessels from within this set.
+
+  Group rules may optionally register a tracker class, which lets a
+  GroupRuleState update the set of feasible vessels incrementally as vessels
+  are added to and removed from a group, instead of re-evaluating the rule
+  from scratch.  Trackers are constructed with the following parameters:
+    invert: (bool)
+      If set to true, invert the rule.
+    parameters: (dictionary)
+      A dictionary of parameters that the rule expects.
+    vesselset:
+      The set of (node_id, vesselname) candidates to track.
+    locations:
+      A dictionary mapping node_ids to their location information, as
+      returned by get_node_locations().  This dictionary is shared with the
+      GroupRuleState, which adds entries to it for any vessel added that is
+      not part of vesselset.
+  and must implement add_vessel(vesseldict), remove_vessel(vesseldict),
+  get_feasible_vessels() and get_signature(node_id).  get_signature() returns
+  the property of a node that the rule looks at (e.g. its coordinates), so
+  that vessels on nodes with the same signature are interchangeable as far
+  as the rule is concerned.  Trackers may also implement
+  get_max_additional_vessels(unavailable_vessels), which returns an upper
+  bound on the number of vessels that can still be added to the group
+  without using any of unavailable_vessels, or None if there is no bound.
+
+  Vessel rules may optionally register an SQL condition callback, so that
+  they can be evaluated by the database as part of a single query (see
+  compile_vessel_rules()).  It accepts the following parameters:
+    invert: (bool)
+      If set to true, invert the rule.
+    parameters: (dictionary)
+      A dictionary of parameters that the rule expects.
+  and returns a tuple (condition, values), where condition is an SQL
+  boolean expression with %s placeholders for each of the values in the
+  list values.  The condition may refer to the columns of the vessels, nodes
+  and location tables.  Nodes without a location have NULL location
+  columns; they should not pass location conditions, inverted or not.
+  Rules without an SQL condition callback are applied in Python instead.
+
+  Rules are not applied in the order they are given.  Every time a rule is
+  applied, the fraction of candidates that pass it and the time it takes are
+  recorded for that rule and its parameters.  The rules of a request are
+  then applied cheapest and most selective first, so that expensive rules
+  only see the vessels that are left, and once no candidates are left the
+  remaining rules are skipped.
+
   vessel_rules:
     Rules that operate on independent vessels. These are generally rules that
     use properties that are for the most part, do not change often and can be
@@ -69,9 +127,13 @@ ruledict:
 
 
 """
+import datetime
 import selexorhelper
 import selexorexceptions
-from copy import deepcopy
+import selexortrace
+import settings
+import threading
+import time
 
 
 
@@ -82,8 +144,86 @@ rule_callbacks = {
 
 parameter_preprocess_callbacks = {}
 
+# Vessel rule name -> SQL condition callback.  See the Usage section of the
+# module docstring for more information.
+rule_sql_conditions = {}
+
+# Group rule name -> tracker class.  See the Usage section of the module
+# docstring for more information.
+group_rule_trackers = {}
+
 all_known_rules = set()
 
+# The maximum number of node_ids to look up in a single query.
+_LOOKUP_CHUNK_SIZE = 1000
+
+# How much weight each new observation has on the selectivity and cost
+# estimates of a rule.
+_STATISTICS_SMOOTHING = 0.2
+
+# The maximum number of rule/parameter combinations to keep statistics for.
+_MAX_STATISTICS_ENTRIES = 10000
+
+
+class _RuleStatistics:
+  '''
+  Keeps track of how selective and how expensive each rule is, for each set
+  of parameters it is used with.  See the Usage section of the module
+  docstring for more information.
+
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    # (rule_name, parameters): [fraction of candidates kept, seconds taken]
+    self._statistics = {}
+
+
+  def record(self, rule_name, rule_params, num_candidates, num_kept, cost):
+    ''' Records the outcome of applying a rule to num_candidates vessels. '''
+    if not num_candidates:
+      return
+    key = _get_statistics_key(rule_name, rule_params)
+    selectivity = float(num_kept) / num_candidates
+    self._lock.acquire()
+    try:
+      if key not in self._statistics:
+        if len(self._statistics) >= _MAX_STATISTICS_ENTRIES:
+          self._statistics.clear()
+        self._statistics[key] = [selectivity, cost]
+      else:
+        statistics = self._statistics[key]
+        statistics[0] += _STATISTICS_SMOOTHING * (selectivity - statistics[0])
+        statistics[1] += _STATISTICS_SMOOTHING * (cost - statistics[1])
+    finally:
+      self._lock.release()
+
+
+  def get_rank(self, rule_name, rule_params):
+    '''
+    Returns the expected cost of a rule per candidate that it removes.
+    Rules with a lower rank should be applied first.  Rules that have not
+    been applied yet are tried first, to find out what they cost.
+
+    '''
+    self._lock.acquire()
+    try:
+      statistics = self._statistics.get(_get_statistics_key(rule_name, rule_params))
+    finally:
+      self._lock.release()
+    if statistics is None:
+      return 0
+    selectivity, cost = statistics
+    return cost / max(1 - selectivity, 0.001)
+
+
+
+def _get_statistics_key(rule_name, rule_params):
+  return (rule_name, repr(sorted(rule_params.items())))
+
+
+rule_statistics = _RuleStatistics()
+
+
 def rules_from_strings(strings):
   rules = {}
   for string in strings:
@@ -150,6 +290,130 @@ def has_group_rules(rules):
   return False
 
 
+def order_rules(rules, rule_type):
+  '''
+  <Purpose>
+    Decides which order the rules of a given type should be applied in.
+  <Arguments>
+    rules:
+      A ruledict. See module documentation for more information.
+    rule_type:
+      'vessel' or 'group'.
+  <Exceptions>
+    None
+  <Side Effects>
+    None
+  <Return>
+    A list of the names of the rules in rules that are of the given type,
+    cheapest and most selective first.
+
+  '''
+  rule_names = [rule_name for rule_name in rules if rule_name in rule_callbacks[rule_type]]
+  rule_names.sort(key=lambda rule_name: rule_statistics.get_rank(rule_name, rules[rule_name]))
+  return rule_names
+
+
+def compile_vessel_rules(rules):
+  '''
+  <Purpose>
+    Builds a single query that selects the vessels that can be offered to
+    users and that satisfy the vessel rules that can be evaluated by the
+    database.
+  <Arguments>
+    rules:
+      A ruledict. See module documentation for more information.
+  <Exceptions>
+    None
+  <Side Effects>
+    None
+  <Return>
+    A tuple (query, values, remaining_rule_names).  query selects
+    (node_id, vessel_name) rows, with %s placeholders for each of the values
+    in the list values.  remaining_rule_names lists the vessel rules that
+    must still be applied in Python.
+
+  '''
+  conditions = ["vessels.acquirable"]
+  values = []
+  if settings.node_offline_timeout is not None:
+    conditions.append("nodes.last_seen >= %s")
+    values.append(datetime.datetime.now() -
+      datetime.timedelta(seconds=settings.node_offline_timeout))
+
+  remaining_rule_names = []
+  for rule_name in rules:
+    if rule_name not in rule_callbacks['vessel']:
+      continue
+    if rule_name not in rule_sql_conditions:
+      remaining_rule_names.append(rule_name)
+      continue
+    rule_params = rules[rule_name]
+    condition, condition_values = rule_sql_conditions[rule_name](
+      'invert' in rule_params, rule_params)
+    conditions.append("(" + condition + ")")
+    values += condition_values
+
+  query = """SELECT vessels.node_id, vessels.vessel_name FROM vessels
+      JOIN nodes ON nodes.node_id = vessels.node_id
+      LEFT JOIN location ON location.ip_addr = nodes.ip_addr
+      WHERE """ + " AND ".join(conditions)
+  return (query, values, remaining_rule_names)
+
+
+def get_vessel_candidates(rules, cursor):
+  '''
+  <Purpose>
+    Looks up the vessels that can be offered to users and that satisfy the
+    given vessel rules.  If settings.compile_vessel_rules is set, the rules
+    that support it are evaluated by the database, in a single query.
+  <Arguments>
+    rules:
+      A ruledict. See module documentation for more information.
+    cursor:
+      A database cursor object.
+  <Exceptions>
+    None
+  <Side Effects>
+    Updates the statistics of the rules that are applied in Python.
+  <Return>
+    A set of (node_id, vesselname) tuples.
+
+  '''
+  if settings.compile_vessel_rules:
+    query, values, remaining_rule_names = compile_vessel_rules(rules)
+  else:
+    query, values, remaining_rule_names = compile_vessel_rules({})
+    remaining_rule_names = list(rules)
+  logger.debug(query)
+  selexorhelper.autoretry_mysql_command(cursor, query, values)
+  vesselset = set(cursor.fetchall())
+
+  remaining_rules = {}
+  for rule_name in remaining_rule_names:
+    remaining_rules[rule_name] = rules[rule_name]
+  return apply_vessel_rules(remaining_rules, cursor, vesselset)
+
+
+def _apply_rule(rule_type, rule_name, rule_params, cursor, vesselset, *args):
+  '''
+  Applies a single rule to vesselset, in place, and records how long it
+  took and how many vessels it kept.  args are passed to the rule callback
+  after the parameters.
+
+  '''
+  num_candidates = len(vesselset)
+  start_time = time.time()
+  with selexortrace.span(rule_type + '_rule.' + rule_name, num_candidates=num_candidates) as rule_span:
+    vesselset.intersection_update(rule_callbacks[rule_type][rule_name](
+                    cursor,
+                    'invert' in rule_params,
+                    rule_params,
+                    *args))
+    rule_span.set(num_matches=len(vesselset))
+  rule_statistics.record(rule_name, rule_params, num_candidates, len(vesselset),
+    time.time() - start_time)
+
+
 def apply_vessel_rules(rules, cursor, vesselset):
   '''
   <Purpose>
@@ -167,18 +431,16 @@ def apply_vessel_rules(rules, cursor, vesselset):
     None
   <Side Effects>
     Applies all known rules onto the input set.
+    Updates the statistics of the rules that are applied.
   <Return>
     The set of vessels that satisfy the given condition.
 
   '''
   vesselset = set(vesselset)
-  for rule_name, rule_params in rules.iteritems():
-    if rule_name in rule_callbacks['vessel']:
-      invert = 'invert' in rule_params
-      vesselset.intersection_update(rule_callbacks['vessel'][rule_name](
-                      cursor,
-                      invert,
-                      rule_params))
+  for rule_name in order_rules(rules, 'vessel'):
+    if not vesselset:
+      break
+    _apply_rule('vessel', rule_name, rules[rule_name], cursor, vesselset, vesselset)
   return vesselset
 
 
@@ -200,6 +462,7 @@ def apply_group_rules(rules, cursor, vesselset, acquired_vessels):
     None
   <Side Effects>
     Applies all known rules onto the input set.
+    Updates the statistics of the rules that are applied.
   <Return>
     The set of handles that satisfy the given condition.
   '''
@@ -210,14 +473,11 @@ def apply_group_rules(rules, cursor, vesselset, acquired_vessels):
     return vesselset
   vesselset = set(vesselset)
 
-  for rule_name, rule_params in rules.iteritems():
-    if rule_name in rule_callbacks['group']:
-      invert = 'invert' in rule_params
-      vesselset.intersection_update(rule_callbacks['group'][rule_name](
-                      cursor,
-                      invert,
-                      rule_params,
-                      acquired_vessels))
+  for rule_name in order_rules(rules, 'group'):
+    if not vesselset:
+      break
+    _apply_rule('group', rule_name, rules[rule_name], cursor, vesselset,
+      acquired_vessels, vesselset)
   return vesselset
 
 
@@ -226,6 +486,11 @@ def get_worst_vessel(acquired_vessels, handleset, cursor, rules):
   <Purpose>
     Returns the vessel that, when removed, gives the largest accessible
     vesselset.
+
+    This re-evaluates every group rule once per acquired vessel.
+    GroupRuleState.get_worst_vessel() gives the same result using the
+    incremental rule state, and should be used instead where a
+    GroupRuleState is available.
   <Arguments>
     acquired_vessels: list of vessel handles currently acquired.
     handleset: The set of all valid handles. (without group-level rules applied)
@@ -244,15 +509,328 @@ def get_worst_vessel(acquired_vessels, handleset, cursor, rules):
   if not acquired_vessels:
     raise ValueError("No vessels have been acquired")
   for vessel in acquired_vessels:
-    acquired_vessels_except_one = deepcopy(acquired_vessels)
+    acquired_vessels_except_one = list(acquired_vessels)
     acquired_vessels_except_one.remove(vessel)
     accessible_vessels = apply_group_rules(rules, cursor, handleset, acquired_vessels_except_one)
     if len(accessible_vessels) > largest_accessible_vessels_size:
-      largest_accessible_vessels = accessible_vessels
+      largest_accessible_vessels_size = len(accessible_vessels)
       worst_vessel = vessel
   return worst_vessel
 
 
+class GroupRuleState:
+  '''
+  <Purpose>
+    Keeps track of which vessels can still be added to a group under its
+    group rules, as vessels are added to and removed from the group.
+
+    Group rules that have a registered tracker are updated incrementally.
+    The location of every candidate is looked up once, when the state is
+    created, so adding or removing a vessel does not touch the database.
+    Group rules without a tracker are evaluated by their callback, against
+    the remaining candidates only.
+  <Example Use>
+    state = GroupRuleState(rules, cursor, vesselset, group['acquired'])
+    state.add_vessel(vesseldict)
+    candidates = state.get_feasible_vessels()
+
+  '''
+  def __init__(self, rules, cursor, vesselset, acquired_vessels=()):
+    '''
+    <Purpose>
+      Creates the group rule state for a group.
+    <Arguments>
+      rules:
+        A ruledict. See module documentation for more information.
+      cursor:
+        A database cursor object.
+      vesselset:
+        The set of (node_id, vesselname) candidates that satisfy the
+        vessel rules of the group.
+      acquired_vessels:
+        The list of vesseldicts that are already in the group.
+    <Exceptions>
+      None
+    <Side Effects>
+      Looks up the location of every candidate.
+    <Returns>
+      A GroupRuleState instance.
+
+    '''
+    self._rules = rules
+    self._cursor = cursor
+    self.vesselset = set(vesselset)
+    self.acquired_vessels = []
+    self._acquired_keys = set()
+
+    group_rule_names = []
+    for rule_name in rules:
+      if rule_name in rule_callbacks['group']:
+        group_rule_names.append(rule_name)
+
+    self._locations = {}
+    if group_rule_names:
+      node_ids = [node_id for (node_id, vesselname) in self.vesselset]
+      node_ids += [vesseldict['node_id'] for vesseldict in acquired_vessels]
+      self._locations = get_node_locations(cursor, node_ids)
+
+    self._trackers = {}
+    self._untracked_rules = []
+    for rule_name in group_rule_names:
+      rule_params = rules[rule_name]
+      if rule_name in group_rule_trackers:
+        self._trackers[rule_name] = group_rule_trackers[rule_name](
+          'invert' in rule_params, rule_params, self.vesselset, self._locations)
+      else:
+        self._untracked_rules.append(rule_name)
+
+    for vesseldict in acquired_vessels:
+      self.add_vessel(vesseldict)
+
+
+  def add_vessel(self, vesseldict):
+    ''' Adds the given vesseldict to the group. '''
+    vessel_key = get_vessel_key(vesseldict)
+    if vessel_key in self._acquired_keys:
+      return
+    if self._trackers and vesseldict['node_id'] not in self._locations:
+      self._locations.update(get_node_locations(self._cursor, [vesseldict['node_id']]))
+
+    self.acquired_vessels.append(vesseldict)
+    self._acquired_keys.add(vessel_key)
+    for tracker in self._trackers.values():
+      tracker.add_vessel(vesseldict)
+
+
+  def remove_vessel(self, vesseldict):
+    ''' Removes the given vesseldict from the group. '''
+    vessel_key = get_vessel_key(vesseldict)
+    if vessel_key not in self._acquired_keys:
+      return
+    self.acquired_vessels.remove(vesseldict)
+    self._acquired_keys.remove(vessel_key)
+    for tracker in self._trackers.values():
+      tracker.remove_vessel(vesseldict)
+
+
+  def get_feasible_vessels(self):
+    '''
+    <Purpose>
+      Returns the set of vessels that can be added to the group without
+      violating any of its group rules.
+    <Arguments>
+      None
+    <Exceptions>
+      None
+    <Side Effects>
+      Calls the callbacks of group rules that do not have a tracker.
+    <Returns>
+      A set of (node_id, vesselname) tuples.  Vessels that are already in the
+      group are never included.
+
+    '''
+    feasible_vessels = self.vesselset - self._acquired_keys
+    # Group rules only apply once there is a vessel to compare against.
+    if not self.acquired_vessels:
+      return feasible_vessels
+
+    for tracker in self._trackers.values():
+      feasible_vessels.intersection_update(tracker.get_feasible_vessels())
+
+    for rule_name in order_rules(self._rules, 'group'):
+      if not feasible_vessels:
+        break
+      if rule_name not in self._untracked_rules:
+        continue
+      _apply_rule('group', rule_name, self._rules[rule_name], self._cursor,
+        feasible_vessels, self.acquired_vessels, feasible_vessels)
+    return feasible_vessels
+
+
+  def has_group_rules(self):
+    ''' Returns whether any group rule applies to the group. '''
+    return bool(self._trackers or self._untracked_rules)
+
+
+  def get_max_additional_vessels(self, unavailable_vessels):
+    '''
+    <Purpose>
+      Returns an upper bound on the number of vessels that can still be
+      added to the group, as given by the trackers of its group rules.
+    <Arguments>
+      unavailable_vessels:
+        A set of (node_id, vesselname) tuples that will not be added.
+    <Exceptions>
+      None
+    <Side Effects>
+      None
+    <Returns>
+      The bound, or None if there is none.
+
+    '''
+    # Group rules only apply once there is a vessel to compare against.
+    if not self.acquired_vessels:
+      return None
+    max_additional_vessels = None
+    for tracker in self._trackers.values():
+      if hasattr(tracker, 'get_max_additional_vessels'):
+        bound = tracker.get_max_additional_vessels(unavailable_vessels)
+        if bound is not None and (max_additional_vessels is None or bound < max_additional_vessels):
+          max_additional_vessels = bound
+    return max_additional_vessels
+
+
+  def get_signature(self, vessel):
+    '''
+    <Purpose>
+      Returns a value that is the same for any two vessels that have the
+      same effect on the group rules, when added to or removed from the
+      group.
+    <Arguments>
+      vessel:
+        A (node_id, vesselname) tuple.
+    <Exceptions>
+      None
+    <Side Effects>
+      None
+    <Returns>
+      A hashable signature.  If some group rule has no tracker, every vessel
+      has its own signature.
+
+    '''
+    if self._untracked_rules:
+      return vessel
+    signature = []
+    for rule_name in sorted(self._trackers):
+      signature.append(self._trackers[rule_name].get_signature(vessel[0]))
+    return tuple(signature)
+
+
+  def get_worst_vessel(self, vessels):
+    '''
+    <Purpose>
+      Returns the vessel that, when removed, gives the largest accessible
+      vesselset.  This gives the same result as get_worst_vessel(), but
+      trackers compute the effect of removing each vessel from the state
+      they already have instead of re-evaluating their rules.
+    <Arguments>
+      vessels:
+        The list of vesseldicts in the group that may be removed.
+    <Exceptions>
+      ValueError
+    <Side Effects>
+      Calls the callbacks of group rules that do not have a tracker.
+    <Returns>
+      The vesseldict of the vessel that should be removed.
+
+    '''
+    if not vessels:
+      raise ValueError("No vessels have been acquired")
+
+    worst_vessel = None
+    largest_accessible_vessels_size = -1
+    for vessel in vessels:
+      if len(self.acquired_vessels) == 1:
+        # Group rules do not apply to an empty group.
+        accessible_vessels = self.vesselset
+      else:
+        accessible_vessels = set(self.vesselset)
+        for tracker in self._trackers.values():
+          accessible_vessels.intersection_update(tracker.get_feasible_vessels_without(vessel))
+
+        if self._untracked_rules:
+          acquired_vessels_except_one = list(self.acquired_vessels)
+          acquired_vessels_except_one.remove(vessel)
+          for rule_name in self._untracked_rules:
+            rule_params = self._rules[rule_name]
+            accessible_vessels.intersection_update(rule_callbacks['group'][rule_name](
+              self._cursor,
+              'invert' in rule_params,
+              rule_params,
+              acquired_vessels_except_one,
+              accessible_vessels))
+
+      if len(accessible_vessels) > largest_accessible_vessels_size:
+        largest_accessible_vessels_size = len(accessible_vessels)
+        worst_vessel = vessel
+    return worst_vessel
+
+
+def get_vessel_key(vesseldict):
+  ''' Returns the (node_id, vesselname) tuple that identifies a vesseldict. '''
+  return (vesseldict['node_id'], vesseldict['vessel_name'])
+
+
+def get_node_locations(cursor, node_ids):
+  '''
+  <Purpose>
+    Looks up the locations of the given nodes in bulk.
+  <Arguments>
+    cursor:
+      A database cursor object.
+    node_ids:
+      An iterable of node_ids to look up.
+  <Exceptions>
+    None
+  <Side Effects>
+    Queries the database once per _LOOKUP_CHUNK_SIZE nodes.
+  <Return>
+    A dictionary mapping each node_id to a dictionary containing its 'city',
+    'country_code', 'longitude' and 'latitude'.  Fields that are not known
+    are None.
+
+  '''
+  locations = {}
+  node_ids = list(set(node_ids))
+  for chunk_start in range(0, len(node_ids), _LOOKUP_CHUNK_SIZE):
+    chunk = node_ids[chunk_start:chunk_start + _LOOKUP_CHUNK_SIZE]
+    query = """SELECT node_id, city, country_code, longitude, latitude FROM
+        nodes LEFT JOIN location USING (ip_addr)
+        WHERE node_id IN (""" + ", ".join(str(int(node_id)) for node_id in chunk) + ")"
+    selexorhelper.autoretry_mysql_command(cursor, query)
+    for node_id, city, country_code, longitude, latitude in cursor.fetchall():
+      locations[node_id] = {
+        'city': city,
+        'country_code': country_code,
+        'longitude': longitude,
+        'latitude': latitude,
+      }
+  return locations
+
+
+def _get_node_condition(vesselset):
+  '''
+  Returns an SQL condition that limits a query to the nodes in vesselset,
+  or None if there are too many nodes for that to be worth it.
+
+  '''
+  node_ids = set([node_id for (node_id, vesselname) in vesselset])
+  if len(node_ids) > _LOOKUP_CHUNK_SIZE:
+    return None
+  if not node_ids:
+    return "1 = 0"
+  return "node_id IN (" + ", ".join(str(int(node_id)) for node_id in node_ids) + ")"
+
+
+def _get_coordinates(location):
+  '''
+  Returns the (longitude, latitude) of a location returned by
+  get_node_locations(), or None if they are not known.
+
+  '''
+  if location is None or location['longitude'] is None or location['latitude'] is None:
+    return None
+  return (location['longitude'], location['latitude'])
+
+
+def _is_within_radius(coordinates1, coordinates2, parameters):
+  ''' Checks if the distance between two coordinates is within the radii range. '''
+  distance = selexorhelper.haversine_distance(
+    coordinates1[0], coordinates1[1], coordinates2[0], coordinates2[1])
+  return distance >= parameters['min_radius'] and \
+         distance <= parameters['max_radius']
+
+
 def _specific_location_preprocessor(parameters):
   '''
   <Purpose>
@@ -340,7 +918,7 @@ def _different_location_preprocessor(parameters):
   return parameters
 
 
-def _specific_location_parser(cursor, invert, parameters):
+def _specific_location_parser(cursor, invert, parameters, vesselset):
   '''
   <Purpose>
     Vessel-Level Rule. Performs location-based parsing for handles.
@@ -361,16 +939,33 @@ def _specific_location_parser(cursor, invert, parameters):
   else:
     condition = 'location.city="'+parameters['city']+'" AND location.country_code="'+parameters['country_code']+'"'
   if invert:
-    condition = 'NOT ' + condition
+    condition = 'NOT (' + condition + ')'
 
   query = """SELECT node_id, vessel_name FROM 
       (SELECT ip_addr FROM location WHERE """+condition+""") as valid_ips
       LEFT JOIN nodes USING (ip_addr) LEFT JOIN vessels USING (node_id)"""
+  node_condition = _get_node_condition(vesselset)
+  if node_condition is not None:
+    query += " WHERE " + node_condition
   logger.debug(query)
-  cursor.execute(query)
+  selexorhelper.autoretry_mysql_command(cursor, query)
   return cursor.fetchall()
 
 
+def _specific_location_sql_condition(invert, parameters):
+  ''' SQL condition callback for location_specific. '''
+  if parameters['city'] is None:
+    condition = "location.country_code = %s"
+    values = [parameters['country_code']]
+  else:
+    condition = "location.city = %s AND location.country_code = %s"
+    values = [parameters['city'], parameters['country_code']]
+  if invert:
+    # Nodes without a location fail the rule either way.
+    condition = "location.ip_addr IS NOT NULL AND NOT (" + condition + ")"
+  return (condition, values)
+
+
 def _separation_radius_preprocessor(parameters):
   '''
   <Purpose>
@@ -502,7 +1097,7 @@ def _port_preprocessor(parameters):
 
 
 
-def _separation_radius_parser(cursor, invert, parameters, acquired_vessels):
+def _separation_radius_parser(cursor, invert, parameters, acquired_vessels, vesselset):
   '''
   <Purpose>
     Group-Level Rule. Performs distance-based parsing for handles.
@@ -515,49 +1110,140 @@ def _separation_radius_parser(cursor, invert, parameters, acquired_vessels):
         Expected Range: [0, Infinity)
 
   '''
+  node_ids = [node_id for (node_id, vesselname) in vesselset]
+  node_ids += [vesseldict['node_id'] for vesseldict in acquired_vessels]
+  locations = get_node_locations(cursor, node_ids)
 
-  acquired_coordinates = set()
   # Get the coordinates of the acquired vessels
   # acquired_vessels is a list of vesseldicts
+  # We may have NULL/NULL for the coordinate data, these are skipped.
+  acquired_coordinates = set()
   for vesseldict in acquired_vessels:
-    # We may have NULL/NULL for the coordinate data.
-    # Make sure we don't fetch any of those entries.
-    if cursor.execute('''
-        SELECT longitude, latitude FROM location LEFT JOIN nodes
-        USING (ip_addr) WHERE longitude IS NOT NULL AND latitude IS NOT NULL
-        AND node_id='''+str(vesseldict['node_id'])) == 1L:
-
-      acquired_coordinates.add(cursor.fetchone())
-
-  # Compile the list of good nodelocations
-  # Performing this on the database is really slow...
-  # We might as well do it here to avoid having too much pressure on the DB.
-  good_nodes = []
-  cursor.execute('''
-      SELECT DISTINCT node_id, longitude, latitude FROM location LEFT JOIN nodes
-      USING (ip_addr) WHERE longitude IS NOT NULL and latitude IS NOT NULL''')
-  for node_id, longitude, latitude in cursor.fetchall():
-    good_radius = True
-    for acquired_longitude, acquired_latitude in acquired_coordinates:
-      distance = selexorhelper.haversine_distance(longitude, latitude, acquired_longitude, acquired_latitude)
-      good_radius = distance >= parameters['min_radius'] and \
-                    distance <= parameters['max_radius']
-      # If distance to one is incorrect, then we don't need to check the rest
-      if not good_radius:
-        break
-    if invert ^ good_radius:
-      good_nodes.append(node_id)
+    coordinates = _get_coordinates(locations.get(vesseldict['node_id']))
+    if coordinates is not None:
+      acquired_coordinates.add(coordinates)
 
-  # Of the list of good nodelocations, compile the set of good vessels
+  # Vessels on the same node share the same coordinates, so we only need to
+  # check each node once.
+  node_is_good = {}
   good_vessels = []
-  for node_id in good_nodes:
-    cursor.execute('SELECT node_id, vessel_name FROM vessels WHERE node_id='+str(node_id))
-    good_vessels += cursor.fetchall()
+  for vessel in vesselset:
+    node_id = vessel[0]
+    if node_id not in node_is_good:
+      coordinates = _get_coordinates(locations.get(node_id))
+      if coordinates is None:
+        node_is_good[node_id] = False
+      else:
+        good_radius = True
+        for acquired_coordinate in acquired_coordinates:
+          good_radius = _is_within_radius(coordinates, acquired_coordinate, parameters)
+          # If distance to one is incorrect, then we don't need to check the rest
+          if not good_radius:
+            break
+        node_is_good[node_id] = invert ^ good_radius
+    if node_is_good[node_id]:
+      good_vessels.append(vessel)
 
   return good_vessels
 
 
-def _different_location_type_parser(cursor, invert, parameters, acquired_vessels):
+class _SeparationRadiusTracker:
+  '''
+  Tracker for location_separation_radius.  Keeps count of how many vessels
+  in the group each candidate node is out of range of.  See the Usage
+  section of the module docstring for more information.
+
+  '''
+  def __init__(self, invert, parameters, vesselset, locations):
+    self._invert = invert
+    self._parameters = parameters
+    self._locations = locations
+
+    # Candidates without coordinates never pass this rule.
+    self._node_coordinates = {}
+    self._node_vessels = {}
+    for vessel in vesselset:
+      coordinates = _get_coordinates(locations.get(vessel[0]))
+      if coordinates is not None:
+        self._node_coordinates[vessel[0]] = coordinates
+        self._node_vessels.setdefault(vessel[0], []).append(vessel)
+
+    # node_id -> Number of vessels in the group it is out of range of
+    self._out_of_range_count = dict.fromkeys(self._node_coordinates, 0)
+    # vessel key -> node_ids that the vessel puts out of range
+    self._out_of_range_nodes = {}
+
+    self._feasible_vessels = set()
+    for node_id in self._node_vessels:
+      self._update_node(node_id, in_range=True)
+
+
+  def _update_node(self, node_id, in_range):
+    if in_range ^ self._invert:
+      self._feasible_vessels.update(self._node_vessels[node_id])
+    else:
+      self._feasible_vessels.difference_update(self._node_vessels[node_id])
+
+
+  def get_out_of_range_nodes(self, vesseldict):
+    ''' Returns the candidate node_ids that the given vessel puts out of range. '''
+    coordinates = _get_coordinates(self._locations.get(vesseldict['node_id']))
+    out_of_range_nodes = []
+    # Vessels without coordinates do not restrict the group.
+    if coordinates is not None:
+      for node_id, node_coordinates in self._node_coordinates.iteritems():
+        if not _is_within_radius(node_coordinates, coordinates, self._parameters):
+          out_of_range_nodes.append(node_id)
+    return out_of_range_nodes
+
+
+  def add_vessel(self, vesseldict):
+    out_of_range_nodes = self.get_out_of_range_nodes(vesseldict)
+    self._out_of_range_nodes[get_vessel_key(vesseldict)] = out_of_range_nodes
+    for node_id in out_of_range_nodes:
+      self._out_of_range_count[node_id] += 1
+      if self._out_of_range_count[node_id] == 1:
+        self._update_node(node_id, in_range=False)
+
+
+  def remove_vessel(self, vesseldict):
+    for node_id in self._out_of_range_nodes.pop(get_vessel_key(vesseldict)):
+      self._out_of_range_count[node_id] -= 1
+      if self._out_of_range_count[node_id] == 0:
+        self._update_node(node_id, in_range=True)
+
+
+  def get_feasible_vessels(self):
+    return self._feasible_vessels
+
+
+  def get_signature(self, node_id):
+    return _get_coordinates(self._locations.get(node_id))
+
+
+  def get_max_additional_vessels(self, unavailable_vessels):
+    # Adding vessels can only put more nodes out of range.
+    if self._invert:
+      return None
+    return len(self._feasible_vessels - unavailable_vessels)
+
+
+  def get_feasible_vessels_without(self, vesseldict):
+    ''' Returns the feasible vessels if the given vessel were removed. '''
+    # Only the nodes that this vessel alone puts out of range change.
+    changed_vessels = []
+    for node_id in self._out_of_range_nodes[get_vessel_key(vesseldict)]:
+      if self._out_of_range_count[node_id] == 1:
+        changed_vessels.extend(self._node_vessels[node_id])
+
+    if not changed_vessels:
+      return self._feasible_vessels
+    if self._invert:
+      return self._feasible_vessels.difference(changed_vessels)
+    return self._feasible_vessels.union(changed_vessels)
+
+
+def _different_location_type_parser(cursor, invert, parameters, acquired_vessels, vesselset):
   '''
   <Purpose>
     Group-Level Rule. Performs location type-based parsing for handles.
@@ -570,45 +1256,153 @@ def _different_location_type_parser(cursor, invert, parameters, acquired_vessels
         reached, each vessel in the group will be from a unique location.
         Expected Range: [1, Infinity)
     'location_type':
-        The kind of location that is differentiated. 'cities' or 'countries'.
+        The kind of location that is differentiated. 'city' or 'country_code'.
 
   '''
-  locations= set()
+  location_type = parameters['location_type']
+  node_ids = [node_id for (node_id, vesselname) in vesselset]
+  node_ids += [vesseldict['node_id'] for vesseldict in acquired_vessels]
+  locations = get_node_locations(cursor, node_ids)
+
   # Compile list of locations
+  acquired_locations = set()
   for vesseldict in acquired_vessels:
-    nodekey = vesseldict['handle'].split(':')[0]
-    query = """
-      SELECT """+parameters['location_type']+""" FROM
-        (SELECT ip_addr FROM nodes WHERE node_key='"""+nodekey+"""') AS node_row
-      LEFT JOIN location USING (ip_addr)"""
-    selexorhelper.autoretry_mysql_command(cursor, query)
-    locations.add(cursor.fetchone()[0])
-
-  query = parameters['location_type'] + " "
+    location = locations.get(vesseldict['node_id'], {}).get(location_type)
+    if location is not None:
+      acquired_locations.add(location)
 
   # If we have enough locations, we want vessels to only be from the
   # already acquired locations.
   # If we don't have enough locations, we want vesels to not be from
   # the already acquired locations.
+  exclude_acquired_locations = _should_exclude_acquired_locations(
+    invert, len(acquired_locations), parameters['location_count'])
 
+  good_vessels = []
+  for vessel in vesselset:
+    location = locations.get(vessel[0], {}).get(location_type)
+    # Vessels with unknown locations never pass this rule.
+    if location is None:
+      continue
+    if exclude_acquired_locations ^ (location in acquired_locations):
+      good_vessels.append(vessel)
+  return good_vessels
+
+
+def _should_exclude_acquired_locations(invert, num_locations, location_count):
+  '''
+  Returns True if vessels should come from locations other than the ones
+  already in the group, False if they should come from the same locations.
+
+  '''
   # Truth table:
   #                        |  Invert  | Dont invert
   # Not enough locations   |    IN    |   NOT IN
   # Enough Locations       |  NOT IN  |     IN
-  if ((not invert and len(locations) < parameters['location_count']) or
-      (invert and len(locations) == parameters['location_count'])):
-    query += 'NOT '
-  query += 'IN ("'+'", "'.join(locations)+'")'
-  query = """
-    SELECT node_id, vessel_name FROM
-      (SELECT node_id FROM
-        (SELECT ip_addr FROM location WHERE city NOT IN ("""+query+""")
-        ) as matching_locations LEFT JOIN nodes using (ip_addr)
-      ) as matching_nodes LEFT JOIN vessels USING (node_id)"""
-  logger.debug(query)
-  cursor.execute(query)
+  return ((not invert and num_locations < location_count) or
+          (invert and num_locations == location_count))
 
-  return cursor.fetchall()
+
+class _DifferentLocationTracker:
+  '''
+  Tracker for location_different.  Keeps count of how many vessels in the
+  group are from each location.  See the Usage section of the module
+  docstring for more information.
+
+  '''
+  def __init__(self, invert, parameters, vesselset, locations):
+    self._invert = invert
+    self._location_type = parameters['location_type']
+    self._location_count = parameters['location_count']
+    self._locations = locations
+
+    # location -> Candidates from that location
+    self._location_vessels = {}
+    for vessel in vesselset:
+      location = self.get_location(vessel[0])
+      # Vessels with unknown locations never pass this rule.
+      if location is not None:
+        self._location_vessels.setdefault(location, set()).add(vessel)
+
+    # location -> Number of vessels in the group from that location
+    self.location_counts = {}
+    # Candidates that are from / not from a location in location_counts
+    self._inside_vessels = set()
+    self._outside_vessels = set()
+    for vessels in self._location_vessels.values():
+      self._outside_vessels.update(vessels)
+
+
+  def get_location(self, node_id):
+    ''' Returns the location of the given node, or None if it is unknown. '''
+    return self._locations.get(node_id, {}).get(self._location_type)
+
+
+  def add_vessel(self, vesseldict):
+    location = self.get_location(vesseldict['node_id'])
+    if location is None:
+      return
+    self.location_counts[location] = self.location_counts.get(location, 0) + 1
+    if self.location_counts[location] == 1:
+      vessels = self._location_vessels.get(location, set())
+      self._inside_vessels.update(vessels)
+      self._outside_vessels.difference_update(vessels)
+
+
+  def remove_vessel(self, vesseldict):
+    location = self.get_location(vesseldict['node_id'])
+    if location is None:
+      return
+    self.location_counts[location] -= 1
+    if self.location_counts[location] == 0:
+      del self.location_counts[location]
+      vessels = self._location_vessels.get(location, set())
+      self._outside_vessels.update(vessels)
+      self._inside_vessels.difference_update(vessels)
+
+
+  def get_feasible_vessels(self):
+    if _should_exclude_acquired_locations(
+        self._invert, len(self.location_counts), self._location_count):
+      return self._outside_vessels
+    return self._inside_vessels
+
+
+  def get_signature(self, node_id):
+    return self.get_location(node_id)
+
+
+  def get_max_additional_vessels(self, unavailable_vessels):
+    if self._invert:
+      return None
+    # Until location_count locations are reached, each vessel has to come
+    # from a new location.  If there aren't enough new locations left, only
+    # one vessel can be added from each.
+    num_new_locations = 0
+    for location, vessels in self._location_vessels.iteritems():
+      if location not in self.location_counts:
+        for vessel in vessels:
+          if vessel not in unavailable_vessels:
+            num_new_locations += 1
+            break
+    if len(self.location_counts) + num_new_locations < self._location_count:
+      return num_new_locations
+    return None
+
+
+  def get_feasible_vessels_without(self, vesseldict):
+    ''' Returns the feasible vessels if the given vessel were removed. '''
+    location = self.get_location(vesseldict['node_id'])
+    # The set of locations only changes if this is the last vessel from its
+    # location.
+    if location is None or self.location_counts[location] > 1:
+      return self.get_feasible_vessels()
+
+    vessels = self._location_vessels.get(location, set())
+    if _should_exclude_acquired_locations(
+        self._invert, len(self.location_counts) - 1, self._location_count):
+      return self._outside_vessels.union(vessels)
+    return self._inside_vessels.difference(vessels)
 
 
 def _ip_change_count_parser(handleset, database, invert, parameters):
@@ -634,7 +1428,7 @@ def _ip_change_count_parser(handleset, database, invert, parameters):
   return good_handles
 
 
-def _node_type_parser(cursor, invert, parameters):
+def _node_type_parser(cursor, invert, parameters, vesselset):
   '''
   <Purpose>
     Vessel-Level Rule. Ensures that all vessels in the group are of the
@@ -660,12 +1454,22 @@ def _node_type_parser(cursor, invert, parameters):
       "SELECT node_id, vessel_name FROM vessels WHERE node_id IN "
       "(SELECT node_id FROM nodes WHERE node_type!='"+node_type+"')"
       )
+  node_condition = _get_node_condition(vesselset)
+  if node_condition is not None:
+    query += " AND " + node_condition
 
   selexorhelper.autoretry_mysql_command(cursor, query)
   return cursor.fetchall()
 
 
-def _port_parser(cursor, invert, parameters):
+def _node_type_sql_condition(invert, parameters):
+  ''' SQL condition callback for node_type. '''
+  if invert:
+    return ("nodes.node_type != %s", [parameters['node_type']])
+  return ("nodes.node_type = %s", [parameters['node_type']])
+
+
+def _port_parser(cursor, invert, parameters, vesselset):
   '''
   <Purpose>
     Vessel-Level Rule. Ensures that all vessels in the group have the specified port number.
@@ -682,16 +1486,32 @@ def _port_parser(cursor, invert, parameters):
     query = "SELECT node_id, vessel_name FROM vesselports WHERE port="+str(port)
   else:
     query = "SELECT node_id, vessel_name FROM vesselports WHERE port !="+str(port)
+  node_condition = _get_node_condition(vesselset)
+  if node_condition is not None:
+    query += " AND " + node_condition
   logger.debug(query)
   selexorhelper.autoretry_mysql_command(cursor, query)
   return cursor.fetchall()
 
 
+def _port_sql_condition(invert, parameters):
+  ''' SQL condition callback for port. '''
+  if invert:
+    comparison = "vesselports.port != %s"
+  else:
+    comparison = "vesselports.port = %s"
+  condition = ("""EXISTS (SELECT 1 FROM vesselports
+      WHERE vesselports.node_id = vessels.node_id
+      AND vesselports.vessel_name = vessels.vessel_name
+      AND """ + comparison + ")")
+  return (condition, [parameters['port']])
+
+
 
 
 
 
-def register_callback(rule_name, rule_type, acquire_callback, parameter_preprocess_callback = None):
+def register_callback(rule_name, rule_type, acquire_callback, parameter_preprocess_callback = None, tracker_class = None, sql_condition_callback = None):
   '''
   <Purpose>
     Registers the callback in the rule parser.
@@ -706,6 +1526,14 @@ def register_callback(rule_name, rule_type, acquire_callback, parameter_preproce
         optionally preprocess the parameter values if needed.
         Unless your rule only operates on strings, you will need to preprocess
         parameters.
+    tracker_class:
+        The class used to incrementally track the rule's state. This is only
+        used by group rules, and is optional.  See the Usage section of the
+        module docstring for more information.
+    sql_condition_callback:
+        The function that expresses the rule as an SQL condition.  This is
+        only used by vessel rules, and is optional.  See the Usage section
+        of the module docstring for more information.
 
   <Side Effects>
     Rules with the specified rule name will now use the specified callbacks.
@@ -727,6 +1555,10 @@ def register_callback(rule_name, rule_type, acquire_callback, parameter_preproce
   all_known_rules.add(rule_name)
   rule_callbacks[rule_type][rule_name] = acquire_callback
   parameter_preprocess_callbacks[rule_name] = parameter_preprocess_callback
+  if tracker_class is not None:
+    group_rule_trackers[rule_name] = tracker_class
+  if sql_condition_callback is not None:
+    rule_sql_conditions[rule_name] = sql_condition_callback
 
 
 def deregister_callback(rule_name):
@@ -759,6 +1591,8 @@ def deregister_callback(rule_name):
   for ruleset in rule_callbacks.values():
     if rule_name in ruleset:
       ruleset.pop(rule_name)
+      group_rule_trackers.pop(rule_name, None)
+      rule_sql_conditions.pop(rule_name, None)
       return
   raise selexorexceptions.SelexorInvalidOperation("Rule does not exist: ", rule_name)
 
@@ -768,12 +1602,12 @@ def _init():
   global logger
   logger = selexorhelper.setup_logging(__name__)
 
-  register_callback('location_specific', 'vessel', _specific_location_parser, _specific_location_preprocessor)
-  register_callback('location_separation_radius', 'group', _separation_radius_parser, _separation_radius_preprocessor)
-  register_callback('location_different', 'group', _different_location_type_parser, _different_location_preprocessor)
+  register_callback('location_specific', 'vessel', _specific_location_parser, _specific_location_preprocessor, sql_condition_callback=_specific_location_sql_condition)
+  register_callback('location_separation_radius', 'group', _separation_radius_parser, _separation_radius_preprocessor, _SeparationRadiusTracker)
+  register_callback('location_different', 'group', _different_location_type_parser, _different_location_preprocessor, _DifferentLocationTracker)
   register_callback('num_ip_change', 'vessel', _ip_change_count_parser, _ip_change_count_preprocessor)
-  register_callback('node_type', 'vessel', _node_type_parser, _node_type_preprocessor)
-  register_callback('port', 'vessel', _port_parser, _port_preprocessor)
+  register_callback('node_type', 'vessel', _node_type_parser, _node_type_preprocessor, sql_condition_callback=_node_type_sql_condition)
+  register_callback('port', 'vessel', _port_parser, _port_preprocessor, sql_condition_callback=_port_sql_condition)
 
 
 
@@ -0,0 +1,268 @@
+"""
+<Program Name>
+  selexorscheduler.py
+
+<Purpose>
+  Runs request resolutions on a fixed number of worker threads, so that a
+  burst of requests cannot create an unbounded number of threads, database
+  connections and clearinghouse clients.
+
+  Waiting requests are queued per owner (user identity), and the workers
+  take requests from the owners in round-robin order, so that a user who
+  submits many requests cannot starve everyone else.  Once
+  settings.max_queued_requests requests are waiting, new ones are refused.
+
+  Every waiting request is given a position_callback, which is called with
+  the request's new 1-based queue position whenever it changes.  The
+  callbacks are called without the scheduler's lock held.
+
+"""
+
+import threading
+import traceback
+
+import selexorexceptions
+import selexorhelper
+import settings
+
+
+logger = selexorhelper.setup_logging(__name__)
+
+
+class ResolutionScheduler:
+  def __init__(self, num_workers=None, max_queued=None):
+    '''
+    <Purpose>
+      Creates a scheduler and starts its worker threads.
+    <Arguments>
+      num_workers:
+        The number of requests to resolve at once.  Defaults to
+        settings.num_resolution_workers.
+      max_queued:
+        The maximum number of waiting requests.  Defaults to
+        settings.max_queued_requests.
+    <Exceptions>
+      None
+    <Side Effects>
+      Starts num_workers worker threads.
+    <Returns>
+      A ResolutionScheduler instance.
+
+    '''
+    if num_workers is None:
+      num_workers = settings.num_resolution_workers
+    if max_queued is None:
+      max_queued = settings.max_queued_requests
+    self._max_queued = max_queued
+    self._condition = threading.Condition()
+    self._running = True
+    # owner: [job], oldest first.  A job is a list in the form
+    # [function, args, position_callback, last reported position].
+    self._jobs_by_owner = {}
+    # The owners with waiting jobs, in the order they will be served.
+    self._owner_order = []
+    self._num_queued = 0
+
+    self._workers = []
+    for worker_no in range(num_workers):
+      worker = threading.Thread(target=self._work)
+      # Don't keep the process alive for requests that haven't started.
+      worker.daemon = True
+      self._workers.append(worker)
+      worker.start()
+
+
+  def submit(self, owner, function, args=(), position_callback=None):
+    '''
+    <Purpose>
+      Queues function(*args) to be run by a worker.
+    <Arguments>
+      owner:
+        The identity of the user the job belongs to.
+      function:
+        The function to run.
+      args:
+        The arguments to pass to function.
+      position_callback:
+        Called with the job's queue position whenever it changes, or None.
+    <Exceptions>
+      SelexorServerBusy if too many jobs are already waiting.
+    <Side Effects>
+      Calls the position callbacks of the waiting jobs.
+    <Returns>
+      The job's queue position.
+
+    '''
+    self._condition.acquire()
+    try:
+      if self._num_queued >= self._max_queued:
+        raise selexorexceptions.SelexorServerBusy(
+          "SeleXor is busy serving other requests. Please try again later.")
+      job = [function, args, position_callback, None]
+      if owner not in self._jobs_by_owner:
+        self._jobs_by_owner[owner] = []
+        self._owner_order.append(owner)
+      self._jobs_by_owner[owner].append(job)
+      self._num_queued += 1
+      position_updates = self._get_position_updates()
+      self._condition.notify()
+    finally:
+      self._condition.release()
+
+    self._report_positions(position_updates)
+    return job[3]
+
+
+  def get_num_queued(self):
+    ''' Returns the number of jobs that are waiting for a worker. '''
+    return self._num_queued
+
+
+  def cancel(self, owner, is_job):
+    '''
+    <Purpose>
+      Takes a job off the queue before a worker starts it.
+    <Arguments>
+      owner:
+        The identity of the user the job belongs to.
+      is_job:
+        Called with the args of each of owner's waiting jobs.  The first job
+        that it returns True for is cancelled.
+    <Exceptions>
+      None
+    <Side Effects>
+      Calls the position callbacks of the waiting jobs.
+    <Returns>
+      The args of the cancelled job, or None if no waiting job matched, such
+      as when a worker has already started it.
+
+    '''
+    self._condition.acquire()
+    try:
+      cancelled_job = None
+      for job in self._jobs_by_owner.get(owner, []):
+        if is_job(job[1]):
+          cancelled_job = job
+          break
+      if cancelled_job is None:
+        return None
+
+      jobs = self._jobs_by_owner[owner]
+      jobs.remove(cancelled_job)
+      if not jobs:
+        del self._jobs_by_owner[owner]
+        self._owner_order.remove(owner)
+      self._num_queued -= 1
+      position_updates = self._get_position_updates()
+    finally:
+      self._condition.release()
+
+    self._report_positions(position_updates)
+    return cancelled_job[1]
+
+
+  def stop(self):
+    '''
+    <Purpose>
+      Stops the workers once they finish their current jobs.  Jobs that are
+      still waiting are dropped.
+    <Arguments>
+      None
+    <Exceptions>
+      None
+    <Side Effects>
+      Wakes up every idle worker.
+    <Returns>
+      A list of the args of every dropped job, so that the caller can clean
+      up after them.
+
+    '''
+    self._condition.acquire()
+    try:
+      self._running = False
+      dropped_args = []
+      for owner in self._owner_order:
+        for job in self._jobs_by_owner[owner]:
+          dropped_args.append(job[1])
+      self._jobs_by_owner = {}
+      self._owner_order = []
+      self._num_queued = 0
+      self._condition.notifyAll()
+    finally:
+      self._condition.release()
+    return dropped_args
+
+
+  def _get_position_updates(self):
+    '''
+    Works out the position of every waiting job, as the workers will take
+    them in round-robin order between owners.  Returns a list of
+    (position_callback, position) for the jobs whose position changed.  The
+    caller must hold self._condition.
+
+    '''
+    position_updates = []
+    position = 0
+    round_no = 0
+    while position < self._num_queued:
+      for owner in self._owner_order:
+        jobs = self._jobs_by_owner[owner]
+        if round_no < len(jobs):
+          position += 1
+          job = jobs[round_no]
+          if job[3] != position:
+            job[3] = position
+            if job[2] is not None:
+              position_updates.append((job[2], position))
+      round_no += 1
+    return position_updates
+
+
+  def _report_positions(self, position_updates):
+    for position_callback, position in position_updates:
+      try:
+        position_callback(position)
+      except Exception:
+        logger.error("Error while reporting queue position\n" + traceback.format_exc())
+
+
+  def _get_next_job(self):
+    '''
+    Waits for a job, and takes it off the queue.  Returns None once the
+    scheduler is stopped.
+
+    '''
+    self._condition.acquire()
+    try:
+      while self._running and not self._owner_order:
+        self._condition.wait()
+      if not self._running:
+        return None
+
+      owner = self._owner_order.pop(0)
+      jobs = self._jobs_by_owner[owner]
+      job = jobs.pop(0)
+      # The owner goes to the back of the line for their next job.
+      if jobs:
+        self._owner_order.append(owner)
+      else:
+        del self._jobs_by_owner[owner]
+      self._num_queued -= 1
+      position_updates = self._get_position_updates()
+    finally:
+      self._condition.release()
+
+    self._report_positions(position_updates)
+    return job
+
+
+  def _work(self):
+    while True:
+      job = self._get_next_job()
+      if job is None:
+        return
+      function, args = job[0], job[1]
+      try:
+        function(*args)
+      except Exception:
+        logger.error("Unhandled error while resolving a request\n" + traceback.format_exc())
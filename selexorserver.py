@@ -13,7 +13,10 @@
   Implements the server for SeleXor.
 
   identity:
-    A unique identifier for each user. It is a tuple in the form: (username, IP)
+    A (username, remoteip, request_id) tuple that identifies a request.
+    Users may have several requests at the same time, each with its own
+    request_id.  Requests are only served to the IP address they were made
+    from.
 
   authdict:
     A dictionary used to store authentication information.
@@ -35,10 +38,20 @@
                     solve it.
         'working': The request is valid, an SeleXor is currently resolving it.
         'complete': The request is fully resolved.
+        'cancelled': The user cancelled the request before it was resolved.
+                     Groups keep the vessels acquired so far, unless the
+                     user asked for them to be released.
+        'timeout': The request's deadline passed before it was resolved.
+                   Groups keep the vessels acquired so far, unless the user
+                   asked for them to be released.
         'unknown': This is an unknown request. Serverside requestdicts will
                    never have this status. This status is returned to clients
                    if they are requesting a requestdict that the server does
                    not know about.
+    'deadline': Optional.  The time after which resolution stops.
+    'cancel_requested': Set once the user cancels the request.
+    'release_on_stop': Whether the vessels acquired so far are released if
+                       the request is cancelled or runs out of time.
 
   groupdict:
     Represents a group. It contains the following:
@@ -48,6 +61,12 @@
     'allocate': The total number of vessels to acquire.
     'status': The current request status of the group. See groupstatus.
     'error': This flag only exists when an error occurs.
+    'version': The request version at which the group last changed.
+    'removed': A list of dictionaries containing the 'handle' and 'version'
+               of each vessel that was released from the group.
+  Vesseldicts in 'acquired' also contain the 'version' at which they were
+  added, so that clients can be sent only what changed since the version
+  they last saw.
 
   groupstatus:
     A string indicating a group's current status.
@@ -80,14 +99,24 @@
 
 import seattleclearinghouse_xmlrpc
 import copy
+import itertools
+import math
 import selexorruleparser
 import selexorhelper
-import random
+import selexornodecache
+import selexorrequeststore
+import selexorreservation
+import selexorreliability
+import selexorscheduler
+import selexorsolver
+import selexortrace
 import fastnmclient
 import threading
+import time
 import traceback
+import uuid
+import Queue
 import selexorexceptions
-import MySQLdb
 import settings
 
 import repyhelper
@@ -97,14 +126,25 @@ repyhelper.translate_and_import('rsa.repy')
 logger = selexorhelper.setup_logging(__name__)
 
 
-# Contains information about all requests.
-# (username, ip): {
+# The format of a requestdict.  Requests are kept in the server's
+# RequestStore, keyed by identity.
+# (username, ip, request_id): {
 #   'status': (string) The current status of this request.
+#   'queue_position': (int) The request's place in line, while it is 'queued'.
 #   'groups': ([node]) Dicts of all groups in request, with group ID as the key
 #   'tree': ([node]) Group tree for this request,
 #   'expiretime': (float) The time to consider this entry as void.
+#   'version': (int) Changes every time the request changes.
+#   'first_version': (int) The version the request was created with.
+#   'resume_needed': (bool) Set if the request was interrupted by a restart.
 #   }
-request_datum = {}
+
+# How much weight each acquisition has on the smoothed acquisition failure rate.
+ACQUISITION_FAILURE_SMOOTHING = 0.2
+
+# Versions are drawn from a single counter, so that two different requests
+# never share a version.
+_request_version_counter = itertools.count(1)
 
 
 # This indicates the maximum number of times we should attempt to resolve each
@@ -137,6 +177,50 @@ class SelexorServer:
     '''
     self._accepting_requests = True
     self._running = True
+    # Translates between node_ids, node_keys and node addresses.
+    self._node_cache = selexornodecache.NodeIdentityCache()
+    # Keeps concurrent resolutions from picking the same vessels.
+    self._vessel_leases = selexorreservation.create_vessel_leases()
+    # Decides how many extra candidates to pick for each group.
+    self._acquisition_statistics = _AcquisitionStatistics()
+    # Decides which candidates to pick, based on earlier acquisitions.
+    self._reliability = selexorreliability.VesselReliability()
+    # Runs the accepted requests on a fixed number of threads.
+    self._scheduler = selexorscheduler.ResolutionScheduler()
+    # The requestdicts of all requests, keyed by identity.
+    self._requests = selexorrequeststore.RequestStore()
+    # (username, remoteip): [request_id], oldest first.  Requests that are
+    # not addressed by ID refer to the user's most recent request.
+    self._request_ids_by_user = {}
+    self._request_ids_lock = threading.Lock()
+    self._restore_loaded_requests()
+
+
+  def _restore_loaded_requests(self):
+    '''
+    Catches up with the requests that the request store loaded from the
+    database: versions continue from the highest version they were saved
+    with, so that clients that saw them keep getting deltas, and each user's
+    most recent request can be found again without its ID.
+
+    '''
+    # (first version, key) of every request
+    loaded_requests = []
+    max_version = 0
+    for key, request_data in self._requests.get_items():
+      max_version = max(max_version, request_data.get('version', 0))
+      # Requests saved before they had IDs can't be addressed any more.
+      if len(key) == 3:
+        loaded_requests.append((request_data.get('first_version', 0), key))
+    _advance_request_versions(max_version)
+
+    loaded_requests.sort()
+    self._request_ids_lock.acquire()
+    try:
+      for first_version, (username, remoteip, request_id) in loaded_requests:
+        self._request_ids_by_user.setdefault((username, remoteip), []).append(request_id)
+    finally:
+      self._request_ids_lock.release()
 
 
 
@@ -151,6 +235,8 @@ class SelexorServer:
       Tells the logging utility to terminate.
       Stops accepting requests.
       Stops parsing requests.
+      Requests that are still queued are marked to be resumed, and saved if
+      settings.persist_request_state is set.
     <Exceptions>
       None
     <Return>
@@ -159,12 +245,100 @@ class SelexorServer:
     '''
     self._accepting_requests = False
     self._running = False
+    for identity, request_data, client, authinfo in self._scheduler.stop():
+      self._interrupt_queued_request(identity, request_data, client)
 
+    if settings.persist_request_state:
+      # Save the interrupted requests now, rather than waiting for the
+      # next periodic save that may never come.
+      db = None
+      try:
+        db, cursor = selexorhelper.connect_to_db()
+        self._requests.persist(cursor)
+        db.commit()
+      except Exception:
+        logger.error("Could not save requests while shutting down\n" + traceback.format_exc())
+      finally:
+        if db is not None:
+          db.close()
 
-  def release_vessels(self, authdata, vessels_to_release, remoteip):
+
+  def _get_request_identity(self, authinfo, remoteip, request_id):
+    '''
+    Returns the identity of the given request of a user.  If request_id is
+    None, the user's most recent request is used.  Returns None if the user
+    has not made any requests.
+
+    '''
+    username = authinfo.keys()[0]
+    if request_id is None:
+      self._request_ids_lock.acquire()
+      try:
+        request_ids = self._request_ids_by_user.get((username, remoteip))
+        if not request_ids:
+          return None
+        request_id = request_ids[-1]
+      finally:
+        self._request_ids_lock.release()
+    return (username, remoteip, str(request_id))
+
+
+  def _add_request_id(self, username, remoteip):
+    '''
+    <Purpose>
+      Picks the ID of a new request.
+    <Arguments>
+      username:
+        The user making the request.
+      remoteip:
+        The remote IP address of the client.
+    <Exceptions>
+      SelexorServerBusy if the user already has
+      settings.max_active_requests_per_user requests that are being served.
+    <Side Effects>
+      Forgets the IDs of requests that are no longer stored.
+    <Returns>
+      The new request ID, as a string.
+
+    '''
+    user = (username, remoteip)
+    self._request_ids_lock.acquire()
+    try:
+      request_ids = []
+      num_active = 0
+      for request_id in self._request_ids_by_user.get(user, []):
+        request_data = self._requests.get(user + (request_id,))
+        if request_data is None:
+          continue
+        request_ids.append(request_id)
+        if request_data.get('status') in selexorrequeststore.ACTIVE_STATUSES:
+          num_active += 1
+      if num_active >= settings.max_active_requests_per_user:
+        raise selexorexceptions.SelexorServerBusy("You already have " +
+          str(num_active) + " requests in progress.  Please wait for one of them to finish.")
+
+      request_id = uuid.uuid4().hex
+      request_ids.append(request_id)
+      self._request_ids_by_user[user] = request_ids
+
+      # Users that stop making requests are only forgotten here.
+      if len(self._request_ids_by_user) > settings.max_finished_requests:
+        for other_user, other_request_ids in self._request_ids_by_user.items():
+          if not [other_request_id for other_request_id in other_request_ids
+              if self._requests.get(other_user + (other_request_id,)) is not None]:
+            del self._request_ids_by_user[other_user]
+      return request_id
+    finally:
+      self._request_ids_lock.release()
+
+
+  def release_vessels(self, authdata, vessels_to_release, remoteip, request_id=None):
     '''
     <Purpose>
-      Returns the # of vessels released
+      Releases the given vessels.  The handles of vessels given by location
+      are looked up together in the database, and the nodemanagers of nodes
+      that aren't in the database are contacted in parallel.  The vessels are
+      then released in chunks of settings.release_batch_size.
     <Arguments>
       authdata:
         An authdict. See module documentation for more information.
@@ -174,134 +348,472 @@ class SelexorServer:
         or node_ip:node_port:vesselname.
       remoteip:
         The remote IP address of the client. This is used for client identification.
+      request_id:
+        The ID of the request that the vessels are removed from.  Defaults
+        to the user's most recent request.
     <Exceptions>
       None
     <Side Effects>
       None
     <Return>
-      A dictionary containing the status of each group.
-      'group_id': 'group_status'
+      On success, (True, number of vessels released, vessels that could not
+      be released).  The vessels that could not be released are a list of
+      the dictionaries that were passed in.
+      On failure, (False, error message).
 
     '''
+    identity = None
     try:
-      username = authdata.keys()[0]
-      identity = (username, remoteip)
+      identity = self._get_request_identity(authdata, remoteip, request_id)
       logger.info(str(identity) + "> Release: " + str(vessels_to_release))
 
       # There's nothing to do if there aren't any vessels to release
       if not vessels_to_release:
-        return 0
+        return (True, 0, [])
 
-      handles_of_vessels_to_release = []
+      # vesselhandle: [vesseldicts given for that vessel]
+      vesseldicts_by_handle = {}
+      vesseldicts_to_look_up = []
+      failed_vesseldicts = []
       for vesseldict in vessels_to_release:
-        if 'node_handle' in vesseldict:
-          handles_of_vessels_to_release.append(vesseldict['node_handle'])
+        vesselhandle = vesseldict.get('handle', vesseldict.get('node_handle'))
+        if vesselhandle:
+          vesseldicts_by_handle.setdefault(vesselhandle, []).append(vesseldict)
         else:
-          # Do we have this information in the database?
-          db, cursor = selexorhelper.connect_to_db()
-
-          # If it is found, the lookup returns a 1L.
-          node_in_db = 1L == cursor.execute("SELECT node_key FROM nodes WHERE ip_addr='"+vesseldict['node_ip']+"' AND node_port="+str(vesseldict['node_port']))
-          if node_in_db:
-            [node_key] = cursor.fetchone()
-            logger.debug('\n'.join([
-                str(identity),
-                "Found node in database: "+vesseldict['node_ip']+':'+str(int(vesseldict['node_port']))+':'+vesseldict['vesselname']+" with key:",
-                node_key]))
-            handles_of_vessels_to_release.append(node_key+':'+vesseldict['vesselname'])
+          vesseldicts_to_look_up.append(vesseldict)
 
+      if vesseldicts_to_look_up:
+        # Do we have this information in the database?
+        db, cursor = selexorhelper.connect_to_db()
+        try:
+          nodeinfos = self._node_cache.get_nodeinfos_by_address(cursor,
+            [(vesseldict['node_ip'], vesseldict['node_port']) for vesseldict in vesseldicts_to_look_up])
+        finally:
+          db.close()
+
+        # nodehandle: [vesseldicts given for that vessel]
+        vesseldicts_by_nodehandle = {}
+        for vesseldict in vesseldicts_to_look_up:
+          address = (vesseldict['node_ip'], int(vesseldict['node_port']))
+          if address in nodeinfos:
+            vesselhandle = nodeinfos[address][1] + ':' + vesseldict['vesselname']
+            vesseldicts_by_handle.setdefault(vesselhandle, []).append(vesseldict)
           else:
-            # Try to connect to that node to get the handle
-            vessel_location = vesseldict['node_ip']+':'+str(int(vesseldict['node_port']))+':'+vesseldict['vesselname']
-            try:
-              handles_of_vessels_to_release.append(get_handle_from_nodehandle(vessel_location))
-            except fastnmclient.NMClientException, e:
-              logger.info("Failed to look up vessel "+vessel_location+' through nodemanager: '+ str(e))
-
-      client = selexorhelper.connect_to_clearinghouse(authdata)
-
-      # Release the remaining vessels
-      for vessel in handles_of_vessels_to_release:
-        # Do we need to check if a vessel failed to release?
-        # Maybe it means that a vessel has gone offline/is now invalid.
-        client.release_resources([vessel])
+            nodehandle = address[0] + ':' + str(address[1]) + ':' + vesseldict['vesselname']
+            vesseldicts_by_nodehandle.setdefault(nodehandle, []).append(vesseldict)
+
+        # Try to connect to the remaining nodes to get the handles
+        handles, lookup_errors = get_handles_from_nodehandles(vesseldicts_by_nodehandle.keys())
+        for nodehandle, vesseldicts in vesseldicts_by_nodehandle.iteritems():
+          if nodehandle in handles:
+            vesseldicts_by_handle.setdefault(handles[nodehandle], []).extend(vesseldicts)
+          else:
+            logger.info(str(identity) + ": Failed to look up vessel " + nodehandle +
+              " through nodemanager: " + lookup_errors[nodehandle])
+            failed_vesseldicts.extend(vesseldicts)
 
-      # Assume all the vessels were released successfully
-      num_released = len(handles_of_vessels_to_release)
+      released_handles = []
+      client = selexorhelper.clearinghouse_sessions.checkout(authdata)
+      try:
+        handles_to_release = vesseldicts_by_handle.keys()
+        for chunk_start in range(0, len(handles_to_release), settings.release_batch_size):
+          chunk = handles_to_release[chunk_start:chunk_start + settings.release_batch_size]
+          try:
+            client.release_resources(chunk)
+            released_handles += chunk
+            continue
+          except Exception, e:
+            logger.info(str(identity) + ": Failed to release " + str(len(chunk)) +
+              " vessel(s) together, releasing them one at a time: " + str(e))
+
+          # Find out which of the vessels can't be released
+          for vesselhandle in chunk:
+            try:
+              client.release_resources([vesselhandle])
+              released_handles.append(vesselhandle)
+            except Exception, e:
+              logger.info(str(identity) + ": Failed to release " + vesselhandle + ": " + str(e))
+              failed_vesseldicts.extend(vesseldicts_by_handle[vesselhandle])
+      finally:
+        selexorhelper.clearinghouse_sessions.checkin(client)
+
+      num_released = len(released_handles)
+
+      # Let other resolutions pick the released vessels again.
+      db, cursor = selexorhelper.connect_to_db()
+      try:
+        nodeinfos = self._node_cache.get_nodeinfos_by_node_key(cursor,
+          [vesselhandle.split(':')[0] for vesselhandle in released_handles])
+      finally:
+        db.close()
+      for vesselhandle in released_handles:
+        node_key, vesselname = vesselhandle.split(':')
+        if node_key in nodeinfos:
+          self._vessel_leases.release((nodeinfos[node_key][0], vesselname))
 
       # Remove vessel entries from the groups tables.
-      if identity in request_datum:
-        for group in request_datum[identity]['groups']:
-          for vesselhandle in handles_of_vessels_to_release:
-            if vesselhandle in request_datum[identity]['groups'][group]['acquired']:
-              request_datum[identity]['groups'][group]['acquired'].remove(vesselhandle)
-              request_datum[identity]['groups'][group]['allocate'] -= 1
+      request_data = None
+      if identity is not None:
+        request_data = self._requests.get(identity)
+      if request_data is not None and 'groups' in request_data:
+        released_handles = set(released_handles)
+        lock = self._requests.get_lock(identity)
+        lock.acquire()
+        try:
+          changed_groups = []
+          for group in request_data['groups'].itervalues():
+            still_acquired = [vesseldict for vesseldict in group['acquired']
+              if vesseldict['handle'] not in released_handles]
+            if len(still_acquired) == len(group['acquired']):
+              continue
+            for vesseldict in group['acquired']:
+              if vesseldict['handle'] in released_handles:
+                group.setdefault('removed', []).append({'handle': vesseldict['handle']})
+            group['allocate'] -= len(group['acquired']) - len(still_acquired)
+            group['acquired'] = still_acquired
+            changed_groups.append(group)
+          self._mark_changed(identity, request_data, changed_groups)
+        finally:
+          lock.release()
 
     except Exception, e:
       logger.error(str(identity) +': Unknown error while releasing vessels\n' + traceback.format_exc())
       return (False, "Internal error occurred.")
 
-    logger.info(str(identity) +': Successfully released ' + str(len(handles_of_vessels_to_release)) + ' vessel(s)')
-    return (True, num_released)
+    logger.info(str(identity) +': Successfully released ' + str(num_released) + ' vessel(s), ' +
+      str(len(failed_vesseldicts)) + ' failed')
+    return (True, num_released, failed_vesseldicts)
 
 
-  def get_request_status(self, authinfo, remoteip):
+  def cancel_request(self, authinfo, remoteip, request_id=None, release=False):
     '''
     <Purpose>
-      Returns the status of the current request.
+      Cancels a request that is still being served.  Resolution stops before
+      the next call to the clearinghouse, and groups keep the vessels that
+      were acquired so far.
     <Arguments>
+      authinfo:
+        An authdict. See module documentation for more information.
+      remoteip:
+        The remote IP address of the client.
+      request_id:
+        The ID of the request.  Defaults to the user's most recent request.
+      release:
+        If True, the vessels acquired so far are released once resolution
+        stops.
+    <Exceptions>
       None
+    <Side Effects>
+      Marks the request as cancelled.  Requests that are still waiting for a
+      worker, or that were interrupted by a restart, are finished straight
+      away.
+    <Return>
+      The status of the request, as returned by get_request_status().
+
+    '''
+    identity = None
+    try:
+      identity = self._get_request_identity(authinfo, remoteip, request_id)
+      request_data = None
+      if identity is not None:
+        request_data = self._requests.get(identity)
+      if request_data is not None:
+        lock = self._requests.get_lock(identity)
+        lock.acquire()
+        try:
+          # Finished requests can't be cancelled anymore.
+          cancelled = request_data.get('status') in selexorrequeststore.ACTIVE_STATUSES
+          was_interrupted = False
+          if cancelled:
+            request_data['cancel_requested'] = True
+            request_data['release_on_stop'] = bool(release)
+            # Nothing is serving a request that was interrupted by a restart.
+            was_interrupted = request_data.pop('resume_needed', False)
+            self._mark_changed(identity, request_data)
+        finally:
+          lock.release()
+        if cancelled:
+          logger.info(str(identity) + ": Request cancelled")
+
+        if was_interrupted:
+          self._finish_stopped_request(identity, request_data, authinfo)
+        elif cancelled:
+          # Queued requests would otherwise stay queued until a worker takes
+          # them, still holding their session and counting towards the
+          # user's active requests.
+          job_args = self._scheduler.cancel(identity[:2],
+            lambda job_args: job_args[0] == identity)
+          if job_args is not None:
+            selexorhelper.clearinghouse_sessions.checkin(job_args[2])
+            self._finish_stopped_request(identity, request_data, authinfo)
+    except Exception, e:
+      logger.error(str(identity) + ": Error while cancelling request\n" + traceback.format_exc())
+
+    if identity is not None:
+      request_id = identity[2]
+    return self.get_request_status(authinfo, remoteip, request_id=request_id)
+
+
+  def get_request_version(self, authinfo, remoteip, request_id=None):
+    '''
+    <Purpose>
+      Returns the version of the given request.  The version changes every
+      time the request's status changes, so status responses can be reused
+      for as long as the version stays the same.
+    <Arguments>
+      authinfo:
+        An authdict. See module documentation for more information.
+      remoteip:
+        The remote IP address of the client.
+      request_id:
+        The ID of the request.  Defaults to the user's most recent request.
     <Exceptions>
       None
     <Side Effects>
       None
     <Return>
-      A dictionary containing the status of each group.
-      'group_id': 'group_status'
+      The version of the request, or None if there is no request.
 
     '''
-    db, cursor = selexorhelper.connect_to_db()
+    identity = self._get_request_identity(authinfo, remoteip, request_id)
+    if identity is None:
+      return None
+    request_data = self._requests.get(identity)
+    if request_data is None:
+      return None
+    return request_data.get('version')
 
-    cursor = db.cursor()
 
+  def wait_for_request_change(self, authinfo, remoteip, known_version, timeout, request_id=None):
+    '''
+    <Purpose>
+      Waits until the version of the current request is different from the
+      one the client already knows about.
+    <Arguments>
+      authinfo:
+        An authdict. See module documentation for more information.
+      remoteip:
+        The remote IP address of the client.
+      known_version:
+        The version of the request that the client has seen.
+      timeout:
+        The maximum number of seconds to wait for.
+      request_id:
+        The ID of the request.  Defaults to the user's most recent request.
+    <Exceptions>
+      None
+    <Side Effects>
+      Blocks the calling thread.
+    <Return>
+      The current version of the request, or None if there is no request.
+
+    '''
+    deadline = time.time() + timeout
+    while True:
+      identity = self._get_request_identity(authinfo, remoteip, request_id)
+      if identity is None:
+        return None
+      version = self._requests.wait_for_change(identity, known_version, deadline - time.time())
+      # Without a request ID, the client follows the user's most recent
+      # request, which may have been replaced while it waited.
+      if version != known_version or version is None or time.time() >= deadline:
+        return version
+
+
+  def get_request_status(self, authinfo, remoteip, since_version=None, request_id=None):
+    '''
+    <Purpose>
+      Returns the status of the current request.  This is built from the
+      request state alone, and does not access the database.
+    <Arguments>
+      authinfo:
+        An authdict. See module documentation for more information.
+      remoteip:
+        The remote IP address of the client.
+      since_version:
+        The version of the request that the client last saw, or None.  If
+        the client saw an earlier version of the current request, only what
+        changed since then is returned.
+      request_id:
+        The ID of the request.  Defaults to the user's most recent request.
+    <Exceptions>
+      None
+    <Side Effects>
+      Resumes the request if it was interrupted by a restart.
+    <Return>
+      A dictionary containing the status of each group.
+      'group_id': 'group_status'
+      'request_id' holds the ID of the request.
+      If 'delta' is set, 'groups' only contains the groups that changed
+      since since_version.  Their 'vessels_acquired' only contains the
+      vessels added since then, and their 'vessels_removed' lists the
+      handles of the vessels released since then.
+
+    '''
     data = {'groups':{}}
+    identity = None
     try:
-      username = authinfo.keys()[0]
-      identity = (username, remoteip)
-      if identity not in request_datum:
+      identity = self._get_request_identity(authinfo, remoteip, request_id)
+      request_data = None
+      if identity is not None:
+        data['request_id'] = identity[2]
+        request_data = self._requests.get(identity)
+      if request_data is None:
         data['status'] = "unknown"
         return data
 
-      request_data = request_datum[identity]
-
-      data['status'] = request_data['status']
-      for group in request_data['groups'].values():
-        data['groups'][group['id']] = {}
-        group_data = data['groups'][group['id']]
-        group_data['status'] = group['status']
-        if 'error' in group:
-          group_data['error'] = group['error']
-
-        group_data['vessels_acquired'] = []
-        for vesseldict in group['acquired']:
-          vesselhandle = vesseldict['handle']
-          nodeinfo = {}
-
-          nodekey, nodeinfo['vesselname'] = vesselhandle.split(':')
-          cursor.execute('SELECT ip_addr, node_port FROM nodes WHERE node_key="'+nodekey+'"')
-          nodeinfo['node_ip'], nodeinfo['node_port'] = cursor.fetchone()
-          nodeinfo['handle'] = vesselhandle
-
-          group_data['vessels_acquired'].append(nodeinfo)
+      if request_data.get('resume_needed'):
+        self._resume_request(identity, request_data, authinfo)
 
-        group_data['target_num_vessels'] = group['allocate']
+      lock = self._requests.get_lock(identity)
+      lock.acquire()
+      try:
+        self._fill_request_status(data, request_data, since_version)
+      finally:
+        lock.release()
     except Exception, e:
       logger.error(str(identity) + ": Error while responding to status query\n" + traceback.format_exc())
       data['error'] = str(e)
     return data
 
 
-  def resolve_node(self, identity, client, node, db, cursor):
+  def _fill_request_status(self, data, request_data, since_version=None):
+    '''
+    Adds the status of the given requestdict to a status response.  See
+    get_request_status() for more information.
+
+    '''
+    # Responses to clients that saw a different request, or a version that
+    # this request never had, must be complete.
+    if ('first_version' not in request_data or since_version < request_data['first_version'] or
+        since_version > request_data['version']):
+      since_version = None
+    if since_version is not None:
+      data['delta'] = True
+
+    data['status'] = request_data['status']
+    if request_data['status'] == 'queued':
+      data['queue_position'] = request_data['queue_position']
+    if 'error' in request_data:
+      data['error'] = request_data['error']
+    for group in request_data['groups'].values():
+      if since_version is not None and group['version'] <= since_version:
+        continue
+      data['groups'][group['id']] = {}
+      group_data = data['groups'][group['id']]
+      group_data['status'] = group['status']
+      if 'error' in group:
+        group_data['error'] = group['error']
+
+      group_data['vessels_acquired'] = []
+      for vesseldict in group['acquired']:
+        if since_version is not None and vesseldict['version'] <= since_version:
+          continue
+        group_data['vessels_acquired'].append({
+          'node_ip': vesseldict['node_ip'],
+          'node_port': vesseldict['node_port'],
+          'vesselname': vesseldict['vessel_name'],
+          'handle': vesseldict['handle'],
+        })
+
+      group_data['target_num_vessels'] = group['allocate']
+      if since_version is not None:
+        group_data['vessels_removed'] = []
+        for removed_vessel in group.get('removed', []):
+          if removed_vessel['version'] > since_version:
+            group_data['vessels_removed'].append(removed_vessel['handle'])
+
+
+  def explain_request(self, authinfo, request, remoteip):
+    '''
+    <Purpose>
+      Works out how well a host request could be served right now, without
+      acquiring anything.  The vessel rules of each group are applied one at
+      a time, and the group rules are checked by searching for a complete
+      group.
+    <Arguments>
+      authinfo:
+        An authdict. See module documentation for more information.
+      request:
+        A host request, in the same format as for handle_request().
+      remoteip:
+        The remote IP address of the client.
+    <Exceptions>
+      None
+    <Side Effects>
+      None
+    <Return>
+      A dictionary containing 'groups', which maps each group ID to a
+      dictionary with the following keys:
+        'target_num_vessels': The number of vessels requested.
+        'rules': A list of dictionaries, one per vessel rule in the order
+          they were applied, each containing 'rule' (the rule name),
+          'candidates' (the number of candidates left after the rule) and
+          'time' (the number of seconds the rule took).  If the group has
+          group rules, they are followed by a single entry whose 'rule' is
+          'group_rules', containing 'group_rules' (their names) and 'time'
+          (the number of seconds spent checking them together).
+        'candidates': The number of vessels that satisfy the vessel rules.
+        'feasibility': 'feasible', 'infeasible', or 'unknown' if this could
+          not be worked out within settings.explain_solver_time_budget.
+        'error': Only present if the group's rules are invalid.
+
+    '''
+    identity = (authinfo.keys()[0], remoteip)
+    request_data = self._validate_request(identity, request)
+    explanation = {'groups': {}}
+
+    db, cursor = selexorhelper.connect_to_db()
+    try:
+      # Vessels that are being picked by resolutions can't be counted on.
+      all_vessels = (selexorruleparser.get_vessel_candidates({}, cursor) -
+        self._vessel_leases.get_leased_vessels(''))
+
+      for group in request_data['groups'].itervalues():
+        group_explanation = {'target_num_vessels': group['allocate'], 'rules': []}
+        explanation['groups'][group['id']] = group_explanation
+        if 'error' in group:
+          group_explanation['error'] = group['error']
+          continue
+
+        candidates = all_vessels
+        # Rules are listed in the order they would be applied in.
+        for rule_name in selexorruleparser.order_rules(group['rules'], 'vessel'):
+          start_time = time.time()
+          candidates = selexorruleparser.apply_vessel_rules(
+            {rule_name: group['rules'][rule_name]}, cursor, candidates)
+          group_explanation['rules'].append({
+            'rule': rule_name,
+            'candidates': len(candidates),
+            'time': time.time() - start_time})
+        group_explanation['candidates'] = len(candidates)
+
+        start_time = time.time()
+        group_state = selexorruleparser.GroupRuleState(group['rules'], cursor, candidates)
+        outcome, solution = selexorsolver.solve(group_state, group['allocate'],
+          time_budget=settings.explain_solver_time_budget)
+        # Group rules limit which candidates can be picked together rather
+        # than which vessels are candidates, so the solver checks them
+        # together and they are reported as one entry.
+        group_rule_names = selexorruleparser.order_rules(group['rules'], 'group')
+        if group_rule_names:
+          group_explanation['rules'].append({
+            'rule': 'group_rules',
+            'group_rules': group_rule_names,
+            'time': time.time() - start_time})
+
+        group_explanation['feasibility'] = {
+          selexorsolver.SOLVED: 'feasible',
+          selexorsolver.INFEASIBLE: 'infeasible',
+          selexorsolver.TIMED_OUT: 'unknown'}[outcome]
+    finally:
+      db.close()
+
+    logger.info(str(identity) + ": Explained request: " + str(explanation))
+    return explanation
+
+
+  def resolve_node(self, identity, client, node, db, cursor, reservations, should_stop=None):
 
     # We should never run into these...
     if node['status'] == STATUS_RESOLVED:
@@ -315,127 +827,292 @@ class SelexorServer:
     vessels_to_acquire = []
     remaining = node['allocate'] - len(node['acquired'])
 
-    selexorhelper.autoretry_mysql_command(cursor, "SELECT node_id, vessel_name FROM vessels WHERE acquirable")
-    all_vessels = cursor.fetchall()
-
     # Get vessels that match the vessel rules
-    handles_vesselrulematch = selexorruleparser.apply_vessel_rules(node['rules'], cursor, all_vessels)
+    with selexortrace.span('vessel_candidates') as candidates_span:
+      handles_vesselrulematch = selexorruleparser.get_vessel_candidates(node['rules'], cursor)
+      candidates_span.set(num_candidates=len(handles_vesselrulematch))
     logger.info(str(identity) + ": Vessel-level matches: " + str(len(handles_vesselrulematch)))
 
+    # Make sure that the node_key of every candidate can be looked up in
+    # memory.  Nodes missing from the cache are fetched in bulk.
+    nodeinfos = self._node_cache.get_nodeinfos_by_node_id(
+        cursor, [node_id for (node_id, vesselname) in handles_vesselrulematch])
+
     # The number of times we tried to resolve this group in the current attempt
     in_group_retry_count = 0
     MAX_IN_GROUP_RETRIES = 3
 
     candidate_vessels = []
 
-    while len(candidate_vessels) < remaining and \
-          in_group_retry_count < MAX_IN_GROUP_RETRIES:
-
-      if not self._running:
-        # Stop if we receive a quit message
-        break
-
-      if node['pass'] >= MAX_PASSES_PER_NODE:
-        raise selexorexceptions.SelexorInternalError("Performing more passes than max pass!")
-
-      handles_grouprulematch = selexorruleparser.apply_group_rules(
-          cursor = cursor,
-          acquired_vessels = candidate_vessels,
-          rules = node['rules'],
-          vesselset = handles_vesselrulematch)
-
-      # Pick any vessel.
-      vessellist = list(handles_grouprulematch)
-      if vessellist:
-        logger.info(str(identity) + ": Candidates for next vessel: " + str(len(vessellist)))
-        # If we run out of handles, we simply get another random one, instead of
-        # programming a special case.
-        node_id, vesselname = random.choice(vessellist)
-        vessellist.remove((node_id, vesselname))
-
-        selexorhelper.autoretry_mysql_command(cursor, 'SELECT node_key FROM nodes WHERE node_id='+str(node_id))
-        nodekey = cursor.fetchone()[0]
-        handle = nodekey + ':' + vesselname
-        logger.info(str(identity)+":\n"+"Considering: "+str(handle))
-
-        # node_id and vessel_name are used extensively by rule parsers
-        # We should include them here to prevent each rule from looking the up
-        vessel_dict = {
-          'handle': handle,
-          'node_id': node_id,
-          'node_key': nodekey,
-          'vessel_name': vesselname,
-        }
-        candidate_vessels.append(vessel_dict)
-
-      # We ran out of vessels to check
-      else:
-        logger.info(str(identity) + ": Can't find any suitable vessels!")
-        in_group_retry_count += 1
+    # Ask for more vessels than we need, to make up for the ones that the
+    # clearinghouse will not give us.
+    num_candidates_wanted = self._acquisition_statistics.get_num_candidates(remaining)
+
+    # Vessels that are leased by other resolutions, or that recently failed
+    # to be acquired.  This is only looked up once per pass; vessels leased
+    # after that are found when we try to reserve them.
+    unavailable_vessels = (reservations.get_vessels_leased_by_others() |
+        self._reliability.get_failed_vessels())
+
+    # Vessels acquired on previous passes are already part of the group, so
+    # they must be taken into account by the group rules.
+    with selexortrace.span('group_rule_state'):
+      group_state = selexorruleparser.GroupRuleState(
+          node['rules'], cursor, handles_vesselrulematch, node['acquired'])
+
+    # Look for a complete group in memory first, so that the vessels we ask
+    # the clearinghouse for are known to satisfy the group rules together.
+    # If the search runs out of time, vessels are picked one at a time below.
+    with selexortrace.span('solve', num_needed=remaining) as solve_span:
+      outcome, solution = selexorsolver.solve(group_state, remaining,
+          reservations.get_reserved_vessels() | unavailable_vessels,
+          choose_vessel=self._reliability.choose)
+      solve_span.set(outcome=outcome)
+    logger.info(str(identity) + ": Searched for a complete group: " + outcome)
+    if outcome == selexorsolver.INFEASIBLE and not (group_state.vesselset &
+        (reservations.get_reserved_vessels() | unavailable_vessels)):
+      # No other resolution holds any vessel we could use, so there is no
+      # point in trying.
+      logger.info(str(identity) + ": Group " + node['id'] + " cannot be satisfied")
+      lock = self._requests.get_lock(identity)
+      lock.acquire()
+      try:
+        node['status'] = STATUS_FAILED
+        node['error'] = "There are not enough vessels available that satisfy the group's rules."
+      finally:
+        lock.release()
+      return node
 
-        # Have we exceeded the maximum in-group retry count?
-        if in_group_retry_count >= MAX_IN_GROUP_RETRIES:
+    for node_id, vesselname in solution:
+      if not reservations.reserve((node_id, vesselname)):
+        # The rest of the group is picked one vessel at a time below.
+        unavailable_vessels.add((node_id, vesselname))
+        continue
+      vessel_dict = _create_vesseldict(nodeinfos[node_id], vesselname)
+      candidate_vessels.append(vessel_dict)
+      group_state.add_vessel(vessel_dict)
+
+    # Pick the remaining candidates one at a time.
+    with selexortrace.span('pick_candidates') as pick_span:
+      while len(candidate_vessels) < num_candidates_wanted and \
+            in_group_retry_count < MAX_IN_GROUP_RETRIES:
+
+        if not self._running:
+          # Stop if we receive a quit message
           break
 
-        # We retry if there could be another combination that MIGHT satisfy
-        # the group rules. If there are no group rules, there is no point
-        # to retry.
-        if not selexorruleparser.has_group_rules(node['rules']):
-          logger.info(str(identity) + ": There are no group rules applied; no point in retrying.")
+        if should_stop is not None and should_stop():
+          # The vessels picked so far are not acquired either.
           break
 
-        if candidate_vessels:
-          # Get the vessel that causes the largest drop in the
-          # size of the available vessel pool
-          worst_vessel = selexorruleparser.get_worst_vessel(
-              candidate_vessels,
-              handles_grouprulematch,
-              cursor,
-              node['rules'])
-
-          # Release the worst vessel so that we can try to get a better one
-          # in the next iteration
-          logger.info(str(identity) + ": Releasing: " + str(worst_vessel))
-          candidate_vessels.remove(worst_vessel)
-          client.release_resources([worst_vessel['handle']])
-
-    # We may get vessels that are unusable (i.e. extra vessels containing
-    # leftover resources).  If so, drop them and try again
-    while candidate_vessels:
-      vessels_to_acquire = []
-      for vesseldict in candidate_vessels:
-        vessels_to_acquire.append(vesseldict['handle'])
+        if node['pass'] >= MAX_PASSES_PER_NODE:
+          raise selexorexceptions.SelexorInternalError("Performing more passes than max pass!")
+
+        handles_grouprulematch = group_state.get_feasible_vessels()
+
+        # Pick any vessel that no other group or resolution has picked.
+        vessellist = list(handles_grouprulematch -
+            reservations.get_reserved_vessels() - unavailable_vessels)
+        if vessellist:
+          logger.info(str(identity) + ": Candidates for next vessel: " + str(len(vessellist)))
+          # If we run out of handles, we simply get another random one, instead of
+          # programming a special case.  Vessels that are more likely to be
+          # acquired are favoured.
+          node_id, vesselname = self._reliability.choose(vessellist)
+          if not reservations.reserve((node_id, vesselname)):
+            # Someone else picked this vessel in the meantime.
+            unavailable_vessels.add((node_id, vesselname))
+            continue
+
+          vessel_dict = _create_vesseldict(nodeinfos[node_id], vesselname)
+          logger.info(str(identity)+":\n"+"Considering: "+str(vessel_dict['handle']))
+          candidate_vessels.append(vessel_dict)
+          group_state.add_vessel(vessel_dict)
+
+        # We ran out of vessels to check
+        else:
+          # The surplus is optional.
+          if len(candidate_vessels) >= remaining:
+            break
+
+          logger.info(str(identity) + ": Can't find any suitable vessels!")
+          in_group_retry_count += 1
+
+          # Have we exceeded the maximum in-group retry count?
+          if in_group_retry_count >= MAX_IN_GROUP_RETRIES:
+            break
+
+          # We retry if there could be another combination that MIGHT satisfy
+          # the group rules. If there are no group rules, there is no point
+          # to retry.
+          if not selexorruleparser.has_group_rules(node['rules']):
+            logger.info(str(identity) + ": There are no group rules applied; no point in retrying.")
+            break
 
+          if candidate_vessels:
+            # Get the vessel that causes the largest drop in the
+            # size of the available vessel pool
+            worst_vessel = group_state.get_worst_vessel(candidate_vessels)
+
+            # Drop the worst vessel so that we can try to get a better one
+            # in the next iteration.  Candidates are not acquired yet, so
+            # there is nothing to release on the clearinghouse.
+            logger.info(str(identity) + ": Dropping: " + str(worst_vessel))
+            candidate_vessels.remove(worst_vessel)
+            group_state.remove_vessel(worst_vessel)
+            reservations.release(selexorruleparser.get_vessel_key(worst_vessel))
+      pick_span.set(num_candidates=len(candidate_vessels))
+
+    picked_vessels = list(candidate_vessels)
+
+    with selexortrace.span('acquire', num_candidates=len(candidate_vessels)) as acquire_span:
+      acquired_vesseldicts, num_requested = self._acquire_vessels(identity, client, candidate_vessels, remaining, db, cursor, should_stop)
+      acquire_span.set(num_acquired=len(acquired_vesseldicts))
+    # Candidates that were never sent to the clearinghouse say nothing about
+    # how many vessels it refuses.
+    self._acquisition_statistics.record(num_requested, len(acquired_vesseldicts))
+
+    # Give back the surplus, along with any vessel that breaks the group
+    # rules because a vessel picked before it was not acquired.
+    vessels_to_keep = self._get_vessels_to_keep(node, acquired_vesseldicts, remaining, group_state.vesselset, cursor)
+    lock = self._requests.get_lock(identity)
+    lock.acquire()
+    try:
+      node['acquired'] += vessels_to_keep
+      node['pass'] += 1
+      if node['pass'] >= MAX_PASSES_PER_NODE:
+        logger.info(str(identity) + ": Group exceeds pass limit. Designating group as failed: " + str(node))
+        node['status'] = STATUS_FAILED
+      elif len(node['acquired']) == node['allocate']:
+        node['status'] = STATUS_RESOLVED
+      else:
+        node['status'] = STATUS_INCOMPLETE
+      # Delta status queries need the version of every acquired vessel, so
+      # it is set before the lock is released.
+      request_data = self._requests.get(identity)
+      if request_data is not None:
+        self._mark_changed(identity, request_data, [node])
+    finally:
+      lock.release()
+
+    # The kept vessels are added to the group first, so that they are not
+    # lost if the surplus cannot be released.
+    vessels_to_release = []
+    for vesseldict in acquired_vesseldicts:
+      if vesseldict not in vessels_to_keep:
+        vessels_to_release.append(vesseldict['handle'])
+    if vessels_to_release:
+      logger.info(str(identity) + ": Releasing " + str(len(vessels_to_release)) + " surplus vessel(s)")
       try:
-        acquired_vesseldicts = client.acquire_specific_vessels(vessels_to_acquire)
-        logger.info(str(identity)+": Requested "+str(len(vessels_to_acquire))+" vessels, acquired "+str(len(acquired_vesseldicts))+":\n"+'\n'.join(i['handle'][-10:] +':'+ i['vessel_id'] for i in acquired_vesseldicts))
-
-        # We must be careful to count only the vessels that we have
-        # actually acquired, as some vessels may not have been given to
-        # the user due to the database having slightly outdated
-        # information.
-        acquired_vesseldicts = _get_acquired_vesseldicts(
-          clearinghouse_vesseldicts=acquired_vesseldicts,
-          selexor_vesseldicts=candidate_vessels)
-        node['acquired'] += acquired_vesseldicts
+        client.release_resources(vessels_to_release)
+      except Exception:
+        logger.error(str(identity) + ": Could not release surplus vessels\n" + traceback.format_exc())
+
+    # Vessels that we did not get may be picked by other groups.
+    for vesseldict in picked_vessels:
+      if vesseldict in node['acquired']:
+        reservations.commit(selexorruleparser.get_vessel_key(vesseldict))
+      else:
+        reservations.release(selexorruleparser.get_vessel_key(vesseldict))
+    return node
+
+
+  def _acquire_vessels(self, identity, client, candidate_vessels, num_needed, db, cursor, should_stop=None):
+    '''
+    <Purpose>
+      Acquires the given candidates from the clearinghouse, in batches of up
+      to settings.acquisition_batch_size vessels.  Batches stop being sent
+      once num_needed vessels are acquired.
+    <Arguments>
+      identity:
+        A user identity.
+      client:
+        The Seattle Clearinghouse XMLRPC client to use.
+      candidate_vessels:
+        The list of vesseldicts to acquire, in order of preference.
+      num_needed:
+        The number of vessels that the group needs.
+      db, cursor:
+        The database connection and cursor to use.
+      should_stop:
+        Called before each batch is sent.  If it returns True, the remaining
+        batches are not sent.  May be None.
+    <Exceptions>
+      NotEnoughCreditsError
+      SelexorInternalError
+    <Side Effects>
+      Acquires vessels on behalf of the user.
+      Marks vessels that the clearinghouse does not know about as
+      non-acquirable in the database.
+      Records the outcome for every vessel that was asked for.
+    <Returns>
+      A tuple (acquired_vesseldicts, num_requested).  acquired_vesseldicts
+      is the list of vesseldicts that were acquired, in the same order as in
+      candidate_vessels.  num_requested is the number of candidates that
+      were asked for.
+
+    '''
+    acquired_vesseldicts = []
+    num_requested = 0
+    batch_size = max(1, settings.acquisition_batch_size)
+    for batch_start in range(0, len(candidate_vessels), batch_size):
+      if len(acquired_vesseldicts) >= num_needed:
+        break
+      if should_stop is not None and should_stop():
+        logger.info(str(identity) + ": Stopping before acquiring the remaining candidates")
         break
+      batch = candidate_vessels[batch_start:batch_start + batch_size]
+      num_requested += len(batch)
+
+      # We may get vessels that are unusable (i.e. extra vessels containing
+      # leftover resources).  If so, drop them and try again
+      while batch:
+        vessels_to_acquire = []
+        for vesseldict in batch:
+          vessels_to_acquire.append(vesseldict['handle'])
+
+        try:
+          clearinghouse_vesseldicts = client.acquire_specific_vessels(vessels_to_acquire)
+          logger.info(str(identity)+": Requested "+str(len(vessels_to_acquire))+" vessels, acquired "+str(len(clearinghouse_vesseldicts))+":\n"+'\n'.join(i['handle'][-10:] +':'+ i['vessel_id'] for i in clearinghouse_vesseldicts))
+
+          # We must be careful to count only the vessels that we have
+          # actually acquired, as some vessels may not have been given to
+          # the user due to the database having slightly outdated
+          # information.
+          acquired_batch = _get_acquired_vesseldicts(
+            clearinghouse_vesseldicts=clearinghouse_vesseldicts,
+            selexor_vesseldicts=batch)
+          acquired_vesseldicts += acquired_batch
+          for vesseldict in batch:
+            self._reliability.record_outcome(
+              selexorruleparser.get_vessel_key(vesseldict), vesseldict in acquired_batch)
+          break
+
+        except seattleclearinghouse_xmlrpc.NotEnoughCreditsError, e:
+          logger.error(str(identity) + ": Not enough vessel credits")
+          raise
+        except seattleclearinghouse_xmlrpc.InvalidRequestError, e:
+          error_string = str(e)
+          # This may be an extra vessel.
+          if 'There is no vessel with the node identifier' not in error_string:
+            logger.error(str(identity) + ": " + str(e))
+            raise
 
-      except seattleclearinghouse_xmlrpc.NotEnoughCreditsError, e:
-        logger.error(str(identity) + ": Not enough vessel credits")
-        raise
-      except seattleclearinghouse_xmlrpc.InvalidRequestError, e:
-        error_string = str(e)
-        # This may be an extra vessel.
-        if 'There is no vessel with the node identifier' in error_string:
           logger.error(str(identity) + ": " + str(e))
           extra_vessels = []
-          for vessel in candidate_vessels:
+          for vessel in batch:
             if (vessel['node_key'] in error_string and
                 vessel['vessel_name'] in error_string):
               extra_vessels.append(vessel)
 
+          # Don't retry the same batch forever if we can't tell which
+          # vessel the clearinghouse is complaining about.
+          if not extra_vessels:
+            raise selexorexceptions.SelexorInternalError(error_string)
+
           for vessel in extra_vessels:
-            candidate_vessels.remove(vessel)
+            batch.remove(vessel)
+            self._reliability.record_outcome(selexorruleparser.get_vessel_key(vessel), False)
             logger.info("Removing: ..." + vessel['node_key'][-10:] + ':' + vessel['vessel_name'])
 
           # Store into the db so that future lookups do not need to
@@ -453,26 +1130,57 @@ class SelexorServer:
           selexorhelper.autoretry_mysql_command(cursor, update_command)
           db.commit()
 
-        else:
-          logger.error(str(identity) + ": " + str(e))
-          raise
+        except Exception, e:
+          logger.error(str(identity) +": Unknown error while acquiring vessels\n" + traceback.format_exc())
+          raise selexorexceptions.SelexorInternalError(str(e))
 
-      except Exception, e:
-        logger.error(str(identity) +": Unknown error while acquiring vessels\n" + traceback.format_exc())
-        raise selexorexceptions.SelexorInternalError(str(e))
-
-    node['pass'] += 1
-    if node['pass'] >= MAX_PASSES_PER_NODE:
-      logger.info(str(identity) + ": Group exceeds pass limit. Designating group as failed: " + str(node))
-      node['status'] = STATUS_FAILED
-    elif len(node['acquired']) == node['allocate']:
-      node['status'] = STATUS_RESOLVED
-    else:
-      node['status'] = STATUS_INCOMPLETE
-    return node
+    return acquired_vesseldicts, num_requested
 
 
-  def handle_request(self, authinfo, request, remoteip):
+  def _get_vessels_to_keep(self, node, acquired_vesseldicts, num_needed, vesselset, cursor):
+    '''
+    <Purpose>
+      Chooses which of the vessels acquired on this pass should be added to
+      the group.
+    <Arguments>
+      node:
+        The groupdict being resolved.
+      acquired_vesseldicts:
+        The vesseldicts acquired on this pass, in the order they were picked.
+      num_needed:
+        The number of vessels that the group needs.
+      vesselset:
+        The set of vessels that satisfy the group's vessel rules.
+      cursor:
+        A database cursor object.
+    <Exceptions>
+      None
+    <Side Effects>
+      None
+    <Returns>
+      The list of vesseldicts to keep, at most num_needed long.
+
+    '''
+    if not selexorruleparser.has_group_rules(node['rules']):
+      return acquired_vesseldicts[:num_needed]
+
+    # Vessels were picked one at a time so that each one satisfied the group
+    # rules together with the ones picked before it.  If some of those were
+    # not acquired, the vessels picked after them have to be checked again.
+    group_state = selexorruleparser.GroupRuleState(
+        node['rules'], cursor, vesselset, node['acquired'])
+    vessels_to_keep = []
+    for vesseldict in acquired_vesseldicts:
+      if len(vessels_to_keep) >= num_needed:
+        break
+      vessel_key = selexorruleparser.get_vessel_key(vesseldict)
+      if vessel_key in group_state.get_feasible_vessels():
+        vessels_to_keep.append(vesseldict)
+        group_state.add_vessel(vesseldict)
+    return vessels_to_keep
+
+
+  def handle_request(self, authinfo, request, remoteip, time_budget=None, release_on_timeout=False):
     '''
     <Purpose>
       Handles a host request for the specified user.
@@ -504,6 +1212,15 @@ class SelexorServer:
 
       remoteip: The IP address where this request originated from.
 
+      time_budget:
+        The number of seconds SeleXor may spend on the request, counted from
+        now, or None for no limit.  Once they are up, resolution stops and
+        the request's status becomes 'timeout'.
+
+      release_on_timeout:
+        If True, the vessels acquired so far are released if the request
+        runs out of time.
+
     <Side Effects>
       Attempts to obtain vessels described in the request_data. This is not
       guaranteed, depending on the ddata collected in the selexordatabase.
@@ -512,12 +1229,9 @@ class SelexorServer:
       None
 
     <Returns>
-      Returns the status of the request, as a string.
-
-      'timeout':
-        The request did not finish in the allocated time.
-      'complete':
-        Selexor successfully finished the request.
+      The status of the new request, as returned by get_request_status().
+      Its 'request_id' is used to address the request later on, so that a
+      user can have several requests in progress at once.
 
     '''
     if not self._accepting_requests:
@@ -525,51 +1239,225 @@ class SelexorServer:
 
     # Get ready to handle the request
     username = authinfo.keys()[0]
-    identity = (username, remoteip)
-    request_datum[identity] = {'status': 'processing'}
+    previous_identity = self._get_request_identity(authinfo, remoteip, None)
+    try:
+      request_id = self._add_request_id(username, remoteip)
+    except selexorexceptions.SelexorServerBusy, e:
+      return {'status': 'error', 'error': str(e), 'groups': {}}
+    identity = (username, remoteip, request_id)
+    request_data = {'status': 'processing'}
+    self._mark_changed(identity, request_data)
+    self._requests.put(identity, request_data)
+    if previous_identity is not None:
+      # Status queries without a request ID now follow this request instead.
+      self._requests.notify_changed(previous_identity)
     logger.info(str(identity) + ": Obtained request: " + str(request))
 
     # Make sure the request is valid
     request_data = self._validate_request(identity, request)
-    request_datum[identity] = request_data
+    if time_budget is not None and request_data['status'] == 'accepted':
+      try:
+        time_budget = float(time_budget)
+        if time_budget <= 0:
+          raise ValueError
+      except (TypeError, ValueError):
+        request_data['status'] = 'error'
+        request_data['error'] = "The time budget must be a positive number of seconds."
+      else:
+        request_data['deadline'] = time.time() + time_budget
+        request_data['release_on_stop'] = bool(release_on_timeout)
+    self._mark_changed(identity, request_data, request_data['groups'].values())
+    request_data['first_version'] = request_data['version']
+    self._requests.put(identity, request_data)
     logger.info(str(identity) + ": Generated Request data: " + str(request_data))
 
     if request_data['status'] == 'accepted':
       try:
-        client = selexorhelper.connect_to_clearinghouse(authinfo)
+        client = selexorhelper.clearinghouse_sessions.checkout(authinfo)
       except selexorexceptions.SelexorException, e:
-        request_data['status'] = 'error'
-        request_data['error'] = str(e)
+        self._set_request_error(identity, request_data, str(e))
         raise
       except:
-        request_data['status'] = 'error'
-        request_data['error'] = "An internal error occurred."
+        self._set_request_error(identity, request_data, "An internal error occurred.")
         logger.error(str(identity) + ": Error connecting to clearinghouse" + traceback.format_exc())
         raise
 
-      # Start working
-      request_data['status'] = "working"
-      logger.error(str(identity) + ": Working on request")
-      resolution_thread = threading.Thread(target=self.serve_request, args=(identity, request_data, client))
-      resolution_thread.start()
+      self._queue_request(identity, request_data, client, authinfo)
 
     else:
       logger.info(str(identity) + ": Could not process request")
-    return self.get_request_status(authinfo, remoteip)
+    return self.get_request_status(authinfo, remoteip, request_id=request_id)
 
 
-  def serve_request(self, identity, request_data, client):
+  def _queue_request(self, identity, request_data, client, authinfo):
     '''
     <Purpose>
-      Serves a host request.
+      Queues a request to be served once a worker is free.
+    <Arguments>
+      identity:
+        A user identity.
+      request_data:
+        A requestdict.
+      client:
+        The ClearinghouseSession to serve the request with.
+      authinfo:
+        An authdict.
+    <Exceptions>
+      None
+    <Side Effects>
+      Sets the request's status to 'queued', or to 'error' if the queue is
+      full.
+    <Returns>
+      None
+
+    '''
+    lock = self._requests.get_lock(identity)
+    def update_queue_position(position):
+      lock.acquire()
+      try:
+        request_data['queue_position'] = position
+        self._mark_changed(identity, request_data)
+      finally:
+        lock.release()
+
+    lock.acquire()
+    try:
+      request_data['status'] = 'queued'
+      request_data['queue_position'] = None
+    finally:
+      lock.release()
+    try:
+      # Requests are queued per user, so that a user's requests take turns
+      # with everyone else's.
+      position = self._scheduler.submit(identity[:2], self.serve_request,
+        (identity, request_data, client, authinfo), update_queue_position)
+    except selexorexceptions.SelexorServerBusy, e:
+      selexorhelper.clearinghouse_sessions.checkin(client)
+      self._set_request_error(identity, request_data, str(e))
+      logger.info(str(identity) + ": Request refused, too many requests are queued")
+    else:
+      # A worker may already have taken it off the queue.
+      logger.info(str(identity) + ": Request queued at position " + str(position))
+
+
+  def _mark_changed(self, identity, request_data, changed_groups=()):
+    '''
+    Records that the given requestdict has changed, so that status responses
+    built from an older version are not reused, and wakes up the status
+    queries that are waiting for it to change.  The groups in changed_groups
+    are given the new version, as are their vessels and released vessels
+    that do not have a version yet.
 
+    '''
+    version = _request_version_counter.next()
+    request_data['version'] = version
+    request_data['expiretime'] = time.time() + settings.request_state_ttl
+    for group in changed_groups:
+      group['version'] = version
+      for vesseldict in group['acquired'] + group.get('removed', []):
+        vesseldict.setdefault('version', version)
+    self._requests.notify_changed(identity)
+
+
+  def _set_request_error(self, identity, request_data, error):
+    ''' Marks a stored request as failed with the given error message. '''
+    lock = self._requests.get_lock(identity)
+    lock.acquire()
+    try:
+      request_data['status'] = 'error'
+      request_data['error'] = error
+      self._mark_changed(identity, request_data)
+    finally:
+      lock.release()
+
+
+  def _interrupt_queued_request(self, identity, request_data, client):
+    '''
+    <Purpose>
+      Marks a request that was still queued when SeleXor stopped as
+      interrupted, so that it is resumed once SeleXor is running again.
     <Arguments>
       identity:
         A user identity.
       request_data:
         A requestdict.
       client:
-        The Seattle Clearinghouse XMLRPC client to use.
+        The ClearinghouseSession that the request was queued with.
+    <Exceptions>
+      None
+    <Side Effects>
+      Checks the session back in.
+    <Returns>
+      None
+
+    '''
+    selexorhelper.clearinghouse_sessions.checkin(client)
+    lock = self._requests.get_lock(identity)
+    lock.acquire()
+    try:
+      request_data['queue_position'] = None
+      request_data['resume_needed'] = True
+      self._mark_changed(identity, request_data)
+    finally:
+      lock.release()
+    logger.info(str(identity) + ": Queued request interrupted by shutdown")
+
+
+  def _resume_request(self, identity, request_data, authinfo):
+    '''
+    <Purpose>
+      Queues a request that was interrupted by a restart, so that its
+      remaining groups are resolved.
+    <Arguments>
+      identity:
+        A user identity.
+      request_data:
+        A requestdict with 'resume_needed' set.
+      authinfo:
+        An authdict, as credentials are not saved with the request.
+    <Exceptions>
+      None
+    <Side Effects>
+      Queues the request.
+    <Returns>
+      None
+
+    '''
+    lock = self._requests.get_lock(identity)
+    lock.acquire()
+    try:
+      # Another status query may have resumed it already.
+      if not request_data.pop('resume_needed', False):
+        return
+    finally:
+      lock.release()
+
+    logger.info(str(identity) + ": Resuming interrupted request")
+    try:
+      client = selexorhelper.clearinghouse_sessions.checkout(authinfo)
+    except Exception, e:
+      self._set_request_error(identity, request_data, str(e))
+      return
+    self._queue_request(identity, request_data, client, authinfo)
+
+
+  def serve_request(self, identity, request_data, client, authinfo):
+    '''
+    <Purpose>
+      Serves a host request.  Groups are resolved concurrently, by up to
+      settings.num_group_resolution_threads threads.
+
+    <Arguments>
+      identity:
+        A user identity.
+      request_data:
+        A requestdict.
+      client:
+        The ClearinghouseSession to use.  It is checked back in once the
+        request is served.
+      authinfo:
+        An authdict. Used to check out sessions for additional threads, as
+        sessions cannot be shared between threads.
 
     <Side Effects>
       Attempts to obtain vessels described in the request_data. This is not
@@ -584,41 +1472,260 @@ class SelexorServer:
 
       'timeout':
         The request did not finish in the allocated time.
+      'cancelled':
+        The user cancelled the request.
       'complete':
         Selexor successfully finished the request.
 
     '''
+    if _get_stop_reason(request_data) is not None:
+      # It was cancelled, or ran out of time, while it was queued.
+      selexorhelper.clearinghouse_sessions.checkin(client)
+      self._finish_stopped_request(identity, request_data, authinfo)
+      return
+
+    # Start working
+    lock = self._requests.get_lock(identity)
+    lock.acquire()
+    try:
+      request_data['status'] = "working"
+      request_data.pop('queue_position', None)
+      self._mark_changed(identity, request_data)
+    finally:
+      lock.release()
+    logger.info(str(identity) + ": Working on request")
     logger.info(str(identity) + ": Request data:\n" + str(request_data))
-    db, cursor = selexorhelper.connect_to_db()
 
+    # Groups that are already done are skipped, in case the request is being
+    # resumed.
+    groups_to_resolve = Queue.Queue()
     for groupname, group in request_data['groups'].iteritems():
-      pass_no = 0
-      while pass_no < 5:
+      if group['status'] not in (STATUS_RESOLVED, STATUS_FAILED, STATUS_ERROR):
+        groups_to_resolve.put(groupname)
+
+    # Shared between all threads working on this request
+    context = {
+      'reservations': _RequestReservations(self._vessel_leases, uuid.uuid4().hex),
+      # Set when a group fails in a way that prevents the rest of the
+      # request from being resolved.
+      'aborted': threading.Event(),
+      # Checked between clearinghouse calls, so that a request that is
+      # cancelled or runs out of time stops as soon as it can.
+      'should_stop': lambda: _get_stop_reason(request_data) is not None,
+    }
+
+    num_threads = max(1, min(settings.num_group_resolution_threads, len(request_data['groups'])))
+    with selexortrace.start_trace(identity[2], 'request', username=identity[0],
+        num_groups=len(request_data['groups'])) as request_span:
+      # Group spans are started in the resolution threads.
+      context['trace_span'] = request_span
+      resolution_threads = []
+      for thread_no in range(num_threads):
+        thread = threading.Thread(
+            target=self._serve_groups,
+            args=(identity, request_data, groups_to_resolve, context, authinfo, client if thread_no == 0 else None))
+        resolution_threads.append(thread)
+        thread.start()
+
+      for thread in resolution_threads:
+        thread.join()
+    selexorhelper.clearinghouse_sessions.checkin(client)
+
+    if context['aborted'].isSet():
+      status = 'error'
+    elif (_get_stop_reason(request_data) is not None and
+        [group for group in request_data['groups'].itervalues()
+          if group['status'] not in (STATUS_RESOLVED, STATUS_FAILED, STATUS_ERROR)]):
+      self._finish_stopped_request(identity, request_data, authinfo)
+      return
+    else:
+      logger.info(str(identity) + ": Resolution Complete")
+      status = 'complete'
+    lock.acquire()
+    try:
+      request_data['status'] = status
+      self._mark_changed(identity, request_data)
+    finally:
+      lock.release()
+
+
+  def _finish_stopped_request(self, identity, request_data, authinfo):
+    '''
+    <Purpose>
+      Ends a request that was cancelled or ran out of time before all of
+      its groups were resolved.
+    <Arguments>
+      identity:
+        A user identity.
+      request_data:
+        A requestdict.
+      authinfo:
+        An authdict.
+    <Exceptions>
+      None
+    <Side Effects>
+      Releases the vessels acquired so far if the user asked for it.
+    <Returns>
+      None
+
+    '''
+    reason = _get_stop_reason(request_data)
+    logger.info(str(identity) + ": Resolution stopped early: " + str(reason))
+    if request_data.get('release_on_stop'):
+      vessels_to_release = []
+      for group in request_data['groups'].itervalues():
+        for vesseldict in group['acquired']:
+          vessels_to_release.append({'handle': vesseldict['handle']})
+      if vessels_to_release:
+        self.release_vessels(authinfo, vessels_to_release, identity[1], identity[2])
+    lock = self._requests.get_lock(identity)
+    lock.acquire()
+    try:
+      request_data['status'] = reason
+      request_data.pop('queue_position', None)
+      self._mark_changed(identity, request_data)
+    finally:
+      lock.release()
+
+
+  def _serve_groups(self, identity, request_data, groups_to_resolve, context, authinfo, client):
+    '''
+    <Purpose>
+      Resolves groups from the given queue until it is empty.  This is the
+      body of each of the threads started by serve_request().
+
+    <Arguments>
+      identity:
+        A user identity.
+      request_data:
+        A requestdict.
+      groups_to_resolve:
+        A Queue of the groupnames that are not yet being resolved.
+      context:
+        The dictionary that is shared by all threads serving the request.
+      authinfo:
+        An authdict.
+      client:
+        The ClearinghouseSession to use.  If None, a session is checked out
+        for this thread and checked back in when it finishes.
+
+    <Side Effects>
+      Attempts to obtain vessels for each group taken from the queue.
+
+    <Exceptions>
+      None
+
+    <Returns>
+      None
+
+    '''
+    db = None
+    own_client = None
+    try:
+      try:
+        if client is None:
+          client = own_client = selexorhelper.clearinghouse_sessions.checkout(authinfo)
+        db, cursor = selexorhelper.connect_to_db()
+      except:
+        logger.error(str(identity) + ": Could not start resolution thread\n" + traceback.format_exc())
+        # The remaining threads will resolve the groups.
+        return
+
+      while not context['aborted'].isSet() and not context['should_stop']():
         try:
-          logger.info(str(identity) + ": Resolving group: " + str(groupname))
-          group = self.resolve_node(identity, client, group, db, cursor)
-          # We are done here, no need to proceed with the remaining
-          # passes
-          if group['status'] != STATUS_INCOMPLETE:
-            break
+          groupname = groups_to_resolve.get_nowait()
+        except Queue.Empty:
+          break
+        group = request_data['groups'][groupname]
+        with selexortrace.span('group', context['trace_span'], group=groupname,
+            num_needed=group['allocate']) as group_span:
+          self._resolve_group(identity, request_data, group, client, db, cursor, context)
+          group_span.set(status=group['status'], num_acquired=len(group['acquired']))
 
-        except seattleclearinghouse_xmlrpc.NotEnoughCreditsError, e:
-          group['status'] = 'error'
-          group['error'] = str(e)
-          logger.info(str(identity) + ": Not enough credits.")
-          request_data['status'] = 'error'
-          return
-        except:
-          group['status'] = 'error'
-          group['error'] = "An internal error occured while resolving this group."
-          logger.error(str(identity) + ": Unknown error while resolving nodes\n" + traceback.format_exc())
-          request_data['status'] = 'error'
-          return
+    finally:
+      if db is not None:
+        db.close()
+      if own_client is not None:
+        selexorhelper.clearinghouse_sessions.checkin(own_client)
 
-        pass_no += 1
 
-    logger.info(str(identity) + ": Resolution Complete")
-    request_data['status'] = 'complete'
+  def _resolve_group(self, identity, request_data, group, client, db, cursor, context):
+    '''
+    <Purpose>
+      Performs as many passes as needed to resolve a single group.
+
+    <Arguments>
+      identity:
+        A user identity.
+      request_data:
+        The requestdict that the group belongs to.
+      group:
+        The groupdict to resolve.
+      client:
+        The Seattle Clearinghouse XMLRPC client to use.
+      db, cursor:
+        The database connection and cursor to use.
+      context:
+        The dictionary that is shared by all threads serving the request.
+
+    <Side Effects>
+      Attempts to obtain vessels for the group.
+      Aborts the request if an error prevents the rest of it from being
+      resolved.
+
+    <Exceptions>
+      None
+
+    <Returns>
+      None
+
+    '''
+    lock = self._requests.get_lock(identity)
+    pass_no = 0
+    while pass_no < 5 and not context['aborted'].isSet():
+      if context['should_stop']():
+        return
+      try:
+        logger.info(str(identity) + ": Resolving group: " + str(group['id']))
+        with selexortrace.span('pass', pass_no=group['pass']) as pass_span:
+          group = self.resolve_node(identity, client, group, db, cursor,
+            context['reservations'], context['should_stop'])
+          pass_span.set(status=group['status'], num_acquired=len(group['acquired']))
+        lock.acquire()
+        try:
+          self._mark_changed(identity, request_data, [group])
+        finally:
+          lock.release()
+        # We are done here, no need to proceed with the remaining
+        # passes
+        if group['status'] != STATUS_INCOMPLETE:
+          break
+
+      except seattleclearinghouse_xmlrpc.NotEnoughCreditsError, e:
+        logger.info(str(identity) + ": Not enough credits.")
+        self._set_group_error(identity, request_data, group, str(e))
+        context['aborted'].set()
+        return
+      except:
+        logger.error(str(identity) + ": Unknown error while resolving nodes\n" + traceback.format_exc())
+        self._set_group_error(identity, request_data, group,
+          "An internal error occured while resolving this group.")
+        context['aborted'].set()
+        return
+
+      pass_no += 1
+
+
+  def _set_group_error(self, identity, request_data, group, error):
+    ''' Marks a group of a stored request as failed with the given error message. '''
+    lock = self._requests.get_lock(identity)
+    lock.acquire()
+    try:
+      group['status'] = 'error'
+      group['error'] = error
+      self._mark_changed(identity, request_data, [group])
+    finally:
+      lock.release()
 
 
   def _validate_request(self, identity, request):
@@ -674,6 +1781,147 @@ class SelexorServer:
     return {'groups': groups, 'status': status}
 
 
+class _RequestReservations:
+  '''
+  The set of vessels that have been picked by the groups of a request.
+  Groups are resolved concurrently, and each vessel may only be picked
+  by one of them.  Each picked vessel is also leased, so that other
+  resolutions do not pick it either.
+
+  '''
+  def __init__(self, vessel_leases, owner):
+    self._lock = threading.Lock()
+    self._reserved_vessels = set()
+    self._vessel_leases = vessel_leases
+    self._owner = owner
+
+
+  def reserve(self, vessel_key):
+    '''
+    Reserves the vessel with the given (node_id, vesselname).  Returns False
+    if the vessel is already reserved, or is leased by another resolution.
+
+    '''
+    self._lock.acquire()
+    try:
+      if vessel_key in self._reserved_vessels:
+        return False
+      if not self._vessel_leases.lease(vessel_key, self._owner):
+        return False
+      self._reserved_vessels.add(vessel_key)
+      return True
+    finally:
+      self._lock.release()
+
+
+  def release(self, vessel_key):
+    ''' Allows other groups and resolutions to pick the given vessel. '''
+    self._lock.acquire()
+    try:
+      self._reserved_vessels.discard(vessel_key)
+      self._vessel_leases.release(vessel_key, self._owner)
+    finally:
+      self._lock.release()
+
+
+  def commit(self, vessel_key):
+    ''' Keeps the given vessel hidden from other resolutions, as it was acquired. '''
+    self._vessel_leases.commit(vessel_key, self._owner)
+
+
+  def get_vessels_leased_by_others(self):
+    ''' Returns the set of vessels leased by other resolutions. '''
+    return self._vessel_leases.get_leased_vessels(self._owner)
+
+
+  def get_reserved_vessels(self):
+    ''' Returns a copy of the set of reserved vessels. '''
+    self._lock.acquire()
+    try:
+      return set(self._reserved_vessels)
+    finally:
+      self._lock.release()
+
+
+class _AcquisitionStatistics:
+  '''
+  Keeps a smoothed estimate of the fraction of picked vessels that the
+  clearinghouse does not give us, which decides how many extra candidates
+  are picked for each group.
+
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.failure_rate = 0.0
+
+
+  def record(self, num_requested, num_acquired):
+    ''' Records the outcome of acquiring num_requested vessels. '''
+    if not num_requested:
+      return
+    observed_failure_rate = 1.0 - float(num_acquired) / num_requested
+    self._lock.acquire()
+    try:
+      self.failure_rate += ACQUISITION_FAILURE_SMOOTHING * (observed_failure_rate - self.failure_rate)
+    finally:
+      self._lock.release()
+
+
+  def get_num_candidates(self, num_needed):
+    ''' Returns the number of candidates to pick to get num_needed vessels. '''
+    max_factor = settings.max_acquisition_overshoot_factor
+    # Expecting to get (1 - failure_rate) of what we ask for.
+    if self.failure_rate >= 1.0 - 1.0 / max_factor:
+      factor = max_factor
+    else:
+      factor = 1.0 / (1.0 - self.failure_rate)
+    factor = max(factor, settings.min_acquisition_overshoot_factor)
+    return int(math.ceil(num_needed * factor))
+
+
+def _advance_request_versions(version):
+  '''
+  Makes sure that versions given out from now on are above version.  This
+  is only called while a server starts, before it serves any request.
+
+  '''
+  global _request_version_counter
+  next_version = _request_version_counter.next()
+  _request_version_counter = itertools.count(max(next_version, version + 1))
+
+
+def _get_stop_reason(request_data):
+  '''
+  Returns why resolution of the given requestdict should stop early:
+  'cancelled' if the user cancelled it, 'timeout' if its deadline passed, or
+  None if it should go on.
+
+  '''
+  if request_data.get('cancel_requested'):
+    return 'cancelled'
+  deadline = request_data.get('deadline')
+  if deadline is not None and time.time() >= deadline:
+    return 'timeout'
+  return None
+
+
+def _create_vesseldict(nodeinfo, vesselname):
+  ''' Returns the vesseldict of a vessel on the node with the given nodeinfo. '''
+  node_id, nodekey, node_ip, node_port = nodeinfo
+  # node_id and vessel_name are used extensively by rule parsers
+  # We should include them here to prevent each rule from looking the up
+  # The node's address is kept so that status queries do not need to
+  # look it up.
+  return {
+    'handle': nodekey + ':' + vesselname,
+    'node_id': node_id,
+    'node_key': nodekey,
+    'vessel_name': vesselname,
+    'node_ip': node_ip,
+    'node_port': node_port,
+  }
+
+
 def get_alpha_characters():
   alpha = ""
   uppercase_ord_values = range(ord('A'), ord('Z') + 1)
@@ -719,6 +1967,55 @@ def get_handle_from_nodehandle(nodehandle):
   return rsa_publickey_to_string(vesseldict['nodekey']) + ':' + vesselname
 
 
+def get_handles_from_nodehandles(nodehandles):
+  '''
+  <Purpose>
+    Looks up the vesselhandles of many node handles at once, contacting up to
+    settings.num_nodemanager_lookup_threads nodemanagers in parallel.
+
+  <Parameters>
+    nodehandles:
+      A list of node handles, in the format 'node_ip:port:vesselname'
+
+  <Exceptions>
+    None
+
+  <Side Effects>
+    Connects to the given nodes.
+
+  <Return>
+    A tuple (handles, errors).  handles maps each node handle that was looked
+    up to its vesselhandle, and errors maps every other node handle to a
+    description of why it could not be looked up.
+
+  '''
+  handles = {}
+  errors = {}
+  nodehandles_to_look_up = Queue.Queue()
+  for nodehandle in nodehandles:
+    nodehandles_to_look_up.put(nodehandle)
+
+  def look_up_handles():
+    while True:
+      try:
+        nodehandle = nodehandles_to_look_up.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        handles[nodehandle] = get_handle_from_nodehandle(nodehandle)
+      except Exception, e:
+        errors[nodehandle] = str(e)
+
+  lookup_threads = []
+  for thread_no in range(min(settings.num_nodemanager_lookup_threads, len(nodehandles))):
+    thread = threading.Thread(target=look_up_handles)
+    lookup_threads.append(thread)
+    thread.start()
+  for thread in lookup_threads:
+    thread.join()
+  return handles, errors
+
+
 def _get_acquired_vesseldicts(clearinghouse_vesseldicts, selexor_vesseldicts):
   """
   <Purpose>
@@ -0,0 +1,156 @@
+"""
+<Program Name>
+  selexorsolver.py
+
+<Purpose>
+  Searches for a set of vessels that completes a group under its group
+  rules, using only the candidates that are already in memory.  This lets
+  SeleXor pick a whole group that is known to satisfy the rules before it
+  contacts the clearinghouse, instead of discovering dead ends one vessel at
+  a time.
+
+  The search is a depth-first search over a GroupRuleState.  Vessels whose
+  nodes have the same signature (see GroupRuleState.get_signature()) affect
+  the group rules in the same way, so only one of them is tried at each
+  step.  Whether a partial group can be completed only depends on which
+  signatures it contains, not on the order they were added in, so every
+  combination of signatures that could not be completed is remembered and
+  is not searched again.  If the whole search space is exhausted, there is
+  no way to complete the group.
+
+"""
+
+import random
+import time
+
+import selexorruleparser
+import settings
+
+
+# Outcomes of solve()
+SOLVED = 'solved'
+INFEASIBLE = 'infeasible'
+TIMED_OUT = 'timed out'
+
+
+class _OutOfTime(Exception):
+  ''' Raised inside the search once the time budget is used up. '''
+
+
+def solve(group_state, num_needed, unavailable_vessels=(), time_budget=None, choose_vessel=random.choice):
+  '''
+  <Purpose>
+    Looks for num_needed vessels that can be added to the group together
+    without violating its group rules.
+  <Arguments>
+    group_state:
+      The GroupRuleState of the group.  It is left as it was found.
+    num_needed:
+      The number of vessels to add.
+    unavailable_vessels:
+      A set of (node_id, vesselname) tuples that must not be used.
+    time_budget:
+      The number of seconds to search for.  Defaults to
+      settings.solver_time_budget.
+    choose_vessel:
+      Picks which of a list of interchangeable vessels to use.
+  <Exceptions>
+    None
+  <Side Effects>
+    None
+  <Returns>
+    A tuple (outcome, vessels).
+    SOLVED: vessels is a list of num_needed (node_id, vesselname) tuples.
+    INFEASIBLE: There is no way to complete the group.  vessels is empty.
+    TIMED_OUT: The search did not finish in time.  vessels is empty.
+
+  '''
+  if time_budget is None:
+    time_budget = settings.solver_time_budget
+  if num_needed <= 0:
+    return (SOLVED, [])
+
+  unavailable_vessels = set(unavailable_vessels)
+  usable_vessels = group_state.get_feasible_vessels() - unavailable_vessels
+  if not group_state.has_group_rules():
+    if len(usable_vessels) < num_needed:
+      return (INFEASIBLE, [])
+    usable_vessels = list(usable_vessels)
+    solution = []
+    for vessel_no in range(num_needed):
+      vessel = choose_vessel(usable_vessels)
+      usable_vessels.remove(vessel)
+      solution.append(vessel)
+    return (SOLVED, solution)
+
+  usable_vessels = group_state.vesselset - unavailable_vessels
+  if len(usable_vessels) < num_needed:
+    return (INFEASIBLE, [])
+
+  # Signatures are numbered, in random order so that different searches
+  # find different solutions.
+  signatures = list(set([group_state.get_signature(vessel) for vessel in usable_vessels]))
+  random.shuffle(signatures)
+  signature_numbers = {}
+  for signature_number, signature in enumerate(signatures):
+    signature_numbers[signature] = signature_number
+  vessel_signatures = {}
+  for vessel in usable_vessels:
+    vessel_signatures[vessel] = signature_numbers[group_state.get_signature(vessel)]
+
+  chosen_vessels = []
+  try:
+    if _search(group_state, num_needed, unavailable_vessels, vessel_signatures,
+        [], chosen_vessels, set(), time.time() + time_budget, choose_vessel):
+      return (SOLVED, [selexorruleparser.get_vessel_key(vesseldict) for vesseldict in chosen_vessels])
+    return (INFEASIBLE, [])
+  except _OutOfTime:
+    return (TIMED_OUT, [])
+  finally:
+    for vesseldict in chosen_vessels:
+      group_state.remove_vessel(vesseldict)
+
+
+def _search(group_state, num_needed, unavailable_vessels, vessel_signatures,
+    chosen_signatures, chosen_vessels, dead_ends, deadline, choose_vessel):
+  '''
+  Adds vessels to chosen_vessels (and group_state) until num_needed are
+  chosen.  vessel_signatures maps each usable vessel to the number of its
+  signature, and chosen_signatures holds the signature numbers of chosen_vessels,
+  and dead_ends holds the sorted tuples of signature numbers of partial
+  groups that are known not to lead to a solution.  Returns True if a
+  solution was found, in which case the chosen vessels are left in
+  chosen_vessels.
+
+  '''
+  if len(chosen_vessels) == num_needed:
+    return True
+  if time.time() > deadline:
+    raise _OutOfTime()
+  max_additional_vessels = group_state.get_max_additional_vessels(unavailable_vessels)
+  if max_additional_vessels is not None and max_additional_vessels < num_needed - len(chosen_vessels):
+    return False
+
+  # signature number: feasible vessels with that signature
+  vessels_by_signature = {}
+  for vessel in group_state.get_feasible_vessels() - unavailable_vessels:
+    vessels_by_signature.setdefault(vessel_signatures[vessel], []).append(vessel)
+
+  for signature_number in sorted(vessels_by_signature):
+    combination = tuple(sorted(chosen_signatures + [signature_number]))
+    if combination in dead_ends:
+      continue
+
+    node_id, vesselname = choose_vessel(vessels_by_signature[signature_number])
+    vesseldict = {'node_id': node_id, 'vessel_name': vesselname}
+    group_state.add_vessel(vesseldict)
+    chosen_vessels.append(vesseldict)
+    chosen_signatures.append(signature_number)
+    if _search(group_state, num_needed, unavailable_vessels, vessel_signatures,
+        chosen_signatures, chosen_vessels, dead_ends, deadline, choose_vessel):
+      return True
+    chosen_signatures.pop()
+    chosen_vessels.pop()
+    group_state.remove_vessel(vesseldict)
+    dead_ends.add(combination)
+  return False
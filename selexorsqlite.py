@@ -0,0 +1,262 @@
+"""
+<Program Name>
+  selexorsqlite.py
+
+<Purpose>
+  Lets SeleXor keep its inventory in an embedded SQLite database instead of
+  a MySQL server.  This is used when settings.db_backend is 'sqlite'.
+
+  Connections and cursors behave like MySQLdb's as far as SeleXor uses
+  them: statements are written in MySQL's dialect with %s placeholders and
+  are translated before they run, execute() returns the number of rows
+  selected or changed, and every selected row is fetched up front.
+
+  Database files are opened in WAL mode, so that readers do not wait for
+  the prober's writes.  The path ':memory:' keeps the database in memory;
+  it is shared by every connection in the process, and is gone when the
+  process exits.  Missing tables are created from SCHEMA_FILE the first
+  time a database is opened.
+
+  Needs SQLite 3.35 or later, for row values and upserts.
+
+"""
+
+import re
+import sqlite3
+import threading
+
+
+# The tables, in SQLite's dialect.
+SCHEMA_FILE = 'database_create_sqlite.sql'
+
+# The path that keeps the database in memory.
+MEMORY_PATH = ':memory:'
+
+# The number of seconds to wait for another connection to finish writing.
+BUSY_TIMEOUT = 30
+
+# (pattern, replacement) for each MySQL construct that SQLite spells
+# differently.
+_TRANSLATIONS = [
+  (re.compile(r"^(\s*)INSERT\s+IGNORE\b", re.IGNORECASE), r"\1INSERT OR IGNORE"),
+  (re.compile(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", re.IGNORECASE), "ON CONFLICT DO UPDATE SET"),
+  (re.compile(r"\bNOW\(\s*\)", re.IGNORECASE), "datetime('now', 'localtime')"),
+  (re.compile(r"^(\s*)SHOW\s+TABLES\s+LIKE\b", re.IGNORECASE),
+    r"\1SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE"),
+]
+
+# VALUES(column) in an upsert refers to the value that was to be inserted.
+_UPSERT_VALUE_PATTERN = re.compile(r"\bVALUES\s*\(\s*(\w+)\s*\)", re.IGNORECASE)
+_UPSERT_CLAUSE = "ON CONFLICT DO UPDATE SET"
+
+_PLACEHOLDER_PATTERN = re.compile(r"%([s%])")
+
+# path: SQLiteConnection, for databases that are shared by all connections.
+_shared_connections = {}
+# The paths of the databases whose tables were created.
+_initialized_paths = set()
+_connect_lock = threading.Lock()
+
+
+def translate_command(command, has_parameters):
+  '''
+  <Purpose>
+    Translates a statement from MySQL's dialect to SQLite's.
+  <Arguments>
+    command:
+      The statement.
+    has_parameters:
+      Whether parameters are given for the statement, in which case its %s
+      placeholders are replaced and %% stands for %, as in MySQLdb.
+  <Exceptions>
+    None
+  <Side Effects>
+    None
+  <Returns>
+    The translated statement.
+
+  '''
+  for pattern, replacement in _TRANSLATIONS:
+    command = pattern.sub(replacement, command)
+  if _UPSERT_CLAUSE in command:
+    insert, update = command.split(_UPSERT_CLAUSE, 1)
+    command = insert + _UPSERT_CLAUSE + _UPSERT_VALUE_PATTERN.sub(r"excluded.\1", update)
+  if has_parameters:
+    command = _PLACEHOLDER_PATTERN.sub(
+      lambda match: match.group(1) == 's' and '?' or '%', command)
+  return command
+
+
+def _adapt_parameter(parameter):
+  # SQLite cuts text off at the first NUL, so binary strings (e.g. pickled
+  # requests) are stored as blobs.  They are read back as buffers.
+  if isinstance(parameter, str) and '\0' in parameter:
+    return buffer(parameter)
+  return parameter
+
+
+def is_transient_error(error):
+  ''' Returns whether a statement that raised error should be run again. '''
+  return (isinstance(error, sqlite3.OperationalError) and
+    'locked' in str(error))
+
+
+def connect(path):
+  '''
+  <Purpose>
+    Opens a SQLite database.
+  <Arguments>
+    path:
+      The path of the database file, or MEMORY_PATH.
+  <Exceptions>
+    sqlite3.Error
+  <Side Effects>
+    Creates the database and its tables, if they don't exist yet.
+  <Returns>
+    A db and cursor object representing the connection.
+
+  '''
+  _connect_lock.acquire()
+  try:
+    if path in _shared_connections:
+      db = _shared_connections[path]
+    else:
+      db = SQLiteConnection(path)
+      if path == MEMORY_PATH:
+        _shared_connections[path] = db
+      if path not in _initialized_paths:
+        create_tables(db.cursor())
+        _initialized_paths.add(path)
+  finally:
+    _connect_lock.release()
+  return db, db.cursor()
+
+
+def create_tables(cursor):
+  ''' Creates the tables in SCHEMA_FILE that don't exist yet. '''
+  code = open(SCHEMA_FILE, 'r').read()
+  for statement in code.split(';'):
+    if statement.strip():
+      cursor.execute(statement.strip())
+
+
+
+class SQLiteConnection:
+  '''
+  A connection to a SQLite database, with the methods of a MySQLdb
+  connection that SeleXor uses.  It may be used from any thread.
+
+  '''
+  def __init__(self, path):
+    self._path = path
+    self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False,
+      detect_types=sqlite3.PARSE_DECLTYPES)
+    # Read text back as str, as MySQLdb does.
+    self._db.text_factory = str
+    if path != MEMORY_PATH:
+      self._db.execute("PRAGMA journal_mode=WAL")
+      # Safe in WAL mode; only a power loss can undo the latest commits.
+      self._db.execute("PRAGMA synchronous=NORMAL")
+    # Shared connections are used by several threads at once.
+    self._lock = threading.RLock()
+
+
+  def cursor(self):
+    return SQLiteCursor(self)
+
+
+  def commit(self):
+    self._lock.acquire()
+    try:
+      self._db.commit()
+    finally:
+      self._lock.release()
+
+
+  def rollback(self):
+    self._lock.acquire()
+    try:
+      self._db.rollback()
+    finally:
+      self._lock.release()
+
+
+  def close(self):
+    # The in-memory database would be lost.
+    if self._path not in _shared_connections:
+      self._db.close()
+
+
+
+class SQLiteCursor:
+  '''
+  A cursor of a SQLiteConnection, with the methods of a MySQLdb cursor that
+  SeleXor uses.
+
+  '''
+  def __init__(self, connection):
+    self._connection = connection
+    self._rows = []
+    self._next_row = 0
+    self.rowcount = -1
+    self.lastrowid = None
+
+
+  def execute(self, command, parameters=None):
+    '''
+    <Purpose>
+      Runs a statement written in MySQL's dialect.
+    <Arguments>
+      command:
+        The statement.
+      parameters:
+        Optional sequence of values to substitute for the %s placeholders in
+        the statement.
+    <Exceptions>
+      sqlite3.Error
+    <Side Effects>
+      Runs the statement, and fetches every row it selects.
+    <Returns>
+      The number of rows selected or changed.
+
+    '''
+    command = translate_command(command, parameters is not None)
+    if parameters is None:
+      parameters = []
+    parameters = [_adapt_parameter(parameter) for parameter in parameters]
+
+    self._connection._lock.acquire()
+    try:
+      cursor = self._connection._db.cursor()
+      try:
+        cursor.execute(command, parameters)
+        if cursor.description is None:
+          self._rows = []
+          self.rowcount = cursor.rowcount
+        else:
+          self._rows = cursor.fetchall()
+          self.rowcount = len(self._rows)
+        self.lastrowid = cursor.lastrowid
+      finally:
+        cursor.close()
+    finally:
+      self._connection._lock.release()
+    self._next_row = 0
+    return self.rowcount
+
+
+  def fetchone(self):
+    if self._next_row >= len(self._rows):
+      return None
+    self._next_row += 1
+    return self._rows[self._next_row - 1]
+
+
+  def fetchall(self):
+    rows = self._rows[self._next_row:]
+    self._next_row = len(self._rows)
+    return tuple(rows)
+
+
+  def close(self):
+    self._rows = []
@@ -0,0 +1,289 @@
+"""
+<Program Name>
+  selexortrace.py
+
+<Purpose>
+  Records how long each step of a request's resolution takes, so that the
+  time spent on a slow request can be attributed to database queries, rule
+  evaluation, or calls to the clearinghouse.
+
+  Each request is traced as a tree of spans.  A span covers one step, such
+  as a group, a pass, a rule, a database query or a clearinghouse call, and
+  records when it started, how long it took and how many results it had.
+  Spans are only recorded while a trace is in progress in the current
+  thread, so work that is not done on behalf of a request (such as probing)
+  is not traced.
+
+  Spans are written to settings.trace_file, one JSON object per line, and
+  the file is rotated once it grows past settings.trace_max_bytes.  Each
+  line contains:
+    'trace': The ID of the request the span belongs to.
+    'span': The ID of the span.
+    'parent': The ID of the enclosing span, or None.
+    'name': What the span covers, e.g. 'clearinghouse.acquire_specific_vessels'.
+    'start': When the span started, in seconds since the epoch.
+    'duration': How long the span took, in seconds.
+    Any attributes given to the span, such as result sizes.
+
+  Running this module prints the count, total, median and 99th percentile
+  duration of each kind of span, optionally for a single request:
+    python selexortrace.py [request_id]
+
+"""
+
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+
+import settings
+
+
+# The span that is in progress in each thread.
+_local = threading.local()
+_span_ids = itertools.count(1)
+
+_trace_logger = None
+_trace_logger_lock = threading.Lock()
+
+
+class Span:
+  def __init__(self, trace_id, name, parent_id, attributes):
+    self.trace_id = trace_id
+    self.span_id = _span_ids.next()
+    self.parent_id = parent_id
+    self.name = name
+    self.attributes = attributes
+    self.start = None
+    self._previous_span = None
+
+
+  def set(self, **attributes):
+    ''' Adds attributes to the span, such as the number of results. '''
+    self.attributes.update(attributes)
+
+
+  def __enter__(self):
+    self._previous_span = getattr(_local, 'span', None)
+    _local.span = self
+    self.start = time.time()
+    return self
+
+
+  def __exit__(self, exc_type, exc_value, exc_traceback):
+    duration = time.time() - self.start
+    _local.span = self._previous_span
+    if exc_type is not None:
+      self.attributes['error'] = exc_type.__name__
+    record = dict(self.attributes)
+    record.update({
+      'trace': self.trace_id,
+      'span': self.span_id,
+      'parent': self.parent_id,
+      'name': self.name,
+      'start': self.start,
+      'duration': duration,
+    })
+    _write(record)
+    return False
+
+
+
+class _NullSpan:
+  ''' Stands in for a span when nothing is being traced. '''
+  def set(self, **attributes):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, exc_traceback):
+    return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def start_trace(trace_id, name, **attributes):
+  '''
+  <Purpose>
+    Starts tracing a request.  Use the returned span in a with statement;
+    spans started inside it are recorded as its descendants.
+  <Arguments>
+    trace_id:
+      The ID of the request.
+    name:
+      What the span covers.
+    attributes:
+      Attributes to record with the span.
+  <Exceptions>
+    None
+  <Side Effects>
+    None
+  <Returns>
+    The root span of the trace.  If settings.trace_enabled is not set, a
+    span that records nothing is returned.
+
+  '''
+  if not settings.trace_enabled:
+    return _NULL_SPAN
+  return Span(str(trace_id), name, None, attributes)
+
+
+def span(name, parent=None, **attributes):
+  '''
+  <Purpose>
+    Starts a span.  Use the returned span in a with statement.
+  <Arguments>
+    name:
+      What the span covers.
+    parent:
+      The enclosing span.  Defaults to the span that is in progress in this
+      thread.  Spans that are started in a thread other than their parent's
+      must be given it.
+    attributes:
+      Attributes to record with the span.
+  <Exceptions>
+    None
+  <Side Effects>
+    None
+  <Returns>
+    The new span.  If there is no enclosing span, a span that records
+    nothing is returned.
+
+  '''
+  if parent is None:
+    parent = getattr(_local, 'span', None)
+  if parent is None or parent is _NULL_SPAN:
+    return _NULL_SPAN
+  return Span(parent.trace_id, name, parent.span_id, attributes)
+
+
+def current_span():
+  ''' Returns the span that is in progress in this thread. '''
+  return getattr(_local, 'span', None) or _NULL_SPAN
+
+
+def _write(record):
+  global _trace_logger
+  if _trace_logger is None:
+    _trace_logger_lock.acquire()
+    try:
+      if _trace_logger is None:
+        handler = logging.handlers.RotatingFileHandler(settings.trace_file,
+          maxBytes=settings.trace_max_bytes, backupCount=settings.trace_backup_count)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        trace_logger = logging.getLogger(__name__)
+        trace_logger.setLevel(logging.INFO)
+        # Keep spans out of the regular logs.
+        trace_logger.propagate = False
+        trace_logger.addHandler(handler)
+        _trace_logger = trace_logger
+    finally:
+      _trace_logger_lock.release()
+  _trace_logger.info(json.dumps(record))
+
+
+def load_spans(trace_file=None, trace_id=None):
+  '''
+  <Purpose>
+    Reads the spans that were written to the trace file and the files it
+    was rotated into.
+  <Arguments>
+    trace_file:
+      The trace file to read.  Defaults to settings.trace_file.
+    trace_id:
+      If given, only the spans of this request are returned.
+  <Exceptions>
+    IOError if the trace file cannot be read.
+  <Side Effects>
+    None
+  <Returns>
+    A list of span records, as dictionaries, oldest file first.
+
+  '''
+  if trace_file is None:
+    trace_file = settings.trace_file
+  paths = []
+  for backup_no in range(settings.trace_backup_count, 0, -1):
+    if os.path.exists(trace_file + '.' + str(backup_no)):
+      paths.append(trace_file + '.' + str(backup_no))
+  paths.append(trace_file)
+
+  spans = []
+  for path in paths:
+    tracefile = open(path)
+    try:
+      for line in tracefile:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # The line was cut off by a crash.
+          continue
+        if trace_id is None or record['trace'] == trace_id:
+          spans.append(record)
+    finally:
+      tracefile.close()
+  return spans
+
+
+def summarize(spans):
+  '''
+  <Purpose>
+    Works out how long each kind of span takes.
+  <Arguments>
+    spans:
+      A list of span records, as returned by load_spans().
+  <Exceptions>
+    None
+  <Side Effects>
+    None
+  <Returns>
+    A dictionary mapping each span name to a dictionary containing the
+    'count', 'total', 'p50', 'p99' and 'max' of the durations of the spans
+    with that name, in seconds.
+
+  '''
+  durations_by_name = {}
+  for record in spans:
+    durations_by_name.setdefault(record['name'], []).append(record['duration'])
+
+  summary = {}
+  for name, durations in durations_by_name.iteritems():
+    durations.sort()
+    summary[name] = {
+      'count': len(durations),
+      'total': sum(durations),
+      'p50': _get_percentile(durations, 50),
+      'p99': _get_percentile(durations, 99),
+      'max': durations[-1],
+    }
+  return summary
+
+
+def _get_percentile(sorted_values, percentile):
+  # Nearest rank
+  rank = max(1, int(round(percentile / 100.0 * len(sorted_values))))
+  return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def main():
+  trace_id = None
+  if len(sys.argv) > 1:
+    trace_id = sys.argv[1]
+  summary = summarize(load_spans(trace_id=trace_id))
+
+  print "%-45s %8s %10s %10s %10s %10s" % ('span', 'count', 'total', 'p50', 'p99', 'max')
+  # Where most of the time went first
+  for name in sorted(summary, key=lambda name: -summary[name]['total']):
+    stats = summary[name]
+    print "%-45s %8d %10.4f %10.4f %10.4f %10.4f" % (name, stats['count'],
+      stats['total'], stats['p50'], stats['p99'], stats['max'])
+
+
+if __name__ == '__main__':
+  main()
@@ -68,6 +68,11 @@ TEMPLATE_INDEX_FN = 'web_ui_template.html'
 INDEX_FN = 'index.html'
 WEB_PATH = './web/'
 
+# Serialized status responses, reused until the request they describe changes.
+# (username, remoteip, request_id as sent by the client):
+#   ((request version, version the client saw), serialized response)
+_status_response_cache = {}
+
 
 
 
@@ -188,6 +193,12 @@ class SelexorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   <Example Use>
     http_server = BaseHTTPServer.HTTPServer(IP, PORT), SelexorHandler)
   '''
+  # Keep connections open between requests, so that clients that poll for
+  # their status do not need a new TLS handshake every time.  Every
+  # response must therefore have a Content-Length.
+  protocol_version = 'HTTP/1.1'
+  # Connections that stay idle for this long are closed.
+  timeout = settings.http_keepalive_timeout
 
   def do_GET(self):
     ''' Serves files that are needed for the SeleXor web client. '''
@@ -215,13 +226,13 @@ class SelexorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       self.send_response(200)
       self.send_header("Content-type", self._get_mime_type_from_path(filepath))
       self.send_header("Content-Length", str(data_length))
-      self.send_header("Connection", "Close")
 
     except IOError, e:
       # Cannot find file
       logger.error(str(e))
       # We can't find the file, send HTTP 404 NOT FOUND error message
       self.send_response(404)
+      self.send_header("Content-Length", "0")
     finally:
       self.end_headers()
 
@@ -263,6 +274,8 @@ class SelexorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       'request': self._handle_host_request,
       'query': self._handle_status_query,
       'release': self._release_vessel,
+      'cancel': self._cancel_request,
+      'explain': self._explain_request,
     }
 
     remoteip = self.client_address[0]
@@ -273,13 +286,17 @@ class SelexorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       postdict = serialize_repy.serialize_deserializedata(rawdata)
       action = postdict.keys()[0]
       response['action'] = action + "_response"
-      if action in self.action_handlers:
+      if action == 'query':
+        # Status queries are the most frequent action, so their responses
+        # are serialized once per request version.
+        output = self._get_status_query_response(postdict[action], remoteip)
+      elif action in self.action_handlers:
         data_to_send = self.action_handlers[action](postdict[action], remoteip)
+        response['status'] = 'ok'
+        response['data'] = data_to_send
+        output = serialize_repy.serialize_serializedata(response)
       else:
         raise selexorexceptions.SelexorInvalidRequest("Unknown Action: " + action)
-      response['status'] = 'ok'
-      response['data'] = data_to_send
-      output = serialize_repy.serialize_serializedata(response)
     except:
       # Catch all exceptions/errors that happen and log them.
       # Then tell the user an internal error occurred.
@@ -288,11 +305,11 @@ class SelexorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       data_to_send = None
       response['status'] = 'error'
       response['error'] = errstr
+      output = serialize_repy.serialize_serializedata(response)
 
     # Send HTTP 200 OK message since this is a good request
     self.send_response(200)
     self.send_header("Content-Length", str(len(output)))
-    self.send_header("Connection", "Close")
     self.end_headers()
 
     self.wfile.write(output)
@@ -316,9 +333,12 @@ class SelexorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     '''
     response_dict = {}
     try:
-      client = selexorhelper.connect_to_clearinghouse(data)
-      accinfo = client.get_account_info()
-      acquired_resources = client.get_resource_info()
+      client = selexorhelper.clearinghouse_sessions.checkout(data)
+      try:
+        accinfo = client.get_account_info()
+        acquired_resources = client.get_resource_info()
+      finally:
+        selexorhelper.clearinghouse_sessions.checkin(client)
 
       response_dict['status'] = 'ok'
       response_dict['max_hosts'] = accinfo['max_vessels'] - len(acquired_resources)
@@ -342,17 +362,88 @@ class SelexorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
   def _handle_host_request(self, data, remoteip):
     ''' Wrapper for selexor server's host request function. '''
-    return selexor_server.handle_request(data['userdata'], data['groups'], remoteip)
+    return selexor_server.handle_request(data['userdata'], data['groups'], remoteip,
+      data.get('time_budget'), data.get('release_on_timeout', False))
+
+
+  def _explain_request(self, data, remoteip):
+    ''' Wrapper for selexor server's request explanation function. '''
+    return selexor_server.explain_request(data['userdata'], data['groups'], remoteip)
 
 
   def _handle_status_query(self, data, remoteip):
     ''' Wrapper for selexor server's status query function. '''
-    return selexor_server.get_request_status(data['userdata'], remoteip)
+    return selexor_server.get_request_status(data['userdata'], remoteip,
+      data.get('version'), data.get('request_id'))
+
+
+  def _get_status_query_response(self, data, remoteip):
+    '''
+    <Purpose>
+      Returns the serialized response to a status query.  The response is
+      reused for as long as the request it describes does not change.
+
+      If the query contains the 'version' of the request that the client
+      last saw, the response is held back until the request changes, or
+      until settings.status_long_poll_timeout seconds have passed, and only
+      what changed since that version is sent.  The response contains the
+      'version' it describes.
+    <Arguments>
+      data:
+        The data sent with the query action.
+      remoteip:
+        The IP address of the remote machine.
+    <Exceptions>
+      None
+    <Side Effects>
+      Caches the serialized response.
+      May block for up to settings.status_long_poll_timeout seconds.
+    <Returns>
+      The serialized response, as a string.
+
+    '''
+    authinfo = data['userdata']
+    request_id = data.get('request_id')
+    identity = (authinfo.keys()[0], remoteip, request_id)
+    # Read the version before building the response, so that a change made
+    # while the response is being built invalidates it.
+    if data.get('version') is not None:
+      version = selexor_server.wait_for_request_change(
+        authinfo, remoteip, data['version'], settings.status_long_poll_timeout, request_id)
+    else:
+      version = selexor_server.get_request_version(authinfo, remoteip, request_id)
+    cache_key = (version, data.get('version'))
+    cached_response = _status_response_cache.get(identity)
+    if version is not None and cached_response and cached_response[0] == cache_key:
+      return cached_response[1]
+
+    output = serialize_repy.serialize_serializedata({
+      'action': 'query_response',
+      'status': 'ok',
+      'version': version,
+      'data': self._handle_status_query(data, remoteip),
+    })
+    if version is None:
+      _status_response_cache.pop(identity, None)
+    else:
+      # Entries of requests that expired are never looked up again, so start
+      # over once there are more entries than the server keeps requests.
+      if len(_status_response_cache) > 2 * settings.max_finished_requests:
+        _status_response_cache.clear()
+      _status_response_cache[identity] = (cache_key, output)
+    return output
 
 
   def _release_vessel(self, data, remoteip):
     ''' Wrapper for selexor server's vessel release function.'''
-    return selexor_server.release_vessels(data['userdata'], data['vessels'], remoteip)
+    return selexor_server.release_vessels(data['userdata'], data['vessels'], remoteip,
+      data.get('request_id'))
+
+
+  def _cancel_request(self, data, remoteip):
+    ''' Wrapper for selexor server's request cancellation function. '''
+    return selexor_server.cancel_request(data['userdata'], remoteip,
+      data.get('request_id'), data.get('release', False))
 
 
   def _get_mime_type_from_path(self, path):
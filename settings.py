@@ -16,6 +16,14 @@ http_ip_addr = '0.0.0.0'
 # Listens on the HTTPS port by default.
 http_port = 443
 
+# Clients waiting for their request to change get a response after at most
+# this many seconds, even if nothing changed.  Keep this below the idle
+# timeout of any proxy between SeleXor and its users.
+status_long_poll_timeout = 25
+
+# Idle HTTP connections are closed after this many seconds.
+http_keepalive_timeout = 60
+
 
 """
 HTTPS Configuration
@@ -41,6 +49,122 @@ path_to_seattle_trunk = '/path/to/seattle/trunk'
 # Set this to 1 to disable threading.
 num_probe_threads = 4
 
+# The maximum number of groups of a single request to resolve at the same
+# time.  Each thread uses its own database connection and clearinghouse
+# client.
+# Set this to 1 to resolve groups one after another.
+num_group_resolution_threads = 4
+
+# Vessels are leased to a resolution while it tries to acquire them, so that
+# concurrent resolutions do not compete for the same vessels.
+# The time a lease is held while its vessel is being acquired, in seconds.
+vessel_lease_duration = 60
+
+# The time a lease is kept after its vessel is acquired, in seconds.  This
+# should match how long the clearinghouse lets users keep their vessels.
+# Releasing vessels through SeleXor ends their leases early.
+vessel_commit_lease_duration = 4 * 60 * 60
+
+# If set to True, leases are stored in the database's vessel_leases table,
+# so that they are shared between SeleXor instances that use the same
+# database.  Otherwise, leases are kept in memory.
+use_database_vessel_leases = False
+
+# SeleXor picks more candidates than each group needs, in proportion to the
+# fraction of vessels that the clearinghouse recently refused to give out,
+# and releases whatever it does not need afterwards.  This lets most groups
+# be resolved in a single round trip to the clearinghouse.
+# The smallest and largest multiples of the needed vessels to pick.
+min_acquisition_overshoot_factor = 1.0
+max_acquisition_overshoot_factor = 2.0
+
+# If set to True, the vessel rules of a group that support it are turned
+# into a single query, so that the database does the filtering and only
+# returns the final candidates.  Other vessel rules are applied afterwards.
+compile_vessel_rules = True
+
+# Nodes that have not been seen for this many seconds are not offered to
+# users.  None offers nodes no matter when they were last seen.
+node_offline_timeout = None
+
+# The number of seconds to spend searching for a complete group that
+# satisfies the group rules before contacting the clearinghouse.  If the
+# search runs out of time, vessels are picked one at a time instead.
+solver_time_budget = 2
+
+# The same, for requests that are only being explained to the user.  This is
+# kept short because the web interface explains requests as they are edited.
+explain_solver_time_budget = 0.5
+
+# Vessels that could not be acquired are not offered to anyone for this many
+# seconds.
+failed_vessel_ttl = 10 * 60
+
+# Vessels are picked with a probability that depends on how often they and
+# their nodes were acquired successfully.  This is the weight that each new
+# acquisition attempt has on the smoothed success rate.
+reliability_smoothing = 0.3
+
+# The success rate assumed for vessels on nodes that SeleXor has not tried
+# to acquire yet.
+default_vessel_reliability = 0.8
+
+# The maximum number of vessels to keep success rates for.
+max_reliability_entries = 100000
+
+# The maximum number of vessels to acquire in a single clearinghouse call.
+acquisition_batch_size = 50
+
+# The number of requests that are resolved at the same time.  Each of these
+# uses up to num_group_resolution_threads threads, database connections and
+# clearinghouse clients.
+num_resolution_workers = 8
+
+# The maximum number of requests that each user can have in progress at the
+# same time.  Further requests are refused until one of them finishes.
+max_active_requests_per_user = 10
+
+# The maximum number of requests that can wait for a free worker.  Requests
+# past this are refused until the queue shrinks.
+max_queued_requests = 100
+
+# Finished requests are forgotten this many seconds after they last changed.
+request_state_ttl = 24 * 60 * 60
+
+# The maximum number of finished requests to remember.  The least recently
+# used ones are forgotten first.
+max_finished_requests = 1000
+
+# Requests are split between this many independently locked groups.
+num_request_store_stripes = 16
+
+# If set to True, requests are saved to the database's request_states table
+# so that they survive restarts.  Requests that were being served when
+# SeleXor stopped are resumed the next time their user checks on them.
+persist_request_state = False
+
+# How often changed requests are saved, in seconds.
+request_state_persist_interval = 5
+
+# The maximum number of vessels to release in a single clearinghouse call.
+release_batch_size = 50
+
+# The maximum number of nodemanagers to contact at once when looking up the
+# handles of vessels that are being released.
+num_nodemanager_lookup_threads = 16
+
+# If set to True, the time spent on each step of every request's resolution
+# is written to trace_file.  Run selexortrace.py to summarize it.  Every
+# database query, rule and clearinghouse call is recorded, so only turn this
+# on while looking into slow requests.
+trace_enabled = False
+trace_file = 'selexor_trace.jsonl'
+
+# The trace file is rotated once it grows past this many bytes, and this
+# many rotated files are kept.
+trace_max_bytes = 10 * 1024 * 1024
+trace_backup_count = 5
+
 # The path to the file that contains the nodestate transition key.
 # The key specified must be the nodestate transition key for the same
 # clearinghouse specified at clearinghouse_xmlrpc_url.
@@ -61,6 +185,23 @@ geoip_server_url = None
 # Sets the use of SSL in insecure mode.
 allow_ssl_insecure = False
 
+# Clearinghouse clients are kept open and reused by later actions of the
+# same user.  The time an unused client is kept, in seconds.
+clearinghouse_session_idle_timeout = 5 * 60
+
+# The maximum number of unused clients to keep for each user.
+max_idle_clearinghouse_sessions_per_user = 4
+
+# The time to wait for the clearinghouse to respond to a call that only reads
+# information, in seconds.  Calls that acquire or release vessels are waited
+# on for as long as they take, since they may still succeed after a timeout.
+clearinghouse_call_timeout = 120
+
+# Calls that only read information (e.g. get_account_info) are sent a second
+# time if they take longer than this many seconds, and the first response is
+# used.
+clearinghouse_hedge_delay = 5
+
 # The time to wait after a probe before probing again, in seconds.
 # Default is 10 minutes.
 probe_delay = 10 * 60
@@ -71,6 +212,12 @@ probe_delay = 10 * 60
 # This is useful when changing the way node types are determined.
 force_refresh_node_type = False
 
+# The time to keep the in-memory copy of node identities (node_id, node_key,
+# IP address and port) before reloading it from the database, in seconds.
+# Nodes are only added or changed when the database is probed, so this
+# defaults to the probe delay.
+node_cache_refresh_interval = probe_delay
+
 """
 Database Configurations
 
@@ -78,6 +225,16 @@ This section defines which database and what users selexor is allowed to
 connect as.
 """
 
+# The database to keep the inventory in.
+# 'mysql' uses the MySQL server on localhost, configured below.
+# 'sqlite' uses an embedded SQLite database at sqlite_path, which needs no
+# server.  This suits small deployments, tests and benchmarks.
+db_backend = 'mysql'
+
+# The SQLite database file.  Its tables are created when it is first opened.
+# ':memory:' keeps the database in memory, for as long as SeleXor runs.
+sqlite_path = 'selexor.sqlite'
+
 # This is the name of the database that we should connect to.
 # Make sure to set it to the database that you created for selexor.
 dbname = 'selexordb'
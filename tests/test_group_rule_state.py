@@ -0,0 +1,178 @@
+"""
+<Program Name>
+  test_group_rule_state.py
+
+<Purpose>
+  Checks that GroupRuleState, which updates the group rules incrementally,
+  agrees with re-evaluating the rules from scratch through
+  apply_group_rules() and get_worst_vessel(), for random groups under every
+  group rule that has a tracker, inverted and not.
+
+  The inventory is kept in an in-memory SQLite database, so no MySQL server
+  is needed.
+
+<Usage>
+  Set path_to_seattle_trunk in settings.py, then from the SeleXor directory:
+    python -m unittest discover tests
+
+"""
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import settings
+settings.db_backend = 'sqlite'
+settings.sqlite_path = ':memory:'
+
+import selexorhelper
+import selexorruleparser
+
+
+# (city, country_code, latitude, longitude).  Some cities are close to each
+# other, so that radius rules pass for some pairs of nodes and not others.
+CITIES = [
+  ('Seattle', 'US', 47.6, -122),
+  ('Tacoma', 'US', 47.3, -122),
+  ('New York', 'US', 40.7, -74),
+  ('Berlin', 'DE', 52.5, 13),
+  ('Potsdam', 'DE', 52.4, 13),
+  ('Tokyo', 'JP', 35.7, 140),
+  ('Sydney', 'AU', -33.9, 151),
+]
+
+NUM_NODES = 60
+MAX_VESSELS_PER_NODE = 3
+NUM_GROUPS = 40
+
+# rule name: unprocessed parameters to test the rule with
+RULES = {
+  'location_different': [
+    {'location_count': '4', 'location_type': 'city'},
+    {'location_count': '3', 'location_type': 'country_code'},
+  ],
+  'location_separation_radius': [
+    {'min_radius': '0', 'max_radius': '100'},
+    {'min_radius': '500', 'max_radius': '20000'},
+  ],
+}
+
+
+def fill_inventory(cursor, rng, num_nodes=NUM_NODES, max_vessels_per_node=MAX_VESSELS_PER_NODE):
+  '''
+  Replaces the inventory with num_nodes random nodes, each with 1 to
+  max_vessels_per_node vessels.  Returns the vesseldicts of every vessel.
+
+  '''
+  for table in ('vesselports', 'vessels', 'nodes', 'location'):
+    selexorhelper.autoretry_mysql_command(cursor, "DELETE FROM " + table)
+
+  vesseldicts = []
+  for node_id in range(1, num_nodes + 1):
+    ip_addr = '10.0.0.' + str(node_id)
+    node_key = 'nodekey' + str(node_id)
+    selexorhelper.autoretry_mysql_command(cursor,
+      "INSERT INTO nodes (node_id, node_key, node_port, node_type, ip_addr, last_ip_change, last_seen) "
+      "VALUES (%s, %s, 1224, 'unknown', %s, NOW(), NOW())", (node_id, node_key, ip_addr))
+    # Some nodes have no location, as happens when the GeoIP lookup fails.
+    if rng.random() < 0.9:
+      city, country_code, latitude, longitude = rng.choice(CITIES)
+      selexorhelper.autoretry_mysql_command(cursor,
+        "INSERT INTO location (ip_addr, city, country_code, latitude, longitude) VALUES (%s, %s, %s, %s, %s)",
+        (ip_addr, city, country_code, latitude, longitude))
+    for vessel_no in range(rng.randint(1, max_vessels_per_node)):
+      vesselname = 'v' + str(vessel_no + 3)
+      selexorhelper.autoretry_mysql_command(cursor,
+        "INSERT INTO vessels (node_id, vessel_name) VALUES (%s, %s)", (node_id, vesselname))
+      vesseldicts.append({
+        'node_id': node_id,
+        'vessel_name': vesselname,
+        'node_key': node_key,
+        'handle': node_key + ':' + vesselname,
+      })
+  return vesseldicts
+
+
+class GroupRuleStateTest(unittest.TestCase):
+  def setUp(self):
+    self.rng = random.Random(0)
+    self.db, self.cursor = selexorhelper.connect_to_db()
+    self.vesseldicts = fill_inventory(self.cursor, self.rng)
+    self.vesselset = set([selexorruleparser.get_vessel_key(vesseldict)
+      for vesseldict in self.vesseldicts])
+
+
+  def tearDown(self):
+    self.db.close()
+
+
+  def _get_rule_sets(self):
+    # Yields every rule on its own, inverted and not, and both rules together.
+    for rule_name, parameter_sets in sorted(RULES.items()):
+      for parameters in parameter_sets:
+        for invert in (False, True):
+          rule_params = dict(parameters)
+          if invert:
+            rule_params['invert'] = True
+          yield {rule_name: rule_params}
+    yield {
+      'location_different': dict(RULES['location_different'][0]),
+      'location_separation_radius': dict(RULES['location_separation_radius'][1]),
+    }
+
+
+  def _get_random_groups(self):
+    for group_no in range(NUM_GROUPS):
+      yield self.rng.sample(self.vesseldicts, self.rng.randint(1, 6))
+
+
+  def test_feasible_vessels(self):
+    for rules in self._get_rule_sets():
+      rules = selexorruleparser.preprocess_rules(rules)
+      for acquired_vessels in self._get_random_groups():
+        group_state = selexorruleparser.GroupRuleState(
+          rules, self.cursor, self.vesselset, acquired_vessels)
+        acquired_keys = set([selexorruleparser.get_vessel_key(vesseldict)
+          for vesseldict in acquired_vessels])
+        expected = selexorruleparser.apply_group_rules(
+          rules, self.cursor, self.vesselset, acquired_vessels)
+        self.assertEqual(set(expected) - acquired_keys,
+          group_state.get_feasible_vessels(), str(rules))
+
+
+  def test_worst_vessel(self):
+    for rules in self._get_rule_sets():
+      rules = selexorruleparser.preprocess_rules(rules)
+      for acquired_vessels in self._get_random_groups():
+        group_state = selexorruleparser.GroupRuleState(
+          rules, self.cursor, self.vesselset, acquired_vessels)
+        expected = selexorruleparser.get_worst_vessel(
+          acquired_vessels, self.vesselset, self.cursor, rules)
+        self.assertEqual(expected, group_state.get_worst_vessel(acquired_vessels), str(rules))
+
+
+  def test_worst_vessel_after_changes(self):
+    # The trackers must give the same answer after vessels are added and
+    # removed as they do when created with the final group.
+    for rules in self._get_rule_sets():
+      rules = selexorruleparser.preprocess_rules(rules)
+      group_state = selexorruleparser.GroupRuleState(rules, self.cursor, self.vesselset)
+      for step in range(NUM_GROUPS):
+        if group_state.acquired_vessels and self.rng.random() < 0.4:
+          group_state.remove_vessel(self.rng.choice(group_state.acquired_vessels))
+        else:
+          group_state.add_vessel(self.rng.choice(self.vesseldicts))
+        if not group_state.acquired_vessels:
+          continue
+        acquired_vessels = list(group_state.acquired_vessels)
+        expected = selexorruleparser.get_worst_vessel(
+          acquired_vessels, self.vesselset, self.cursor, rules)
+        self.assertEqual(expected, group_state.get_worst_vessel(acquired_vessels), str(rules))
+
+
+
+if __name__ == '__main__':
+  unittest.main()
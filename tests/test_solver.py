@@ -0,0 +1,130 @@
+"""
+<Program Name>
+  test_solver.py
+
+<Purpose>
+  Checks selexorsolver.solve() against an exhaustive search over small
+  random inventories: when it finds a group, the group must satisfy the
+  group rules, and when it says that there is none, the exhaustive search
+  must not find one either.
+
+  Uses the in-memory SQLite inventory of test_group_rule_state.py.
+
+<Usage>
+  Set path_to_seattle_trunk in settings.py, then from the SeleXor directory:
+    python -m unittest discover tests
+
+"""
+
+import itertools
+import random
+import unittest
+
+# Sets up the SQLite backend, so it must be imported first.
+import test_group_rule_state
+
+import selexorhelper
+import selexorruleparser
+import selexorsolver
+
+
+NUM_INVENTORIES = 6
+NUM_NODES = 6
+MAX_GROUP_SIZE = 5
+
+RULE_SETS = [
+  {'location_different': {'location_count': '3', 'location_type': 'country_code'}},
+  {'location_different': {'location_count': '2', 'location_type': 'city', 'invert': True}},
+  {'location_separation_radius': {'min_radius': '0', 'max_radius': '6000'}},
+  {'location_separation_radius': {'min_radius': '3000', 'max_radius': '20000', 'invert': True}},
+  {
+    'location_separation_radius': {'min_radius': '1000', 'max_radius': '15000'},
+    'location_different': {'location_count': '3', 'location_type': 'country_code'},
+  },
+]
+
+
+class SolverTest(unittest.TestCase):
+  def setUp(self):
+    self.rng = random.Random(0)
+    self.db, self.cursor = selexorhelper.connect_to_db()
+
+
+  def tearDown(self):
+    self.db.close()
+
+
+  def _fill_inventory(self):
+    # One vessel per node keeps the exhaustive search small.
+    self.vesseldicts = test_group_rule_state.fill_inventory(
+      self.cursor, self.rng, NUM_NODES, max_vessels_per_node=1)
+    self.vesselset = set()
+    self.vesseldicts_by_key = {}
+    for vesseldict in self.vesseldicts:
+      vessel_key = selexorruleparser.get_vessel_key(vesseldict)
+      self.vesselset.add(vessel_key)
+      self.vesseldicts_by_key[vessel_key] = vesseldict
+
+
+  def _is_valid_order(self, rules, vessel_keys):
+    # Whether the vessels can be added to the group in this order, with the
+    # group rules checked from scratch at every step.
+    acquired_vessels = []
+    for vessel_key in vessel_keys:
+      if acquired_vessels and vessel_key not in selexorruleparser.apply_group_rules(
+          rules, self.cursor, self.vesselset, acquired_vessels):
+        return False
+      acquired_vessels.append(self.vesseldicts_by_key[vessel_key])
+    return True
+
+
+  def _has_solution(self, rules, num_needed):
+    for vessel_keys in itertools.combinations(sorted(self.vesselset), num_needed):
+      for ordering in itertools.permutations(vessel_keys):
+        if self._is_valid_order(rules, ordering):
+          return True
+    return False
+
+
+  def test_solve_matches_exhaustive_search(self):
+    outcomes = set()
+    for inventory_no in range(NUM_INVENTORIES):
+      self._fill_inventory()
+      for rules in RULE_SETS:
+        rules = selexorruleparser.preprocess_rules(
+          dict([(rule, dict(parameters)) for (rule, parameters) in rules.items()]))
+        for num_needed in range(1, MAX_GROUP_SIZE + 1):
+          group_state = selexorruleparser.GroupRuleState(rules, self.cursor, self.vesselset)
+          outcome, solution = selexorsolver.solve(group_state, num_needed, time_budget=10)
+          outcomes.add(outcome)
+          description = str((rules, num_needed, outcome, solution))
+
+          self.assertEqual([], group_state.acquired_vessels, description)
+          self.assertEqual(outcome == selexorsolver.SOLVED,
+            self._has_solution(rules, num_needed), description)
+          if outcome == selexorsolver.SOLVED:
+            self.assertEqual(num_needed, len(set(solution)), description)
+            self.assertTrue(self._is_valid_order(rules, solution), description)
+          else:
+            self.assertEqual(selexorsolver.INFEASIBLE, outcome, description)
+            self.assertEqual([], solution, description)
+
+    # Make sure that the inventories are varied enough to test both answers.
+    self.assertEqual(set([selexorsolver.SOLVED, selexorsolver.INFEASIBLE]), outcomes)
+
+
+  def test_solve_times_out(self):
+    self._fill_inventory()
+    rules = selexorruleparser.preprocess_rules(
+      {'location_different': {'location_count': '3', 'location_type': 'country_code'}})
+    group_state = selexorruleparser.GroupRuleState(rules, self.cursor, self.vesselset)
+    # A budget that is used up before the search starts.
+    outcome, solution = selexorsolver.solve(group_state, 2, time_budget=-1)
+    self.assertEqual(selexorsolver.TIMED_OUT, outcome)
+    self.assertEqual([], solution)
+    self.assertEqual([], group_state.acquired_vessels)
+
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -113,12 +113,32 @@ var SHOW_UNIMPLEMENTED = true;
 
 var g_authenticated = false;
 var g_server_status;
+// The request's place in line while the server status is 'queued'.
+var g_queue_position;
 
+// The server holds status queries until the request changes, so the next
+// query can be sent as soon as a response arrives.  Failed queries are
+// retried after this many milliseconds.
 var SERVER_POLL_INTERVAL = 2000;
 var g_server_status_poll_timer;
+// The ID of the request being shown.  Status queries and releases are
+// addressed to it, as users may have several requests in progress.
+var g_request_id;
+// The version of the request status that was last received.
+var g_server_status_version;
+// The status of each group, as built up from the server's responses.
+// Responses after the first only contain what changed.
+var g_group_statuses = {};
 
 var g_vessels_acquired = {}
 
+// Requests are explained this many milliseconds after the user stops
+// editing them.
+var EXPLAIN_DELAY = 500;
+var g_explain_timer;
+// Only the response to the latest explanation is shown.
+var g_explain_sequence = 0;
+
 var PROGRESS_IMAGE_SRC = './images/progress.gif'
 
 /*
@@ -358,7 +378,8 @@ var extract_login_info_from_url_hash = function() {
   None
 <Side Effects>
   Updates each group's status.
-  Schedules another poll in SERVER_POLL_INTERVAL seconds.
+  Sends another query as soon as the request changes, while it is being
+  served.
 <Exceptions>
   None
 <Returns>
@@ -369,6 +390,11 @@ var poll_server_status = function() {
   var requestinfo = {
     'userdata': get_user_data()
   }
+  if (g_request_id != null)
+    requestinfo['request_id'] = g_request_id
+  // Ask the server to wait until there is something new to report.
+  if (g_server_status_version != null)
+    requestinfo['version'] = g_server_status_version
   $.ajax({
     url:'', type:'POST', dataType: 'text',
     data: repy_serialize({'query': requestinfo}),
@@ -379,20 +405,175 @@ var poll_server_status = function() {
   }).done(function(rawdata, textStatus, jqXhr) {
     var response = repy_deserialize(rawdata.trim())
     var data = response['data']
+    g_server_status_version = response['version']
     g_server_status = data['status']
-    update_group_status_spans(data['groups'])
-    if (g_server_status == 'working')
-      g_server_status_poll = setTimeout(poll_server_status, SERVER_POLL_INTERVAL)
-    else if (g_server_status == 'complete') {
-      update_vessels_dict(data['groups'])
-      $('.vessel_release').removeAttr('disabled')
+    g_queue_position = data['queue_position']
+    apply_group_statuses(data)
+    update_group_status_spans(g_group_statuses)
+    if (g_server_status == 'queued' || g_server_status == 'working')
+      g_server_status_poll_timer = setTimeout(poll_server_status, 0)
+    else {
+      $('#vessel_cancel_button').hide()
+      // Requests that were stopped early keep what they acquired so far.
+      if (g_server_status == 'cancelled')
+        $('#vessel_acquire_errtext').text("The request was cancelled.")
+      else if (g_server_status == 'timeout')
+        $('#vessel_acquire_errtext').text("The request ran out of time.")
+      if (g_server_status == 'complete' || g_server_status == 'cancelled' ||
+          g_server_status == 'timeout') {
+        update_vessels_dict(g_group_statuses)
+        $('.vessel_release').removeAttr('disabled')
+      }
     }
   }).fail(function(data, textStatus, jqXhr) {
-    alert("An error occurred while contacting the server...")
+    // Held queries may be cut off by proxies along the way, so try again.
+    g_server_status_poll_timer = setTimeout(poll_server_status, SERVER_POLL_INTERVAL)
+  });
+}
+
+
+/*
+<Purpose>
+  Applies a status response to g_group_statuses.
+<Arguments>
+  data:
+    The data of a status response.  If 'delta' is set, it only contains the
+    groups that changed, with the vessels that were added to and removed
+    from them.  Otherwise, it contains every group.
+<Side Effects>
+  Updates g_group_statuses.
+<Exceptions>
+  None
+<Returns>
+  None
+
+*/
+function apply_group_statuses(data) {
+  if (!data['delta'])
+    g_group_statuses = {}
+  for (var groupid in data['groups']) {
+    var changes = data['groups'][groupid]
+    var group = g_group_statuses[groupid]
+    if (!group)
+      group = g_group_statuses[groupid] = {'vessels_acquired': []}
+    group['status'] = changes['status']
+    group['error'] = changes['error']
+    group['target_num_vessels'] = changes['target_num_vessels']
+
+    // Vessels are keyed by handle, so a change that is sent twice is only
+    // applied once.
+    var gone = {}
+    for (var i in changes['vessels_removed'] || [])
+      gone[changes['vessels_removed'][i]] = true
+    for (var i in changes['vessels_acquired'])
+      gone[changes['vessels_acquired'][i]['handle']] = true
+    var vessels = []
+    for (var i in group['vessels_acquired'])
+      if (!gone[group['vessels_acquired'][i]['handle']])
+        vessels.push(group['vessels_acquired'][i])
+    group['vessels_acquired'] = vessels.concat(changes['vessels_acquired'])
+  }
+}
+
+
+/*
+<Purpose>
+  Explains the current request once the user has stopped editing it for
+  EXPLAIN_DELAY milliseconds.
+<Arguments>
+  None
+<Side Effects>
+  Cancels any explanation that was scheduled before.
+<Exceptions>
+  None
+<Returns>
+  None
+
+*/
+function schedule_request_explanation() {
+  clearTimeout(g_explain_timer)
+  g_explain_timer = setTimeout(explain_request, EXPLAIN_DELAY)
+}
+
+
+/*
+<Purpose>
+  Asks the selexor server how well the current request could be served,
+  without acquiring anything.
+<Arguments>
+  None
+<Side Effects>
+  Updates the status cell of each group with the explanation.
+<Exceptions>
+  None
+<Returns>
+  None
+
+*/
+function explain_request() {
+  // Don't hide the status of a request that is being served.
+  if (!g_authenticated || g_server_status == 'queued' || g_server_status == 'working')
+    return
+  var groups = convert_rules_to_string()
+  if (isEmpty(groups))
+    return
+
+  var sequence = ++g_explain_sequence
+  $.ajax({
+    url:'', type:'POST', dataType: 'text',
+    data: repy_serialize({'explain': {'userdata': get_user_data(), 'groups': groups}}),
+    beforeSend: function(jqXhr) {
+      if (jqXhr && jqXhr.overrideMimeType)
+        jqXhr.overrideMimeType("text/plain;charset=UTF-8");
+      }
+  }).done(function(rawdata, textStatus, jqXhr) {
+    var response = repy_deserialize(rawdata.trim())
+    if (sequence != g_explain_sequence || response['status'] == 'error')
+      return
+    update_group_explanations(response['data']['groups'])
   });
 }
 
 
+/*
+<Purpose>
+  Shows the explanation of each group in its status cell.
+<Arguments>
+  groups:
+    The 'groups' of an explanation returned by the selexor server.
+<Side Effects>
+  Updates and shows the status cell of each group.
+<Exceptions>
+  None
+<Returns>
+  None
+
+*/
+function update_group_explanations(groups) {
+  for (var groupid in groups) {
+    var group = g_groupid_to_row[groupid]
+    var explanation = groups[groupid]
+    var notice = ''
+    var error_node = $(group).find('.error_node')
+    error_node.clear_error()
+
+    if (explanation['error'])
+      error_node.show_error(explanation['error'])
+    else {
+      notice = explanation['candidates'] + " matching vessels"
+      if (explanation['feasibility'] == 'infeasible')
+        error_node.show_error("Not enough vessels satisfy these rules right now.")
+      else if (explanation['feasibility'] == 'feasible')
+        notice += ", request can be met"
+    }
+
+    $(group).find('.progress_image').hide()
+    $(group).find('.progress_text').text(notice)
+    $(group).find('.status_cell').css('display', 'table-cell')
+  }
+}
+
+
 /*
 <Purpose>
   Updates g_vessels_acquired to reflect what's inside groups.
@@ -469,6 +650,7 @@ function update_group_status_spans(groups) {
     } else {
       switch (g_server_status) {
       case 'accepted':
+      case 'queued':
       case 'working':
         image_source = PROGRESS_IMAGE_SRC
         break
@@ -481,14 +663,23 @@ function update_group_status_spans(groups) {
       case 'accepted':
       case 'working':
       case 'complete':
+      case 'cancelled':
+      case 'timeout':
         notice = "Complete!"
         break
       }
     } else {
       switch(g_server_status) {
+      case 'queued':
+        notice = "Waiting in line"
+        if (g_queue_position)
+          notice += " (position " + g_queue_position + ")"
+        break
       case 'accepted':
       case 'working':
       case 'complete':
+      case 'cancelled':
+      case 'timeout':
         notice = groups[groupid]['vessels_acquired'].length + " of " + groups[groupid]['target_num_vessels']
         break
       }
@@ -515,6 +706,8 @@ function update_group_status_spans(groups) {
     // Show vessel release cell
     switch(g_server_status) {
     case 'complete':
+    case 'cancelled':
+    case 'timeout':
       // Don't display remove button if there are no vessels
       if (groups[groupid]['vessels_acquired'].length)
         $('.vessel_release').css('display', 'table-cell')
@@ -815,10 +1008,15 @@ var send_host_request = function() {
       $('#acquire_capsule').removeClass('error');
 
       var data = response['data']
+      g_request_id = data['request_id']
       update_group_status_spans(data['groups'])
 
       if (data['status'] == 'error') {
         update_group_status_spans(data['groups'])
+        if (data['error']) {
+          $('#vessel_acquire_errtext').text(data['error'])
+          $('#acquire_capsule').addClass('error');
+        }
         $('.vessel_release').removeAttr('disabled')
       } else {
         // Success!
@@ -826,6 +1024,10 @@ var send_host_request = function() {
           // Prevent user from making changes while code is running
           $('input, select').attr('disabled', 'disabled')
         }
+        $('#vessel_cancel_button').removeAttr('disabled').show()
+        // The new request has a version of its own.
+        g_server_status_version = null
+        g_group_statuses = {}
         poll_server_status()
       }
     }
@@ -838,6 +1040,54 @@ var send_host_request = function() {
 
 
 
+/*
+<Purpose>
+  Cancels the request that is being served.  Groups keep the vessels that
+  were acquired so far, unless the user asks for them to be released.
+<Arguments>
+  None
+<Side Effects>
+  Connects to the server and cancels the request.
+  The status poll picks up the request's final status.
+<Exceptions>
+  None
+<Returns>
+  None
+
+*/
+var cancel_host_request = function() {
+  if (!confirm("Are you sure you want to cancel this request?"))
+    return
+
+  var cancelinfo = {
+    'userdata': get_user_data(),
+    'release': confirm("Release the vessels that were acquired so far?")
+  }
+  if (g_request_id != null)
+    cancelinfo['request_id'] = g_request_id
+  $('#vessel_cancel_button').attr('disabled', 'disabled')
+
+  $.ajax({
+    url:'', type:'POST', dataType: 'text',
+    data: repy_serialize({'cancel': cancelinfo}),
+    beforeSend: function(jqXhr) {
+      if (jqXhr && jqXhr.overrideMimeType)
+        jqXhr.overrideMimeType("text/plain;charset=UTF-8");
+      }
+  }).done(function(rawdata, textStatus, jqXhr) {
+    var response = repy_deserialize(rawdata.trim())
+    if (response['status'] == 'error') {
+      $('#vessel_acquire_errtext').text(response['error'])
+      $('#vessel_cancel_button').removeAttr('disabled')
+    }
+  }).fail(function(data, textStatus, jqXhr) {
+    alert("Failed to connect to server!")
+    $('#vessel_cancel_button').removeAttr('disabled')
+  });
+}
+
+
+
 /*
 <Purpose>
   Creates a drop-down menu.
@@ -1197,6 +1447,8 @@ function release_group(groupid) {
     'userdata': get_user_data(),
     'vessels': g_vessels_acquired[groupid]
   }
+  if (g_request_id != null)
+    release_data['request_id'] = g_request_id
   var row = $(g_groupid_to_row[groupid])
   // Show progress image
   row.find('.release_progress_image').css('display', 'inline')
@@ -1220,9 +1472,15 @@ function release_group(groupid) {
         g_num_hosts_remaining += data[1]
   
         update_remaining_host_count()
-        row.find('.vessel_release, .status_cell').hide();
-        // We don't need to keep track of these vessels anymore
-        delete g_vessels_acquired[groupid]
+        if (data[2] && data[2].length > 0) {
+          // Keep the vessels that weren't released so they can be retried
+          g_vessels_acquired[groupid] = data[2]
+          error = 'Failed to release ' + data[2].length + ' vessel(s).'
+        } else {
+          row.find('.vessel_release, .status_cell').hide();
+          // We don't need to keep track of these vessels anymore
+          delete g_vessels_acquired[groupid]
+        }
       } else
         error = data[1]
       } 
@@ -1370,9 +1628,17 @@ var setup_form = function() {
   $("input#vessel_acquire_button").bind('click', function() {
       send_host_request()
     })
+  $("input#vessel_cancel_button").bind('click', function() {
+      cancel_host_request()
+    })
   $("input#authentication_button").bind('click', function() {
       authenticate()
     })
+
+  // Tell the user whether their request can be served as they edit it
+  $('#group_table')
+    .on('change keyup', 'input, select', schedule_request_explanation)
+    .on('click', 'button', schedule_request_explanation)
 }
 
 /*